@@ -6,10 +6,21 @@ import pox.openflow.libopenflow_01 as of
 from pox.lib.packet.arp import arp
 from pox.lib.packet.ipv4 import ipv4
 from pox.lib.addresses import EthAddr, IPAddr
+from pox.lib.recoco import Timer
 log = core.getLogger()
 import time
 import random
 import json # addition to read configuration from file
+import zlib
+import bisect
+import logging
+import threading
+import functools
+from collections import deque, OrderedDict
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError: #python2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 
 from pox.lib.packet.ethernet import ethernet, ETHER_BROADCAST
 
@@ -23,25 +34,336 @@ class colors:
     underline   = '\033[04m'
 
 FLOW_IDLE_TIMEOUT = 10
+PROACTIVE_PRIORITY = of.OFP_DEFAULT_PRIORITY + 1 #proactive wildcard rules win over the reactive ones
+STATS_POLL_INTERVAL = 2 #seconds between two flow/port statistics requests
+STATS_WINDOW = 5 #number of port statistics samples kept per server (sliding window)
+MAGLEV_TABLE_SIZE = 4099 #prime, much larger than the number of replicas of a group
+AFFINITY_TIMEOUT = 120 #seconds a TCP/UDP connection keeps its server after its last activity
+AFFINITY_SWEEP_INTERVAL = 30 #seconds between two sweeps of the connection affinity tables
+BALANCED_PROTOCOLS = (6, 17) #TCP and UDP are balanced per connection (5-tuple), anything else per client
+ARP_ENTRY_TTL = 300 #seconds an ARP entry is valid after it was (re)learned
+ARP_CACHE_SIZE = 4096 #ARP entries kept per switch, the least recently used are evicted
+ARP_REFRESH_INTERVAL = 30 #seconds between two refreshes of the ARP entries that are getting old
+ARP_REPLY_CACHE_SIZE = 4096 #pre-packed ARP reply frames kept by the controller
+METRICS_REFRESH_INTERVAL = 5 #seconds between two refreshes of the exported gauges
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1) #seconds
 
-class SimpleLoadBalancer(object):
-    #An ARP table containing the pair (IP, port) for each IP
-    arpTable={}
+# a small metrics registry (counters, gauges and latency histograms) exported in the Prometheus text format
+class MetricsRegistry(object):
+    def __init__(self):
+        self.counters = {}   #key = (name, labels), value = number
+        self.gauges = {}     #key = (name, labels), value = number
+        self.histograms = {} #key = (name, labels), value = [per bucket counts (+Inf last), sum, count]
+        self.help = {}       #key = name, value = (type, description)
+        self.lock = threading.Lock() #updated by the POX thread, exported by the HTTP thread
+
+    # describe a metric (name, "counter"/"gauge"/"histogram", help text)
+    def describe(self, name, metric_type, description):
+        self.help[name] = (metric_type, description)
+
+    # labels are given as a tuple of (name, value) pairs
+    def inc(self, name, labels = (), value = 1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    # replace every gauge of a metric, given as a dict with key = labels, value = number
+    def set_gauges(self, name, values):
+        with self.lock:
+            for key in [key for key in self.gauges if key[0] == name]:
+                del self.gauges[key]
+            for (labels, value) in values.items():
+                self.gauges[(name, labels)] = value
+
+    def observe(self, name, value, labels = ()):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @staticmethod
+    def format_labels(labels, extra = ()):
+        labels = tuple(labels) + tuple(extra)
+        if len(labels) == 0:
+            return ""
+        return "{" + ",".join('%s="%s"' % (name, value) for (name, value) in labels) + "}"
+
+    # the registry in the Prometheus text exposition format
+    def render(self):
+        with self.lock: #a consistent snapshot, formatted without holding the lock
+            values = list(self.counters.items()) + list(self.gauges.items())
+            histograms = [(key, (list(buckets), total, count)) for (key, (buckets, total, count)) in self.histograms.items()]
+        lines = []
+        described = set()
+        def header(name):
+            if name not in described and name in self.help:
+                lines.append("# HELP %s %s" % (name, self.help[name][1]))
+                lines.append("# TYPE %s %s" % (name, self.help[name][0]))
+                described.add(name)
+        for ((name, labels), value) in sorted(values, key = lambda item: str(item[0])):
+            header(name)
+            lines.append("%s%s %s" % (name, self.format_labels(labels), value))
+        for ((name, labels), (buckets, total, count)) in sorted(histograms, key = lambda item: str(item[0])):
+            header(name)
+            cumulative = 0
+            for (bound, bucket) in zip(list(LATENCY_BUCKETS) + ["+Inf"], buckets):
+                cumulative += bucket
+                lines.append("%s_bucket%s %d" % (name, self.format_labels(labels, (("le", bound),)), cumulative))
+            lines.append("%s_sum%s %.9f" % (name, self.format_labels(labels), total))
+            lines.append("%s_count%s %d" % (name, self.format_labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+# serve the metrics of a registry over HTTP on a local port (in a background thread)
+def start_metrics_server(metrics, port):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args): #keep the controller's output clean
+            pass
+
+    server = HTTPServer(("127.0.0.1", port), MetricsHandler)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+# measure the latency of a SimpleLoadBalancer handler into the lb_handler_seconds histogram
+def timed(handler):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(self, *args, **kw):
+            start = time.time()
+            try:
+                return function(self, *args, **kw)
+            finally:
+                self.metrics.observe("lb_handler_seconds", time.time() - start, (("handler", handler),))
+        return wrapper
+    return decorator
+
+# an ARP table (IP -> (MAC, port)) with TTL aging and a size cap with LRU eviction
+class ArpCache(object):
+    def __init__(self, ttl = ARP_ENTRY_TTL, max_entries = ARP_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict() #key = ip, value = (mac, port, time learned), least recently used first
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, ip):
+        return self.get(ip) is not None
+
+    def __getitem__(self, ip):
+        entry = self.get(ip)
+        if entry is None:
+            raise KeyError(ip)
+        return entry
+
+    # (re)learn an entry, which also restarts its TTL
+    def __setitem__(self, ip, value):
+        self.entries.pop(ip, None)
+        self.entries[ip] = (value[0], value[1], time.time())
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last = False)
+
+    # the (mac, port) of an ip, None if unknown or expired
+    def get(self, ip, default = None):
+        entry = self.entries.get(ip)
+        if entry is None:
+            return default
+        if time.time() - entry[2] > self.ttl:
+            del self.entries[ip]
+            return default
+        self.entries[ip] = self.entries.pop(ip) #most recently used
+        return (entry[0], entry[1])
+
+    def items(self):
+        now = time.time()
+        return [(ip, (entry[0], entry[1])) for (ip, entry) in list(self.entries.items()) if now - entry[2] <= self.ttl]
+
+    # drop the expired entries
+    def expire(self):
+        now = time.time()
+        for (ip, entry) in list(self.entries.items()):
+            if now - entry[2] > self.ttl:
+                del self.entries[ip]
+
+    # the entries learned more than age seconds ago (still valid)
+    def older_than(self, age):
+        now = time.time()
+        return [(ip, (entry[0], entry[1])) for (ip, entry) in list(self.entries.items()) if age < now - entry[2] <= self.ttl]
+
+# liveness of a server as seen by the health checks (with hysteresis)
+class ServerHealth(object):
+    def __init__(self):
+        self.alive = True       #servers are assumed alive until they miss enough probes
+        self.awaiting = False   #a probe was sent and not answered yet
+        self.misses = 0         #consecutive unanswered probes
+        self.successes = 0      #consecutive answered probes
+
+# Maglev consistent hashing lookup table for the replicas of a group
+class MaglevTable(object):
+    def __init__(self, servers, size = MAGLEV_TABLE_SIZE):
+        self.size = size
+        self.servers = sorted(servers, key = lambda ip: ip.toUnsigned())
+        self.table = self.populate()
+
+    # a stable hash (the same across controller restarts)
+    @staticmethod
+    def hash(key, seed):
+        return zlib.crc32((seed + str(key)).encode()) & 0xffffffff
+
+    # fill the table following each server's permutation in turns, so every server gets an equal share
+    def populate(self):
+        if len(self.servers) == 0:
+            return []
+        offsets = [self.hash(server, "offset") % self.size for server in self.servers]
+        skips = [self.hash(server, "skip") % (self.size - 1) + 1 for server in self.servers]
+        next_index = [0] * len(self.servers)
+        table = [None] * self.size
+        filled = 0
+        while True:
+            for i in range(len(self.servers)):
+                slot = (offsets[i] + skips[i] * next_index[i]) % self.size
+                while table[slot] is not None:
+                    next_index[i] += 1
+                    slot = (offsets[i] + skips[i] * next_index[i]) % self.size
+                table[slot] = self.servers[i]
+                next_index[i] += 1
+                filled += 1
+                if filled == self.size:
+                    return table
+
+    # O(1) lookup of the server for a key (e.g. the client ip)
+    def lookup(self, key):
+        if len(self.table) == 0:
+            return None
+        return self.table[self.hash(key, "key") % self.size]
+
+# a load balanced service (VIP) and its clients/servers, as loaded from the configuration
+class LoadBalancedService(object):
+    def __init__(self, lb_mac, service_ip, server_ips, user_ip_to_group, server_ip_to_group):
+        self.lb_mac = lb_mac
+        self.service_ip = service_ip
+        self.server_ips = server_ips
+        self.user_ip_to_group = user_ip_to_group
+        self.server_ip_to_group = server_ip_to_group
+
+        #the replicas of every group and their consistent hashing tables
+        self.group_servers = {}
+        for (ip, group) in self.server_ip_to_group.items():
+            self.group_servers.setdefault(group, []).append(ip)
+        self.down_servers = set() #servers that failed their health checks
+        self.maglev_tables = {} #key = group, value = MaglevTable
+        self.build_maglev_tables()
+
+        #proactive mode: wildcard nw_src prefixes pinned to a replica (key = server ip, value = list of (ip, prefix length))
+        self.base_plan = {}      #as planned with all the servers alive
+        self.proactive_plan = {} #as currently pinned (the prefixes of dead servers are moved to live ones)
+
+    def __repr__(self):
+        return str(self.service_ip)
+
+    # the replicas of a group that are currently alive
+    def live_servers(self, group):
+        return [ip for ip in self.group_servers[group] if ip not in self.down_servers]
+
+    # (re)build the consistent hashing table of every group from its live replicas
+    def build_maglev_tables(self):
+        for group in self.group_servers:
+            self.maglev_tables[group] = MaglevTable(self.live_servers(group))
+
+    # pin the planned prefixes to the live servers, a dead server's prefixes are spread over its group by consistent hashing
+    def update_proactive_plan(self):
+        plan = {}
+        for (server_ip, prefixes) in self.base_plan.items():
+            for prefix in prefixes:
+                owner = server_ip
+                if server_ip in self.down_servers:
+                    owner = self.maglev_tables[self.server_ip_to_group[server_ip]].lookup("%s/%d" % prefix)
+                if owner is not None:
+                    plan.setdefault(owner, []).append(prefix)
+        self.proactive_plan = plan
+
+    # the currently pinned server of every proactive prefix
+    def prefix_owners(self):
+        owners = {}
+        for (server_ip, prefixes) in self.proactive_plan.items():
+            for prefix in prefixes:
+                owners[prefix] = server_ip
+        return owners
+
+    # the server a client is pinned to by the proactive prefixes (None if it is not covered)
+    def pinned_server(self, client_ip):
+        for (server_ip, prefixes) in self.proactive_plan.items():
+            for (network, length) in prefixes:
+                if in_prefix(client_ip.toUnsigned(), network.toUnsigned(), length):
+                    return server_ip
+        return None
+
+# the load balancing state of a single switch (datapath)
+class LoadBalancerSwitch(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.dpid = connection.dpid
+
+        #An ARP table containing the pair (MAC, port) for each IP seen on this switch
+        self.arpTable = ArpCache()
+
+        #the lb choise for each (service ip, host ip)
+        self.lb_choise = {}
 
-    #a starting position for the lb choise for each host ip
-    lb_choise={
-        IPAddr("10.0.0.1"):IPAddr("10.0.0.5"),
-        IPAddr("10.0.0.2"):IPAddr("10.0.0.6"),
-        IPAddr("10.0.0.3"):IPAddr("10.0.0.7"),
-        IPAddr("10.0.0.4"):IPAddr("10.0.0.8")
-        }
+        #proactive mode: the server whose replies are installed towards each client, key = (service ip, client ip)
+        self.proactive_replies = {}
+
+        #installed client -> server flows, value = server ip, key = flow key:
+        #(service ip, client ip) for per client flows, (service ip, client ip, protocol, client port, service port) for TCP/UDP connections
+        self.flows = {}
+
+        #connection affinity table, key = connection flow key, value = [server ip, last time the connection was seen]
+        self.affinity = {}
+
+        #load statistics of each server, fed by the periodic flow/port statistics replies
+        self.port_samples = {} #key = server ip, value = deque of (time, tx_bytes, tx_packets)
+        self.server_flows = {} #key = server ip, value = number of client flows towards it
+        self.stats_timer = None
+
+    def __repr__(self):
+        return str(self.dpid)
+
+    # rate of (bytes, packets) per second sent to a server over the sliding window
+    def server_rate(self, server_ip):
+        samples = self.port_samples.get(server_ip)
+        if not samples or len(samples) < 2 or samples[-1][0] <= samples[0][0]:
+            return (0.0, 0.0)
+        elapsed = samples[-1][0] - samples[0][0]
+        return ((samples[-1][1] - samples[0][1]) / elapsed, (samples[-1][2] - samples[0][2]) / elapsed)
+
+    # load of a server, the byte rate first and the number of flows as a tie breaker
+    def server_load(self, server_ip):
+        return (self.server_rate(server_ip)[0], self.server_flows.get(server_ip, 0))
+
+class SimpleLoadBalancer(object):
 
     #a colorful way to display macs
     def mac_wcolor(self,mac):
         returnstr = ""
-        lastint = int(str(mac)[-1])
+        lastint = int(str(mac)[-1], 16)
 
-        if mac == self.lb_mac:
+        if mac in self.lb_macs:
             returnstr += colors.reset
             returnstr += colors.green
         elif lastint < 5 and lastint > 0: 
@@ -66,105 +388,384 @@ class SimpleLoadBalancer(object):
     def ip_wcolor(self,ip):
         returnstr = ""
 
-        if ip in self.user_ip_to_group:
-            returnstr = colors.reset
-            if self.user_ip_to_group[ip] == "red":
-                returnstr += colors.red
-            else:
-                returnstr += colors.blue
+        if ip in self.services:
+            returnstr = colors.underline + colors.green
 
-        elif ip in self.server_ip_to_group:
+        elif ip in self.server_to_service:
             returnstr = colors.underline
-            if self.server_ip_to_group[ip] == "red":
+            if self.server_to_service[ip].server_ip_to_group[ip] == "red":
                 returnstr += colors.red
             else:
                 returnstr += colors.blue
 
-        elif ip == self.service_ip:
-            returnstr = colors.underline + colors.green
-
         else:
-            returnstr = colors.reset + colors.reset
+            services = self.client_services(ip)
+            if len(services) > 0:
+                returnstr = colors.reset
+                if services[0].user_ip_to_group[ip] == "red":
+                    returnstr += colors.red
+                else:
+                    returnstr += colors.blue
+            else:
+                returnstr = colors.reset + colors.reset
 
         returnstr += str(ip) + colors.reset
         return returnstr
 
-    #a print function to print the ARP table
-    def print_arp_table(self):
-        print("\n{:^44}".format("Switch ARP table"))
+    #a print function to print the ARP table of a switch (only when info messages are logged)
+    def print_arp_table(self, sw):
+        if not log.isEnabledFor(logging.INFO):
+            return
+        print("\n{:^44}".format("Switch %s ARP table" % (sw.dpid)))
         print("|{:^15}".format("IP") + "|{:^19}".format("MAC") + "|{:^6}|".format("PORT"))
-        for item in self.arpTable.items():
+        for item in sw.arpTable.items():
             print("+---------------+-------------------+------+")
             print("|{:^30}".format(self.ip_wcolor(item[0])) + "|{:^34}".format(self.mac_wcolor(item[1][0])) + "|{:^6}|".format(item[1][1]))
         print("--------------------------------------------")
 
-    #update the ARP table when a new packet arrives
-    def update_ARP_table(self, ip, mac, inport):
-        if(ip in self.arpTable) and (self.arpTable[ip] == (mac,inport)): # if ARP entry already exists
-            log.info(colors.yellow + "APR entry for IP: " + self.ip_wcolor(ip) + colors.yellow + " already exists" + colors.reset)
-        elif (ip in self.arpTable): # if ARP entry exists but with different values
-            self.arpTable[ip]=(mac,inport) # Update arp table
-            log.info(colors.yellow + "ARP entry exists, but got updated! (for IP " + self.ip_wcolor(ip) + colors.yellow + ")" + colors.reset)
+    #update the ARP table of a switch when a new packet arrives (returns True if the table changed)
+    def update_ARP_table(self, sw, ip, mac, inport):
+        if(ip in sw.arpTable) and (sw.arpTable[ip] == (mac,inport)): # if ARP entry already exists
+            sw.arpTable[ip]=(mac,inport) # only refresh its TTL
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(colors.yellow + "APR entry for IP: " + self.ip_wcolor(ip) + colors.yellow + " already exists" + colors.reset)
+            return False
+        elif (ip in sw.arpTable): # if ARP entry exists but with different values
+            sw.arpTable[ip]=(mac,inport) # Update arp table
+            if log.isEnabledFor(logging.INFO):
+                log.info(colors.yellow + "ARP entry exists, but got updated! (for IP " + self.ip_wcolor(ip) + colors.yellow + ")" + colors.reset)
         else: #if arp entry does not exist
-            self.arpTable[ip]=(mac,inport) #Add it
-            log.info(colors.yellow + "New ARP entry for IP: " + self.ip_wcolor(ip) + colors.yellow + " installed" + colors.reset)
+            sw.arpTable[ip]=(mac,inport) #Add it
+            if log.isEnabledFor(logging.INFO):
+                log.info(colors.yellow + "New ARP entry for IP: " + self.ip_wcolor(ip) + colors.yellow + " installed" + colors.reset)
+        return True
 
     # initialize SimpleLoadBalancer class instance
-    def __init__(self, lb_mac = None, service_ip = None, 
-                 server_ips = [], user_ip_to_group = {}, server_ip_to_group = {}):
+    def __init__(self, services = [], proactive = False, lb_policy = "maglev",
+                 health_check_interval = 0, health_check_fall = 3, health_check_rise = 2, metrics_port = 0):
+        
+        # the metrics of the hot paths, exported over HTTP on a local port if one is given
+        self.metrics = MetricsRegistry()
+        self.metrics.describe("lb_packet_in_total", "counter", "Packet-in events handled, by packet type")
+        self.metrics.describe("lb_arp_replies_total", "counter", "Proxied ARP replies sent")
+        self.metrics.describe("lb_arp_lookups_total", "counter", "ARP table lookups on the IP path, by result (hit/miss)")
+        self.metrics.describe("lb_arp_reply_frames_total", "counter", "ARP replies sent from a pre-packed frame (hit) or built (miss)")
+        self.metrics.describe("lb_flow_mods_total", "counter", "Flow mods sent, by kind")
+        self.metrics.describe("lb_handler_seconds", "histogram", "Latency of the handlers")
+        self.metrics.describe("lb_flows", "gauge", "Installed client flows per server")
+        self.metrics.describe("lb_server_up", "gauge", "Health of every server (1 up, 0 down)")
+        self.metrics.describe("lb_arp_entries", "gauge", "ARP table entries per switch")
+        self.metrics.describe("lb_affinity_entries", "gauge", "Connection affinity entries per switch")
+        self.metrics_timer = None
+        if metrics_port > 0:
+            start_metrics_server(self.metrics, metrics_port)
+            #the gauges walk the controller's tables, so they are refreshed on the POX thread
+            self.metrics_timer = Timer(METRICS_REFRESH_INTERVAL, self.collect_metrics, recurring = True)
         
         # add the necessary openflow listeners
         core.openflow.addListeners(self)
 
-        # set class parameters
-        self.lb_mac = lb_mac
-        self.service_ip = service_ip
-        self.server_ips = server_ips
-        self.user_ip_to_group = user_ip_to_group
-        self.server_ip_to_group = server_ip_to_group
+        # the VIP table, key = service ip, value = LoadBalancedService
+        self.services = {}
+        self.server_to_service = {} #key = server ip, value = LoadBalancedService
+        self.lb_macs = set()
+        for service in services:
+            self.services[service.service_ip] = service
+            self.lb_macs.add(service.lb_mac)
+            for server_ip in service.server_ip_to_group:
+                self.server_to_service[server_ip] = service
+
+        # per datapath state, key = dpid, value = LoadBalancerSwitch
+        self.switches = {}
+
+        #proactive mode: wildcard nw_src prefixes pinned to a replica of each service
+        self.proactive = proactive
+        if self.proactive:
+            for service in self.services.values():
+                service.base_plan = plan_proactive_prefixes(service.user_ip_to_group, service.server_ip_to_group, list(self.services.keys()))
+                service.update_proactive_plan()
+
+        #server selection policy ("maglev", "random", "least_loaded" or "weighted")
+        self.lb_policy = lb_policy
+
+        #active health checks: a server is down after health_check_fall unanswered probes and up again after health_check_rise answered ones
+        self.health_check_fall = health_check_fall
+        self.health_check_rise = health_check_rise
+        self.server_health = dict((server_ip, ServerHealth()) for server_ip in self.server_to_service)
+        self.health_timer = None
+        if health_check_interval > 0:
+            self.health_timer = Timer(health_check_interval, self.run_health_checks, recurring = True)
+
+        #age out the connection affinity entries of finished connections
+        self.affinity_timer = Timer(AFFINITY_SWEEP_INTERVAL, self.age_affinity_tables, recurring = True)
+
+        #refresh the ARP entries before they expire, and keep the ARP replies pre-packed
+        self.arp_refresh_timer = Timer(ARP_REFRESH_INTERVAL, self.refresh_arp_tables, recurring = True)
+        self.arp_reply_frames = OrderedDict() #key = (service ip, requester macs and ip, requested ip, replied mac, port), value = packed packet-out
         pass
 
+    # refresh the gauges from the controller's tables (on the POX thread)
+    def collect_metrics(self):
+        flows = dict(((("server", server_ip),), 0) for server_ip in self.server_to_service)
+        arp_entries = {}
+        affinity_entries = {}
+        for sw in self.switches.values():
+            for server_ip in sw.flows.values():
+                flows[(("server", server_ip),)] = flows.get((("server", server_ip),), 0) + 1
+            arp_entries[(("dpid", sw.dpid),)] = len(sw.arpTable)
+            affinity_entries[(("dpid", sw.dpid),)] = len(sw.affinity)
+        self.metrics.set_gauges("lb_flows", flows)
+        self.metrics.set_gauges("lb_arp_entries", arp_entries)
+        self.metrics.set_gauges("lb_affinity_entries", affinity_entries)
+        self.metrics.set_gauges("lb_server_up", dict(((("server", server_ip),), 1 if health.alive else 0) for (server_ip, health) in self.server_health.items()))
+
+    # the services a client is a member of
+    def client_services(self, client_ip):
+        return [service for service in self.services.values() if client_ip in service.user_ip_to_group]
+
     # respond to switch connection up event
     def _handle_ConnectionUp(self, event):
-        self.connection = event.connection
-        # write your code here!!!
+        if event.dpid in self.switches and self.switches[event.dpid].stats_timer is not None:
+            self.switches[event.dpid].stats_timer.cancel()
+        sw = self.switches[event.dpid] = LoadBalancerSwitch(event.connection)
         log.info(colors.purple+"Switch " + str(event.connection) + " has come up."+colors.reset )
         
-        # send arp request to all hosts
-        for(ip, group) in self.user_ip_to_group.items():
-            self.send_proxied_arp_request(event.connection, ip)
+        for service in self.services.values():
+            # send arp request to all hosts
+            for(ip, group) in service.user_ip_to_group.items():
+                self.send_proxied_arp_request(service, event.connection, ip)
 
-        log.info(colors.purple+"Sent ARP requests to all hosts"+colors.reset)
+            log.info(colors.purple+"Sent ARP requests to all hosts of service " + self.ip_wcolor(service.service_ip) + colors.reset)
 
-        #send arp request to all servers
-        for(ip, group) in self.server_ip_to_group.items():
-            self.send_proxied_arp_request(event.connection, ip)
+            #send arp request to all servers
+            for(ip, group) in service.server_ip_to_group.items():
+                self.send_proxied_arp_request(service, event.connection, ip)
         
-        log.info(colors.purple+"Sent ARP requests to all servers"+colors.reset)
+            log.info(colors.purple+"Sent ARP requests to all servers of service " + self.ip_wcolor(service.service_ip) + colors.reset)
+
+            #the client address space was split into per group prefixes, the rules are installed once the servers' ARP entries are known
+            for (server_ip, prefixes) in service.proactive_plan.items():
+                log.info(colors.purple + "Proactive prefixes for " + self.ip_wcolor(server_ip) + colors.purple + ": " + ", ".join("%s/%d" % prefix for prefix in prefixes) + colors.reset)
+
+        #start polling the switch for statistics when the selection depends on the servers' load
+        if self.lb_policy in ("least_loaded", "weighted"):
+            sw.stats_timer = Timer(STATS_POLL_INTERVAL, self.request_stats, recurring = True, args = [sw])
         pass
 
-    # update the load balancing choice for a certain client
-    def update_lb_mapping(self, client_ip):
-        choise = random.randint(0,1) # flip a coin for the choise        
+    # forget a client -> server flow that expired, its connection (if any) stays pinned until it ages out
+    def _handle_FlowRemoved(self, event):
+        if event.dpid not in self.switches or event.deleted: #deleted flows are already forgotten
+            return
+        sw = self.switches[event.dpid]
+        match = event.ofp.match
+        if match.nw_proto in BALANCED_PROTOCOLS:
+            key = (match.nw_dst, match.nw_src, match.nw_proto, match.tp_src, match.tp_dst)
+            if key in sw.affinity:
+                sw.affinity[key][1] = time.time()
+        else:
+            key = (match.nw_dst, match.nw_src)
+        sw.flows.pop(key, None)
 
-        if(self.user_ip_to_group[client_ip] == "red"): #if client ip is in the red group
-            choise += 5
-        elif(self.user_ip_to_group[client_ip] == "blue"): #if client ip is in the blue group
-            choise += 7
-        else: #imposible case
-            print(colors.red + "The impossible has happend in update_lb_mapping!" + colors.reset)
+    # ask again for the ARP entries that are getting old (with a request sent straight to the host) and drop the expired ones
+    def refresh_arp_tables(self):
+        for sw in list(self.switches.values()):
+            sw.arpTable.expire()
+            for (ip, arp_entry) in sw.arpTable.older_than(ARP_ENTRY_TTL / 2.0):
+                if ip in self.server_to_service:
+                    service = self.server_to_service[ip]
+                else:
+                    services = self.client_services(ip)
+                    if len(services) == 0:
+                        continue
+                    service = services[0]
+                self.send_proxied_arp_request(service, sw.connection, ip, arp_entry)
 
+    # drop the affinity of connections that have no flow installed and were idle for too long
+    def age_affinity_tables(self):
+        now = time.time()
+        for sw in self.switches.values():
+            for (key, (server_ip, last_seen)) in list(sw.affinity.items()):
+                if key not in sw.flows and now - last_seen > AFFINITY_TIMEOUT:
+                    del sw.affinity[key]
 
-        #based on the choise, update the mapping
-        if(choise == 5): self.lb_choise[client_ip]=IPAddr("10.0.0.5")  
-        elif(choise == 6): self.lb_choise[client_ip]=IPAddr("10.0.0.6")
-        elif(choise == 7): self.lb_choise[client_ip]=IPAddr("10.0.0.7")
-        elif(choise == 8): self.lb_choise[client_ip]=IPAddr("10.0.0.8")  
-            
-        pass
+    # forget the state of a switch that went down
+    def _handle_ConnectionDown(self, event):
+        if event.dpid in self.switches:
+            if self.switches[event.dpid].stats_timer is not None:
+                self.switches[event.dpid].stats_timer.cancel()
+            del self.switches[event.dpid]
+            log.info(colors.purple+"Switch %s has gone down." % (event.dpid) + colors.reset)
+
+    # ask a switch for its flow and port statistics
+    def request_stats(self, sw):
+        sw.connection.send(of.ofp_stats_request(body = of.ofp_flow_stats_request()))
+        sw.connection.send(of.ofp_stats_request(body = of.ofp_port_stats_request()))
+
+    # count the client flows that each server currently receives
+    def _handle_FlowStatsReceived(self, event):
+        if event.dpid not in self.switches:
+            return
+        server_flows = {}
+        for flow in event.stats:
+            for action in flow.actions:
+                if action.type == of.OFPAT_SET_NW_DST and action.nw_addr in self.server_to_service:
+                    server_flows[action.nw_addr] = server_flows.get(action.nw_addr, 0) + 1
+        self.switches[event.dpid].server_flows = server_flows
+
+    # keep a sliding window of the traffic sent out of each server's port
+    def _handle_PortStatsReceived(self, event):
+        if event.dpid not in self.switches:
+            return
+        sw = self.switches[event.dpid]
+        now = time.time()
+        port_stats = dict((stats.port_no, stats) for stats in event.stats)
+        for server_ip in self.server_to_service:
+            if server_ip not in sw.arpTable or sw.arpTable[server_ip][1] not in port_stats:
+                continue
+            stats = port_stats[sw.arpTable[server_ip][1]]
+            if server_ip not in sw.port_samples:
+                sw.port_samples[server_ip] = deque(maxlen = STATS_WINDOW)
+            sw.port_samples[server_ip].append((now, stats.tx_bytes, stats.tx_packets))
+
+    # probe every server, the previous probe of a server should have been answered by now
+    def run_health_checks(self):
+        for (server_ip, health) in self.server_health.items():
+            if health.awaiting:
+                health.misses += 1
+                health.successes = 0
+                if health.alive and health.misses >= self.health_check_fall:
+                    self.mark_server_down(server_ip)
+            # a miss is only counted for a probe that was actually sent (e.g. not while no switch is connected)
+            health.awaiting = self.send_health_probe(server_ip)
+
+    # send an ARP request to a server, straight to its port if it is known or flooded otherwise
+    # returns whether any probe was sent
+    def send_health_probe(self, server_ip):
+        service = self.server_to_service[server_ip]
+        located = False
+        for sw in self.switches.values():
+            if server_ip in sw.arpTable:
+                self.send_proxied_arp_request(service, sw.connection, server_ip, sw.arpTable[server_ip])
+                located = True
+        if not located:
+            for sw in self.switches.values():
+                self.send_proxied_arp_request(service, sw.connection, server_ip)
+        return len(self.switches) > 0
+
+    # a server answered a probe
+    def handle_health_reply(self, server_ip):
+        health = self.server_health[server_ip]
+        health.awaiting = False
+        health.misses = 0
+        health.successes += 1
+        if not health.alive and health.successes >= self.health_check_rise:
+            self.mark_server_up(server_ip)
+
+    # take a failed server out of its group and move only its flows to live replicas
+    def mark_server_down(self, server_ip):
+        service = self.server_to_service[server_ip]
+        self.server_health[server_ip].alive = False
+        log.info(colors.red + "Server " + self.ip_wcolor(server_ip) + colors.red + " is down, failing over its flows" + colors.reset)
+
+        old_owners = service.prefix_owners()
+        service.down_servers.add(server_ip)
+        service.build_maglev_tables()
+        service.update_proactive_plan()
+
+        for sw in self.switches.values():
+            self.repin_proactive_prefixes(sw, service, old_owners)
+            for (key, flow_server_ip) in list(sw.flows.items()):
+                if key[0] != service.service_ip or flow_server_ip != server_ip:
+                    continue
+                self.delete_flow_rule_client_to_server(sw, service, key[1], key)
+                sw.affinity.pop(key, None) #the connection cannot stay on a dead server
+                new_server_ip = self.choose_server(sw, service, key)
+                if new_server_ip is not None and new_server_ip in sw.arpTable:
+                    self.install_flow_rule_client_to_server(sw, service, sw.arpTable[new_server_ip][1], key[1], new_server_ip, key = key)
+
+    # bring a recovered server back in its group, the existing flows stay where they are
+    def mark_server_up(self, server_ip):
+        service = self.server_to_service[server_ip]
+        self.server_health[server_ip].alive = True
+        log.info(colors.green + "Server " + self.ip_wcolor(server_ip) + colors.green + " is up again" + colors.reset)
+
+        old_owners = service.prefix_owners()
+        service.down_servers.discard(server_ip)
+        service.build_maglev_tables()
+        service.update_proactive_plan()
+
+        for sw in self.switches.values():
+            self.repin_proactive_prefixes(sw, service, old_owners)
+
+    # reinstall (or remove) the proactive rules whose pinned server changed
+    def repin_proactive_prefixes(self, sw, service, old_owners):
+        new_owners = service.prefix_owners()
+        for prefix in set(old_owners.keys()) | set(new_owners.keys()):
+            if old_owners.get(prefix) == new_owners.get(prefix):
+                continue
+            if new_owners.get(prefix) in sw.arpTable:
+                self.install_proactive_flow_rule(sw, service, prefix, new_owners[prefix]) #replaces the rule with the same match and priority
+            else:
+                self.delete_proactive_flow_rule(sw, service, prefix)
+
+    # pick a replica of the group based on the servers' load on a switch
+    def choose_loaded_server(self, sw, service, group):
+        servers = sorted(service.live_servers(group), key = lambda ip: ip.toUnsigned())
+        if len(servers) == 0:
+            return None
+        if self.lb_policy == "least_loaded":
+            return min(servers, key = sw.server_load)
+
+        #weighted: a server is chosen with probability inversely proportional to its byte rate
+        weights = [1.0 / (1.0 + sw.server_rate(ip)[0]) for ip in servers]
+        point = random.uniform(0, sum(weights))
+        for (ip, weight) in zip(servers, weights):
+            point -= weight
+            if point <= 0:
+                return ip
+        return servers[-1]
+
+    # update the load balancing choice for a certain client of a service (or one of its connections, given its flow key)
+    def update_lb_mapping(self, sw, service, client_ip, key = None):
+        group = service.user_ip_to_group[client_ip]
+        if group not in service.group_servers: #imposible case
+            print(colors.red + "The impossible has happend in update_lb_mapping!" + colors.reset)
+            return None
+
+        if key is None:
+            key = (service.service_ip, client_ip)
+        if self.lb_policy == "maglev":
+            #connections of the same client are hashed independently
+            server_ip = service.maglev_tables[group].lookup(client_ip if len(key) == 2 else key[1:])
+        elif self.lb_policy == "random":
+            servers = service.live_servers(group)
+            server_ip = random.choice(servers) if len(servers) > 0 else None # flip a coin for the choise
+        else:
+            server_ip = self.choose_loaded_server(sw, service, group)
+            #account for the new flow until the next statistics reply arrives
+            if server_ip is not None:
+                sw.server_flows[server_ip] = sw.server_flows.get(server_ip, 0) + 1
+        if len(key) == 2: #the choice of a connection is kept by the (aging) affinity table only
+            sw.lb_choise[key] = server_ip
+        return server_ip
     
-    # send ARP reply "proxied" by the controller (on behalf of another machine in network)
-    def send_proxied_arp_reply(self, packet, connection, outport, requested_mac):
+    # the server of a flow key, a known connection keeps its (live) server for its whole lifetime
+    def choose_server(self, sw, service, key):
+        if len(key) == 2:
+            return self.update_lb_mapping(sw, service, key[1])
+
+        entry = sw.affinity.get(key)
+        if entry is not None and entry[0] not in service.down_servers:
+            entry[1] = time.time()
+            return entry[0]
+
+        server_ip = self.update_lb_mapping(sw, service, key[1], key)
+        if server_ip is not None:
+            sw.affinity[key] = [server_ip, time.time()]
+        return server_ip
+
+    # build the packed ARP reply "proxied" by the controller for an ARP request
+    def build_proxied_arp_reply(self, service, packet, requested_mac):
         #craft arp reply
         r = arp()
         r.opcode    = r.REPLY
@@ -172,27 +773,47 @@ class SimpleLoadBalancer(object):
         r.hwdst     = packet.src
         r.protodst  = packet.payload.protosrc
 
-        if(packet.payload.protosrc in self.server_ip_to_group): #if a server is the source
+        if(packet.payload.protosrc in service.server_ip_to_group): #if a server is the source
             r.protosrc = packet.payload.protodst #set the source ip to the destination ip of the request
-        elif(packet.payload.protosrc in self.user_ip_to_group): #if a host is the source
-            r.protosrc = self.service_ip #set the source ip to the service ip (a host could only ARP for the service ip)
+        elif(packet.payload.protosrc in service.user_ip_to_group): #if a host is the source
+            r.protosrc = service.service_ip #set the source ip to the service ip (a host could only ARP for the service ip)
 
         #craft ethernet packet
-        e = ethernet(type=ethernet.ARP_TYPE, src=self.lb_mac, dst=packet.payload.hwsrc)
+        e = ethernet(type=ethernet.ARP_TYPE, src=service.lb_mac, dst=packet.payload.hwsrc)
         e.set_payload(r)
+        return e.pack()
 
-        #send packet
-        msg         = of.ofp_packet_out()
-        msg.data    = e.pack()
-        msg.in_port = outport
-        msg.actions.append(of.ofp_action_output(port=outport))
-        connection.send(msg)
+    # send ARP reply "proxied" by the controller (on behalf of another machine in network)
+    @timed("send_proxied_arp_reply")
+    def send_proxied_arp_reply(self, service, packet, connection, outport, requested_mac):
+        #the same requester asking for the same address on the same port gets the same packet-out, so it is built and packed only once
+        frame_key = (service.service_ip, packet.src, packet.payload.hwsrc, packet.payload.protosrc, packet.payload.protodst, requested_mac, outport)
+        packed_msg = self.arp_reply_frames.get(frame_key)
+        if packed_msg is None:
+            self.metrics.inc("lb_arp_reply_frames_total", (("result", "miss"),))
+
+            #send packet
+            msg         = of.ofp_packet_out()
+            msg.data    = self.build_proxied_arp_reply(service, packet, requested_mac)
+            msg.in_port = outport
+            msg.actions.append(of.ofp_action_output(port=outport))
+            packed_msg = msg.pack()
+
+            self.arp_reply_frames[frame_key] = packed_msg
+            if len(self.arp_reply_frames) > ARP_REPLY_CACHE_SIZE:
+                self.arp_reply_frames.popitem(last = False)
+        else:
+            self.metrics.inc("lb_arp_reply_frames_total", (("result", "hit"),))
+        connection.send(packed_msg)
+        self.metrics.inc("lb_arp_replies_total")
         
-        log.info(colors.yellow + "Sent ARP reply to " + self.ip_wcolor(packet.payload.protosrc) + colors.yellow + " from " + self.mac_wcolor(requested_mac) + colors.reset)
+        if log.isEnabledFor(logging.INFO):
+            log.info(colors.yellow + "Sent ARP reply to " + self.ip_wcolor(packet.payload.protosrc) + colors.yellow + " from " + self.mac_wcolor(requested_mac) + colors.reset)
         pass
 
     # send ARP request "proxied" by the controller (so that the controller learns about another machine in network)
-    def send_proxied_arp_request(self, connection, ip):
+    # with a known (mac, port) ARP entry the request is sent straight to the machine instead of being flooded
+    def send_proxied_arp_request(self, service, connection, ip, arp_entry = None):
         #craft arp request
         r = arp()
         r.hwtype    = r.HW_TYPE_ETHERNET
@@ -200,115 +821,246 @@ class SimpleLoadBalancer(object):
         r.hwlen     = 6
         r.protolen  = r.protolen
         r.opcode    = r.REQUEST
-        r.hwsrc     = self.lb_mac 
-        r.protosrc  = self.service_ip
-        r.hwdst     = ETHER_BROADCAST
+        r.hwsrc     = service.lb_mac 
+        r.protosrc  = service.service_ip
+        r.hwdst     = ETHER_BROADCAST if arp_entry is None else arp_entry[0]
         r.protodst  = ip
 
         #craft ethernet packet
-        e = ethernet(type=ethernet.ARP_TYPE, src=self.lb_mac, dst=ETHER_BROADCAST)
+        e = ethernet(type=ethernet.ARP_TYPE, src=service.lb_mac, dst=r.hwdst)
         e.set_payload(r)
 
         #send packet
         msg         = of.ofp_packet_out()
         msg.data    = e.pack()
         msg.in_port = of.OFPP_NONE
-        msg.actions.append(of.ofp_action_output(port=of.OFPP_FLOOD))
+        msg.actions.append(of.ofp_action_output(port=of.OFPP_FLOOD if arp_entry is None else arp_entry[1]))
         connection.send(msg)
         
-        log.info(colors.yellow + "Sent ARP request to " + self.ip_wcolor(ip) + colors.reset)
+        if arp_entry is None:
+            if log.isEnabledFor(logging.INFO):
+                log.info(colors.yellow + "Sent ARP request to " + self.ip_wcolor(ip) + colors.reset)
+        elif log.isEnabledFor(logging.DEBUG):
+            log.debug(colors.yellow + "Sent ARP probe to " + self.ip_wcolor(ip) + colors.reset)
         pass  
     
-    # install flow rule from a certain client to a certain server
-    def install_flow_rule_client_to_server(self, connection, outport, client_ip, server_ip, buffer_id=of.NO_BUFFER):
-        #update the load balancing choice for the client
-        self.update_lb_mapping(client_ip)
-
+    # install flow rule from a certain client (or one of its connections, given its flow key) to a certain server of a service
+    @timed("install_flow_rule_client_to_server")
+    def install_flow_rule_client_to_server(self, sw, service, outport, client_ip, server_ip, buffer_id=of.NO_BUFFER, key=None):
         #helping variables
-        chosen_server_ip = self.lb_choise[client_ip]
-        chosen_server_mac = self.arpTable[chosen_server_ip][0]
-        chosen_server_port = self.arpTable[chosen_server_ip][1]
+        chosen_server_ip = server_ip
+        chosen_server_mac = sw.arpTable[chosen_server_ip][0]
+        chosen_server_port = outport
 
         msg = of.ofp_flow_mod()
         msg.idle_timeout=FLOW_IDLE_TIMEOUT
+        msg.flags = of.OFPFF_SEND_FLOW_REM #to forget the flow when it expires
 
-        #match only ICMP packets         
-        msg.match.dl_type = 0x0800 #IP
-        msg.match.nw_proto = 1 #ICMP
-        
-        msg.match.nw_dst = self.service_ip  #match destination ip of service
-        msg.match.nw_src = client_ip        #and source ip from the arguements 
+        if key is None:
+            key = (service.service_ip, client_ip)
+        self.set_client_flow_match(msg.match, key)
 
         msg.buffer_id = buffer_id #add the buffered packet's id
 
         msg.actions.append(of.ofp_action_nw_addr.set_dst(chosen_server_ip)) #replace destination ip as the chosen server ip
         msg.actions.append(of.ofp_action_dl_addr.set_dst(chosen_server_mac))#mac address of the chosen server
         msg.actions.append(of.ofp_action_output(port = chosen_server_port)) #and send it to the chosen server's port
-        connection.send(msg)
+        sw.connection.send(msg)
+        sw.flows[key] = chosen_server_ip
+        self.metrics.inc("lb_flow_mods_total", (("kind", "client_to_server"),))
         
-        log.info("")
-        log.info(colors.green + "Installed flow for route %s -> %s" %( self.ip_wcolor(client_ip), self.ip_wcolor(chosen_server_ip))  )
+        if log.isEnabledFor(logging.INFO):
+            log.info("")
+            log.info(colors.green + "Installed flow for route %s -> %s" %( self.ip_wcolor(client_ip), self.ip_wcolor(chosen_server_ip))  )
         pass
 
-    # install flow rule from a certain server to a certain client
-    def install_flow_rule_server_to_client(self, connection, outport, server_ip, client_ip, buffer_id=of.NO_BUFFER):
+    # match of a client -> service flow key
+    def set_client_flow_match(self, match, key):
+        match.dl_type = 0x0800 #IP
+        match.nw_dst = key[0]  #match destination ip of service
+        match.nw_src = key[1]  #and source ip of the client
+        if len(key) == 2:
+            match.nw_proto = 1 #only ICMP packets
+        else:
+            match.nw_proto = key[2] #TCP/UDP connection
+            match.tp_src = key[3]
+            match.tp_dst = key[4]
+
+    # delete the flow rule from a certain client (or connection) to the service (e.g. when its server failed)
+    def delete_flow_rule_client_to_server(self, sw, service, client_ip, key=None):
+        if key is None:
+            key = (service.service_ip, client_ip)
         msg = of.ofp_flow_mod()
-        
+        msg.command = of.OFPFC_DELETE_STRICT
+        self.set_client_flow_match(msg.match, key)
+        sw.connection.send(msg)
+        sw.flows.pop(key, None)
+        self.metrics.inc("lb_flow_mods_total", (("kind", "delete"),))
+
+        if log.isEnabledFor(logging.INFO):
+            log.info(colors.red + "Deleted flow for route %s -> %s" % (self.ip_wcolor(client_ip), self.ip_wcolor(service.service_ip)))
+        pass
+
+    # install the proactive wildcard rules of a server (client prefixes -> server)
+    def install_proactive_flow_rules(self, sw, service, server_ip):
+        for prefix in service.proactive_plan.get(server_ip, []):
+            self.install_proactive_flow_rule(sw, service, prefix, server_ip)
+        pass
+
+    # install the proactive wildcard rule of a single prefix (client prefix -> server)
+    @timed("install_proactive_flow_rule")
+    def install_proactive_flow_rule(self, sw, service, prefix, server_ip):
+        server_mac = sw.arpTable[server_ip][0]
+        server_port = sw.arpTable[server_ip][1]
+
+        msg = of.ofp_flow_mod()
+        msg.priority = PROACTIVE_PRIORITY #no timeouts, the rule stays until the switch disconnects
+
         #match only ICMP packets
         msg.match.dl_type = 0x0800 #IP
         msg.match.nw_proto = 1 #ICMP
 
-        # match destination ip with the given client's ip
+        msg.match.nw_dst = service.service_ip  #match destination ip of service
+        msg.match.nw_src = prefix              #and any source ip inside the prefix
+
+        msg.actions.append(of.ofp_action_nw_addr.set_dst(server_ip))  #replace destination ip as the pinned server ip
+        msg.actions.append(of.ofp_action_dl_addr.set_dst(server_mac)) #mac address of the pinned server
+        msg.actions.append(of.ofp_action_output(port = server_port))  #and send it to the pinned server's port
+        sw.connection.send(msg)
+        self.metrics.inc("lb_flow_mods_total", (("kind", "proactive"),))
+
+        if log.isEnabledFor(logging.INFO):
+            log.info(colors.green + "Installed proactive flow for route %s/%d -> %s" % (self.ip_wcolor(prefix[0]), prefix[1], self.ip_wcolor(server_ip)))
+        pass
+
+    # delete the proactive wildcard rule of a prefix (its group has no live server)
+    def delete_proactive_flow_rule(self, sw, service, prefix):
+        msg = of.ofp_flow_mod()
+        msg.command = of.OFPFC_DELETE_STRICT
+        msg.priority = PROACTIVE_PRIORITY
+        msg.match.dl_type = 0x0800 #IP
+        msg.match.nw_proto = 1 #ICMP
+        msg.match.nw_dst = service.service_ip
+        msg.match.nw_src = prefix
+        sw.connection.send(msg)
+        self.metrics.inc("lb_flow_mods_total", (("kind", "delete"),))
+
+        if log.isEnabledFor(logging.INFO):
+            log.info(colors.red + "Deleted proactive flow for route %s/%d" % (self.ip_wcolor(prefix[0]), prefix[1]))
+        pass
+
+    # install flow rule from a certain server of a service to a certain client (any protocol)
+    @timed("install_flow_rule_server_to_client")
+    def install_flow_rule_server_to_client(self, sw, service, outport, server_ip, client_ip, buffer_id=of.NO_BUFFER):
+        msg = of.ofp_flow_mod()
+        
+        #match all IP packets, the same rewrite serves ICMP and every TCP/UDP connection between the two
+        msg.match.dl_type = 0x0800 #IP
+
+        # match source ip with the server's ip (a client may use many services) and destination ip with the given client's ip
+        msg.match.nw_src = server_ip
         msg.match.nw_dst = client_ip
 
         msg.buffer_id = buffer_id #add the buffered packet's id
 
-        msg.actions.append(of.ofp_action_nw_addr.set_src(self.service_ip))  #replace source ip as the service ip
-        msg.actions.append(of.ofp_action_dl_addr.set_src(self.lb_mac))      #mac address of the load balancer
-        msg.actions.append(of.ofp_action_dl_addr.set_dst(self.arpTable[client_ip][0])) #and destination mac as the client's mac
+        msg.actions.append(of.ofp_action_nw_addr.set_src(service.service_ip))  #replace source ip as the service ip
+        msg.actions.append(of.ofp_action_dl_addr.set_src(service.lb_mac))      #mac address of the load balancer
+        msg.actions.append(of.ofp_action_dl_addr.set_dst(sw.arpTable[client_ip][0])) #and destination mac as the client's mac
         msg.actions.append(of.ofp_action_output(port = outport))        #and send it to the given port
-        connection.send(msg)
+        sw.connection.send(msg)
+        self.metrics.inc("lb_flow_mods_total", (("kind", "server_to_client"),))
         
-        log.info("")
-        log.info(colors.green + "Installed flow for route %s -> %s" %(self.ip_wcolor(server_ip), self.ip_wcolor(client_ip))  )
+        if log.isEnabledFor(logging.INFO):
+            log.info("")
+            log.info(colors.green + "Installed flow for route %s -> %s" %(self.ip_wcolor(server_ip), self.ip_wcolor(client_ip))  )
         
         pass
 
     # main packet-in handling routine
+    @timed("packet_in")
     def _handle_PacketIn(self, event):
         packet = event.parsed
-        connection = event.connection
         inport = event.port
+        if event.dpid not in self.switches:
+            return
+        sw = self.switches[event.dpid]
+        self.metrics.inc("lb_packet_in_total", (("type", "arp" if packet.type == packet.ARP_TYPE else "ip" if packet.type == packet.IP_TYPE else "other"),))
 
         if packet.type == packet.ARP_TYPE: #if the packet is an ARP packet
             if packet.payload.opcode == arp.REQUEST: #if the packet is an ARP request
 
-                if (packet.payload.protodst == self.service_ip) or (packet.payload.protodst in self.user_ip_to_group): #if the request is for the service ip or for a client
+                if packet.payload.protodst in self.services: #if the request is for a service ip
+                    service = self.services[packet.payload.protodst]
+                elif packet.payload.protosrc in self.server_to_service: #if a server requests a client of its service
+                    service = self.server_to_service[packet.payload.protosrc]
+                    if packet.payload.protodst not in service.user_ip_to_group:
+                        return
+                else:
+                    return
+
+                if log.isEnabledFor(logging.INFO):
                     log.info("")
                     log.info(colors.yellow + "Received ARP request for " + self.ip_wcolor(packet.payload.protodst) + colors.yellow + " from " + self.ip_wcolor(packet.payload.protosrc))
-                    #send ARP reply to the client as the service
-                    self.send_proxied_arp_reply(packet, connection, inport, self.lb_mac)
+                #send ARP reply to the client as the service
+                self.send_proxied_arp_reply(service, packet, sw.connection, inport, service.lb_mac)
 
             elif packet.payload.opcode == arp.REPLY: #if the packet is an ARP reply
-                log.info(colors.yellow + "Received ARP reply for "+ colors.green +"service IP"+colors.yellow+" from " + self.ip_wcolor(packet.payload.protosrc) + colors.reset)
-                if packet.payload.hwdst == self.lb_mac: #if the reply is for the load balancer
-                    self.update_ARP_table(packet.payload.protosrc, packet.payload.hwsrc, inport) #update the ARP table
-                    self.print_arp_table()
+                if log.isEnabledFor(logging.INFO):
+                    log.info(colors.yellow + "Received ARP reply for "+ colors.green +"service IP"+colors.yellow+" from " + self.ip_wcolor(packet.payload.protosrc) + colors.reset)
+                if packet.payload.hwdst in self.lb_macs: #if the reply is for the load balancer
+                    changed = self.update_ARP_table(sw, packet.payload.protosrc, packet.payload.hwsrc, inport) #update the ARP table
+                    if changed:
+                        self.print_arp_table(sw)
+
+                    #the reply of a server also answers its health probe
+                    if packet.payload.protosrc in self.server_health:
+                        self.handle_health_reply(packet.payload.protosrc)
+
+                    #in proactive mode install the rules as soon as the endpoints are resolved (or moved),
+                    #refreshes and probe replies leave the installed rules (and their counters) alone
+                    if self.proactive:
+                        if changed and packet.payload.protosrc in self.server_to_service:
+                            self.install_proactive_flow_rules(sw, self.server_to_service[packet.payload.protosrc], packet.payload.protosrc)
+                        for service in self.client_services(packet.payload.protosrc):
+                            server_ip = service.pinned_server(packet.payload.protosrc)
+                            key = (service.service_ip, packet.payload.protosrc)
+                            if server_ip is not None and (changed or sw.proactive_replies.get(key) != server_ip):
+                                self.install_flow_rule_server_to_client(sw, service, inport, server_ip, packet.payload.protosrc)
+                                sw.proactive_replies[key] = server_ip
             pass
 
         elif packet.type == packet.IP_TYPE: #if the packet is an IP packet
 
-            if (packet.next.srcip in self.user_ip_to_group): #if the packet is from a client
-                destination_from_arp = self.arpTable[self.lb_choise[packet.next.srcip]] #get the destination from the load balancing choice
+            if (packet.next.dstip in self.services) and (packet.next.srcip in self.services[packet.next.dstip].user_ip_to_group): #if the packet is from a client to a service
+                service = self.services[packet.next.dstip]
+                if packet.next.protocol in BALANCED_PROTOCOLS: #TCP/UDP are balanced per connection
+                    key = (service.service_ip, packet.next.srcip, packet.next.protocol, packet.next.next.srcport, packet.next.next.dstport)
+                else: #and anything else per client
+                    key = (service.service_ip, packet.next.srcip)
+                server_ip = self.choose_server(sw, service, key) #update the load balancing choice for the client/connection
+                if server_ip is None: #no live server for the client's group
+                    return
+                if server_ip not in sw.arpTable: #the chosen server is not known yet (or its entry expired), ask for it
+                    self.metrics.inc("lb_arp_lookups_total", (("result", "miss"),))
+                    self.send_proxied_arp_request(service, sw.connection, server_ip)
+                    return
+                self.metrics.inc("lb_arp_lookups_total", (("result", "hit"),))
+                destination_from_arp = sw.arpTable[server_ip] #get the destination from the load balancing choice
 
                 # and install a flow rule from the client to a server
-                self.install_flow_rule_client_to_server(connection, destination_from_arp[1], packet.next.srcip, self.lb_choise[packet.next.srcip],event.ofp.buffer_id)
+                self.install_flow_rule_client_to_server(sw, service, destination_from_arp[1], packet.next.srcip, server_ip, event.ofp.buffer_id, key)
 
-            elif (packet.next.srcip in self.server_ip_to_group): #if the packet is from a server
-                destination_from_arp = self.arpTable[packet.next.dstip] #get the destination from the ARP table
+            elif (packet.next.srcip in self.server_to_service) and (packet.next.dstip in self.server_to_service[packet.next.srcip].user_ip_to_group): #if the packet is from a server to a client
+                service = self.server_to_service[packet.next.srcip]
+                if packet.next.dstip not in sw.arpTable: #the client is not known yet (or its entry expired), ask for it
+                    self.metrics.inc("lb_arp_lookups_total", (("result", "miss"),))
+                    self.send_proxied_arp_request(service, sw.connection, packet.next.dstip)
+                    return
+                self.metrics.inc("lb_arp_lookups_total", (("result", "hit"),))
+                destination_from_arp = sw.arpTable[packet.next.dstip] #get the destination from the ARP table
 
-                #and install a flow rule from any server to the client
-                self.install_flow_rule_server_to_client(connection, destination_from_arp[1], packet.next.srcip, packet.next.dstip, event.ofp.buffer_id)
+                #and install a flow rule from the server to the client
+                self.install_flow_rule_server_to_client(sw, service, destination_from_arp[1], packet.next.srcip, packet.next.dstip, event.ofp.buffer_id)
             pass
         return
 
@@ -319,32 +1071,124 @@ def load_json_dict(json_file):
         json_dict = json.load(f)
     return json_dict
 
-# main launch routine
-def launch(configuration_json_file):
-    log.info("Loading Simple Load Balancer module")
-    
-    # load the configuration from file    
-    configuration_dict = load_json_dict(configuration_json_file)   
+# check if an (unsigned) address falls inside the prefix network/length
+def in_prefix(addr, network, length):
+    return (addr >> (32 - length)) == (network >> (32 - length))
+
+# split the client address space into wildcard prefixes and pin each one to a replica of its group
+# returns a dict with key = server ip, value = list of (ip, prefix length)
+def plan_proactive_prefixes(user_ip_to_group, server_ip_to_group, reserved_ips = []):
+    #owner of every known address (None for addresses that must never be covered, e.g. the servers)
+    owners = {}
+    for ip in list(server_ip_to_group.keys()) + list(reserved_ips):
+        owners[ip.toUnsigned()] = None
+    for (ip, group) in user_ip_to_group.items():
+        owners[ip.toUnsigned()] = group
+
+    clients = [ip.toUnsigned() for ip in user_ip_to_group]
+    if len(clients) == 0:
+        return {}
+
+    #start from the smallest prefix covering all the clients
+    length = 32
+    while not in_prefix(min(clients), max(clients), length):
+        length -= 1
+    network = (min(clients) >> (32 - length)) << (32 - length)
+
+    #recursively split until every prefix holds clients of a single group and nothing else
+    group_prefixes = {} #key = group, value = list of (network, length, number of clients)
+    def split(network, length, addrs):
+        if len(addrs) == 0:
+            return
+        groups = set(owners[addr] for addr in addrs)
+        if len(groups) == 1 and None not in groups:
+            group_prefixes.setdefault(groups.pop(), []).append((network, length, len(addrs)))
+            return
+        if length == 32: #a reserved address
+            return
+        half = network | (1 << (31 - length))
+        split(network, length + 1, [addr for addr in addrs if not in_prefix(addr, half, length + 1)])
+        split(half, length + 1, [addr for addr in addrs if in_prefix(addr, half, length + 1)])
+
+    split(network, length, [addr for addr in owners if in_prefix(addr, network, length)])
+
+    plan = {}
+    for (group, prefixes) in group_prefixes.items():
+        servers = sorted([ip for ip in server_ip_to_group if server_ip_to_group[ip] == group], key = lambda ip: ip.toUnsigned())
+        if len(servers) == 0:
+            continue
+
+        #keep splitting the most populated prefix so that every replica gets at least one
+        while len(prefixes) < len(servers):
+            prefixes.sort(key = lambda prefix: prefix[2])
+            (network, length, count) = prefixes[-1]
+            if count < 2:
+                break
+            prefixes.pop()
+            for sub_network in (network, network | (1 << (31 - length))):
+                sub_count = len([addr for addr in owners if owners[addr] == group and in_prefix(addr, sub_network, length + 1)])
+                if sub_count > 0:
+                    prefixes.append((sub_network, length + 1, sub_count))
+
+        #pin the prefixes to the replicas in a round robin fashion
+        prefixes.sort()
+        for (i, (network, length, count)) in enumerate(prefixes):
+            plan.setdefault(servers[i % len(servers)], []).append((IPAddr(network), length))
+    return plan
+
+# build a service (VIP) from its configuration, missing keys fall back to the defaults (the top level configuration)
+def load_service(service_dict, defaults = {}):
+    def get(key):
+        return service_dict[key] if key in service_dict else defaults[key]
 
     # the service IP that is publicly visible from the users' side   
-    service_ip = IPAddr(configuration_dict['service_ip'])
+    service_ip = IPAddr(get('service_ip'))
 
     # the load balancer MAC with which the switch responds to ARP requests from users/servers
-    lb_mac = EthAddr(configuration_dict['lb_mac'])
+    lb_mac = EthAddr(get('lb_mac'))
 
     # the IPs of the servers
-    server_ips = [IPAddr(x) for x in configuration_dict['server_ips']]    
+    server_ips = [IPAddr(x) for x in get('server_ips')]    
 
     # map users (IPs) to service groups (e.g., 10.0.0.5 to 'red')    
     user_ip_to_group = {}
-    for user_ip,group in configuration_dict['user_groups'].items():
+    for user_ip,group in get('user_groups').items():
         user_ip_to_group[IPAddr(user_ip)] = group
 
     # map servers (IPs) to service groups (e.g., 10.0.0.1 to 'blue')
     server_ip_to_group = {}
-    for server_ip,group in configuration_dict['server_groups'].items():
+    for server_ip,group in get('server_groups').items():
         server_ip_to_group[IPAddr(server_ip)] = group
 
+    return LoadBalancedService(lb_mac, service_ip, server_ips, user_ip_to_group, server_ip_to_group)
+
+# main launch routine
+def launch(configuration_json_file):
+    log.info("Loading Simple Load Balancer module")
+    
+    # load the configuration from file    
+    configuration_dict = load_json_dict(configuration_json_file)   
+
+    # the VIP table, either a list of services or a single service described at the top level
+    if 'services' in configuration_dict:
+        services = [load_service(service_dict, configuration_dict) for service_dict in configuration_dict['services']]
+    else:
+        services = [load_service(configuration_dict)]
+
+    # install wildcard client prefixes proactively instead of one rule per client (optional)
+    proactive = configuration_dict.get('proactive', False)
+
+    # how a server is chosen for a new client: "maglev", "random", "least_loaded" or "weighted" (optional)
+    lb_policy = configuration_dict.get('lb_policy', "maglev")
+
+    # probe the servers every health_check_interval seconds, 0 disables the health checks (optional)
+    health_check_interval = float(configuration_dict.get('health_check_interval', 0))
+    health_check_fall = int(configuration_dict.get('health_check_fall', 3))
+    health_check_rise = int(configuration_dict.get('health_check_rise', 2))
+
+    # export the metrics in the Prometheus text format on http://127.0.0.1:<metrics_port>/metrics, 0 disables it (optional)
+    metrics_port = int(configuration_dict.get('metrics_port', 0))
+
     # do the launch with the given parameters
-    core.registerNew(SimpleLoadBalancer, lb_mac, service_ip, server_ips, user_ip_to_group, server_ip_to_group)
+    core.registerNew(SimpleLoadBalancer, services, proactive, lb_policy, health_check_interval, health_check_fall, health_check_rise, metrics_port)
     log.info("Simple Load Balancer module loaded")
@@ -0,0 +1,260 @@
+#!/usr/bin/python3
+
+# Offline benchmark of the SimpleLoadBalancer handlers (no Mininet, no root)
+#
+# The load balancer is driven with a stub core.openflow and a fake switch connection that records
+# every message the handlers send. Synthetic ARP/ICMP/TCP packet-ins are fed at a given rate and the
+# packet-in throughput, the per-event latency percentiles and the flow mods emitted are reported.
+#
+# POX itself is only needed as a library (its packet and OpenFlow classes), e.g.:
+#   python3 bench_SimpleLoadBalancer.py --pox-dir ~/pox --events 50000 --clients 2000
+
+import argparse
+import json
+import logging
+import os
+import random
+import struct
+import sys
+import time
+
+# the packet-in mix used when none is given (kind=weight)
+DEFAULT_MIX = "arp=0.2,icmp=0.3,tcp=0.4,reply=0.1"
+
+# a stub of the openflow component, the balancer only registers its listeners on it
+class FakeOpenFlow(object):
+    def addListeners(self, listener, *args, **kw):
+        pass
+
+# a fake switch connection recording the messages sent by the handlers
+class FakeConnection(object):
+    def __init__(self, dpid, of, pack = True):
+        self.dpid = dpid
+        self.of = of
+        self.pack = pack
+        self.sent = {} #key = OpenFlow message type, value = number of messages
+
+    def __str__(self):
+        return "[fake %s]" % (self.dpid)
+
+    def send(self, data):
+        if isinstance(data, (bytes, bytearray)):
+            msg_type = bytearray(data[:2])[1]
+        else:
+            msg_type = data.header_type
+            if self.pack: #a real connection packs every message
+                data.pack()
+        self.sent[msg_type] = self.sent.get(msg_type, 0) + 1
+
+    def count(self, msg_type):
+        return self.sent.get(msg_type, 0)
+
+# the packet-in message of an event (only its buffer id is used)
+class FakePacketIn(object):
+    def __init__(self, buffer_id):
+        self.buffer_id = buffer_id
+
+# a ConnectionUp/PacketIn event
+class FakeEvent(object):
+    def __init__(self, connection, parsed = None, port = None, buffer_id = None):
+        self.connection = connection
+        self.dpid = connection.dpid
+        self.parsed = parsed
+        self.port = port
+        self.ofp = FakePacketIn(buffer_id)
+
+# percentile of an already sorted list
+def percentile(sorted_values, fraction):
+    if len(sorted_values) == 0:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+# a locally administered MAC derived from an ip
+def host_mac(EthAddr, ip):
+    return EthAddr(b"\x02\x00" + struct.pack("!I", ip.toUnsigned()))
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(","):
+        (kind, weight) = item.split("=")
+        weights[kind.strip()] = float(weight)
+    return weights
+
+def main():
+    parser = argparse.ArgumentParser(description = "Offline benchmark of the SimpleLoadBalancer packet-in handlers")
+    parser.add_argument("--pox-dir", default = os.path.expanduser("~/pox"), help = "directory of the POX checkout (default: ~/pox)")
+    parser.add_argument("--config", default = os.path.join(os.path.dirname(os.path.abspath(__file__)), "SimpleLoadBalancer_conf.json"), help = "load balancer configuration file")
+    parser.add_argument("--events", type = int, default = 20000, help = "number of packet-in events to feed")
+    parser.add_argument("--rate", type = float, default = 0, help = "packet-ins per second to feed, 0 feeds them as fast as possible")
+    parser.add_argument("--clients", type = int, default = 0, help = "extra synthetic clients added to the groups of every service")
+    parser.add_argument("--mix", default = DEFAULT_MIX, help = "packet-in mix as kind=weight pairs, kinds: arp, icmp, tcp, reply (default: %s)" % (DEFAULT_MIX))
+    parser.add_argument("--proactive", action = "store_true", help = "enable the proactive mode regardless of the configuration")
+    parser.add_argument("--lb-policy", default = None, help = "override the lb_policy of the configuration")
+    parser.add_argument("--no-pack", action = "store_true", help = "do not pack the messages sent to the fake connection")
+    parser.add_argument("--seed", type = int, default = 1, help = "random seed of the synthetic traffic")
+    parser.add_argument("--json", action = "store_true", help = "print the results as JSON")
+    parser.add_argument("--verbose", action = "store_true", help = "keep the load balancer's info messages")
+    args = parser.parse_args()
+
+    #POX is used as a library, with a core that is initialized but never brought up
+    sys.path.insert(0, args.pox_dir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    logging.basicConfig(level = logging.INFO if args.verbose else logging.WARNING)
+    import pox.core
+    pox.core.initialize()
+    from pox.core import core
+    core.register("openflow", FakeOpenFlow())
+
+    import pox.openflow.libopenflow_01 as of
+    from pox.lib.addresses import EthAddr, IPAddr
+    from pox.lib.packet.ethernet import ethernet, ETHER_BROADCAST
+    from pox.lib.packet.arp import arp
+    from pox.lib.packet.ipv4 import ipv4
+    from pox.lib.packet.icmp import icmp, echo, TYPE_ECHO_REQUEST, TYPE_ECHO_REPLY
+    from pox.lib.packet.tcp import tcp
+    import SimpleLoadBalancer as slb
+
+    #load the services as the launch routine does, plus the synthetic clients
+    configuration_dict = slb.load_json_dict(args.config)
+    if 'services' in configuration_dict:
+        services = [slb.load_service(service_dict, configuration_dict) for service_dict in configuration_dict['services']]
+    else:
+        services = [slb.load_service(configuration_dict)]
+    for (index, service) in enumerate(services):
+        groups = sorted(service.group_servers.keys())
+        for i in range(args.clients):
+            client_ip = IPAddr("172.%d.%d.%d" % (16 + index, (i + 1) // 250, (i + 1) % 250 + 1))
+            service.user_ip_to_group[client_ip] = groups[i % len(groups)]
+
+    proactive = args.proactive or configuration_dict.get('proactive', False)
+    lb_policy = args.lb_policy or configuration_dict.get('lb_policy', "maglev")
+    balancer = slb.SimpleLoadBalancer(services, proactive, lb_policy)
+
+    connection = FakeConnection(1, of, pack = not args.no_pack)
+    balancer._handle_ConnectionUp(FakeEvent(connection))
+
+    #every host sits on its own port of the switch
+    ports = {}
+    def port_of(ip):
+        if ip not in ports:
+            ports[ip] = len(ports) + 1
+        return ports[ip]
+
+    def arp_packet(opcode, src_mac, src_ip, dst_mac, dst_ip):
+        a = arp()
+        a.opcode = opcode
+        a.hwsrc = src_mac
+        a.hwdst = dst_mac
+        a.protosrc = src_ip
+        a.protodst = dst_ip
+        e = ethernet(type = ethernet.ARP_TYPE, src = src_mac, dst = ETHER_BROADCAST if opcode == arp.REQUEST else dst_mac)
+        e.set_payload(a)
+        return ethernet(e.pack()) #parsed from the wire, as the packets of real events
+
+    def ip_packet(src_mac, src_ip, dst_mac, dst_ip, payload):
+        ip = ipv4()
+        ip.protocol = ipv4.TCP_PROTOCOL if isinstance(payload, tcp) else ipv4.ICMP_PROTOCOL
+        ip.srcip = src_ip
+        ip.dstip = dst_ip
+        ip.set_payload(payload)
+        e = ethernet(type = ethernet.IP_TYPE, src = src_mac, dst = dst_mac)
+        e.set_payload(ip)
+        return ethernet(e.pack())
+
+    def icmp_payload(icmp_type):
+        i = icmp()
+        i.type = icmp_type
+        i.set_payload(echo())
+        return i
+
+    def tcp_payload(srcport, dstport):
+        t = tcp()
+        t.srcport = srcport
+        t.dstport = dstport
+        t.off = 5
+        t.win = 1024
+        t.SYN = True
+        return t
+
+    #warm up: every host answers the ARP requests of the load balancer
+    for service in services:
+        for ip in list(service.user_ip_to_group.keys()) + list(service.server_ip_to_group.keys()):
+            packet = arp_packet(arp.REPLY, host_mac(EthAddr, ip), ip, service.lb_mac, service.service_ip)
+            balancer._handle_PacketIn(FakeEvent(connection, packet, port_of(ip), of.NO_BUFFER))
+    warmup_flow_mods = connection.count(of.OFPT_FLOW_MOD)
+
+    #build the synthetic packet-ins before the clock starts
+    rng = random.Random(args.seed)
+    mix = parse_mix(args.mix)
+    kinds = sorted(mix.keys())
+    clients = [(service, ip) for service in services for ip in service.user_ip_to_group]
+    events = []
+    kind_counts = dict((kind, 0) for kind in kinds)
+    for i in range(args.events):
+        kind = rng.choices(kinds, weights = [mix[k] for k in kinds])[0]
+        (service, client_ip) = rng.choice(clients)
+        client_mac = host_mac(EthAddr, client_ip)
+        in_ip = client_ip #the host whose port the packet comes in from
+        if kind == "arp":
+            packet = arp_packet(arp.REQUEST, client_mac, client_ip, ETHER_BROADCAST, service.service_ip)
+        elif kind == "icmp":
+            packet = ip_packet(client_mac, client_ip, service.lb_mac, service.service_ip, icmp_payload(TYPE_ECHO_REQUEST))
+        elif kind == "tcp":
+            packet = ip_packet(client_mac, client_ip, service.lb_mac, service.service_ip, tcp_payload(rng.randint(1024, 65535), 80))
+        elif kind == "reply":
+            server_ip = rng.choice(service.group_servers[service.user_ip_to_group[client_ip]])
+            packet = ip_packet(host_mac(EthAddr, server_ip), server_ip, service.lb_mac, client_ip, icmp_payload(TYPE_ECHO_REPLY))
+            in_ip = server_ip
+        else:
+            parser.error("unknown packet-in kind: %s" % (kind))
+        kind_counts[kind] += 1
+        events.append(FakeEvent(connection, packet, port_of(in_ip), of.NO_BUFFER))
+
+    #feed the packet-ins and time every handler call
+    latencies = []
+    interval = 1.0 / args.rate if args.rate > 0 else 0
+    start = time.time()
+    for (i, event) in enumerate(events):
+        if interval > 0:
+            delay = start + i * interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        before = time.time()
+        balancer._handle_PacketIn(event)
+        latencies.append(time.time() - before)
+    elapsed = time.time() - start
+
+    busy = sum(latencies)
+    latencies.sort()
+    results = {
+        "events": len(events),
+        "mix": kind_counts,
+        "elapsed_seconds": elapsed,
+        "packet_ins_per_second": len(events) / elapsed if elapsed > 0 else 0.0,
+        "handler_packet_ins_per_second": len(events) / busy if busy > 0 else 0.0,
+        "latency_us": {
+            "p50": percentile(latencies, 0.50) * 1e6,
+            "p90": percentile(latencies, 0.90) * 1e6,
+            "p99": percentile(latencies, 0.99) * 1e6,
+            "max": latencies[-1] * 1e6 if latencies else 0.0,
+        },
+        "flow_mods": connection.count(of.OFPT_FLOW_MOD) - warmup_flow_mods,
+        "warmup_flow_mods": warmup_flow_mods,
+        "packet_outs": connection.count(of.OFPT_PACKET_OUT),
+    }
+
+    if args.json:
+        print(json.dumps(results, indent = 2, sort_keys = True))
+    else:
+        print("events               : %d (%s)" % (results["events"], ", ".join("%s=%d" % item for item in sorted(kind_counts.items()))))
+        print("elapsed              : %.3f s" % (results["elapsed_seconds"]))
+        print("packet-ins/s (fed)   : %.0f" % (results["packet_ins_per_second"]))
+        print("packet-ins/s (busy)  : %.0f" % (results["handler_packet_ins_per_second"]))
+        print("latency p50/p90/p99  : %.1f / %.1f / %.1f us (max %.1f us)" % (results["latency_us"]["p50"], results["latency_us"]["p90"], results["latency_us"]["p99"], results["latency_us"]["max"]))
+        print("flow mods emitted    : %d (+%d during warm up)" % (results["flow_mods"], results["warmup_flow_mods"]))
+        print("packet outs emitted  : %d" % (results["packet_outs"]))
+    sys.stdout.flush()
+    os._exit(0) #do not wait for the POX threads
+
+if __name__ == "__main__":
+    main()
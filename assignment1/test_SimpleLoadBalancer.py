@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+
+# Unit tests of the SimpleLoadBalancer (proactive prefixes, server selection, Maglev tables, health checks, connection
+# affinity, ARP cache), run without Mininet: POX is stubbed when it is not on the path, e.g.
+#   python3 -m pytest test_SimpleLoadBalancer.py
+
+import os
+import sys
+import unittest
+from collections import deque
+
+# POX is stubbed by the pox_stub module at the root of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pox_stub import stub_pox, Connection
+stub_pox()
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pox.openflow.libopenflow_01 as of
+from pox.lib.addresses import IPAddr, EthAddr
+import SimpleLoadBalancer as slb
+
+def addresses(first, count):
+    return [IPAddr(IPAddr(first).toUnsigned() + i) for i in range(count)]
+
+# a service of a single group (10.0.0.1-3 serving 10.0.1.1-8) and a switch that knows every host
+def red_service(servers = 3, clients = 8):
+    server_ips = addresses("10.0.0.1", servers)
+    client_ips = addresses("10.0.1.1", clients)
+    return slb.LoadBalancedService(EthAddr("0a:00:00:00:00:01"), IPAddr("10.0.0.100"), server_ips,
+                                   dict((ip, 'red') for ip in client_ips), dict((ip, 'red') for ip in server_ips))
+
+def connect_switch(lb, service, dpid = 1):
+    sw = lb.switches[dpid] = slb.LoadBalancerSwitch(Connection(dpid))
+    hosts = sorted(list(service.server_ip_to_group) + list(service.user_ip_to_group), key = lambda ip: ip.toUnsigned())
+    for (port, ip) in enumerate(hosts, 1):
+        sw.arpTable[ip] = (EthAddr("00:00:00:00:00:%02x" % port), port)
+    return sw
+
+class ProactivePrefixesTest(unittest.TestCase):
+    def test_plan(self):
+        servers = addresses("10.0.0.1", 4)
+        server_groups = {servers[0]: 'red', servers[1]: 'red', servers[2]: 'blue', servers[3]: 'blue'}
+        user_groups = dict((client, 'red') for client in addresses("10.0.0.16", 8))
+        user_groups.update(dict((client, 'blue') for client in addresses("10.0.0.24", 8)))
+        plan = slb.plan_proactive_prefixes(user_groups, server_groups, [IPAddr("10.0.0.100")])
+        self.assertEqual(set(plan.keys()), set(servers)) #every replica gets at least one prefix
+        for client in user_groups:
+            owners = [server for (server, prefixes) in plan.items()
+                      for (network, length) in prefixes if slb.in_prefix(client.toUnsigned(), network.toUnsigned(), length)]
+            self.assertEqual(len(owners), 1)
+            self.assertEqual(server_groups[owners[0]], user_groups[client])
+        for reserved in servers + [IPAddr("10.0.0.100")]:
+            for prefixes in plan.values():
+                for (network, length) in prefixes:
+                    self.assertFalse(slb.in_prefix(reserved.toUnsigned(), network.toUnsigned(), length))
+
+class LeastLoadedTest(unittest.TestCase):
+    def test_least_loaded(self):
+        service = red_service()
+        lb = slb.SimpleLoadBalancer([service], lb_policy = "least_loaded")
+        sw = connect_switch(lb, service)
+        (busy, first, second) = service.server_ips
+        sw.port_samples[busy] = deque([(0.0, 0, 0), (1.0, 100000, 100)])
+        clients = sorted(service.user_ip_to_group, key = lambda ip: ip.toUnsigned())
+        #the idle servers are told apart by their flows, which count the new flows until the next statistics
+        chosen = [lb.update_lb_mapping(sw, service, client) for client in clients[:4]]
+        self.assertEqual(chosen, [first, second, first, second])
+        self.assertEqual(sw.server_flows, {first: 2, second: 2})
+        service.down_servers.add(first)
+        self.assertEqual(lb.update_lb_mapping(sw, service, clients[4]), second)
+
+class MaglevTableTest(unittest.TestCase):
+    def test_balanced(self):
+        table = slb.MaglevTable(addresses("10.0.0.1", 5))
+        shares = [table.table.count(server) for server in table.servers]
+        self.assertEqual(sum(shares), slb.MAGLEV_TABLE_SIZE)
+        self.assertLessEqual(max(shares) - min(shares), 1)
+
+    def test_disruption_on_server_removal(self):
+        servers = addresses("10.0.0.1", 5)
+        clients = addresses("10.1.0.1", 10000)
+        before = slb.MaglevTable(servers)
+        after = slb.MaglevTable(servers[:2] + servers[3:])
+        moved = 0
+        for client in clients:
+            if before.lookup(client) == servers[2]:
+                self.assertIn(after.lookup(client), servers[:2] + servers[3:])
+            elif after.lookup(client) != before.lookup(client):
+                moved += 1
+        #only the clients of the removed server move, give or take the few table slots that change owner
+        self.assertLess(moved, len(clients) * 0.05)
+
+    def test_lookup_is_stable(self):
+        servers = addresses("10.0.0.1", 3)
+        client = IPAddr("10.1.0.7")
+        self.assertEqual(slb.MaglevTable(servers).lookup(client), slb.MaglevTable(list(reversed(servers))).lookup(client))
+        self.assertEqual(slb.MaglevTable([]).lookup(client), None)
+
+    def test_down_servers_are_skipped(self):
+        servers = addresses("10.0.0.1", 3)
+        clients = addresses("10.1.0.1", 20)
+        service = slb.LoadBalancedService(EthAddr("0a:00:00:00:00:01"), IPAddr("10.0.0.100"), servers,
+                                          dict((client, 'red') for client in clients), dict((server, 'red') for server in servers))
+        service.down_servers.add(servers[0])
+        service.build_maglev_tables()
+        for client in clients:
+            self.assertIn(service.maglev_tables['red'].lookup(client), servers[1:])
+
+class HealthCheckTest(unittest.TestCase):
+    def test_failover_moves_only_the_flows_of_the_failed_server(self):
+        service = red_service()
+        lb = slb.SimpleLoadBalancer([service], health_check_fall = 2, health_check_rise = 2)
+        sw = connect_switch(lb, service)
+        for client in service.user_ip_to_group:
+            key = (service.service_ip, client)
+            server_ip = lb.choose_server(sw, service, key)
+            lb.install_flow_rule_client_to_server(sw, service, sw.arpTable[server_ip][1], client, server_ip)
+        flows = dict(sw.flows)
+        failed = flows[(service.service_ip, sorted(service.user_ip_to_group, key = lambda ip: ip.toUnsigned())[0])]
+        alive = [ip for ip in service.server_ips if ip != failed]
+
+        def probe(answering):
+            lb.run_health_checks()
+            for server_ip in answering:
+                lb.handle_health_reply(server_ip)
+
+        probe(alive)
+        probe(alive) #a single miss
+        self.assertEqual(service.down_servers, set())
+        sw.connection.sent = []
+        probe(alive)
+        self.assertEqual(service.down_servers, set([failed]))
+        for (key, server_ip) in flows.items():
+            if server_ip == failed:
+                self.assertIn(sw.flows[key], alive)
+            else:
+                self.assertEqual(sw.flows[key], server_ip)
+        deleted = [msg.match.nw_src for msg in sw.connection.sent if isinstance(msg, of.ofp_flow_mod) and msg.command == of.OFPFC_DELETE_STRICT]
+        self.assertEqual(sorted(deleted), sorted(key[1] for (key, server_ip) in flows.items() if server_ip == failed))
+
+        #back after two answered probes, the flows stay where they are
+        moved = dict(sw.flows)
+        probe(service.server_ips)
+        self.assertEqual(service.down_servers, set([failed]))
+        probe(service.server_ips)
+        self.assertEqual(service.down_servers, set())
+        self.assertEqual(sw.flows, moved)
+
+class ConnectionAffinityTest(unittest.TestCase):
+    def test_pinning_and_expiry(self):
+        service = red_service()
+        lb = slb.SimpleLoadBalancer([service])
+        sw = connect_switch(lb, service)
+        key = (service.service_ip, IPAddr("10.0.1.1"), 6, 40000, 80)
+        server_ip = lb.choose_server(sw, service, key)
+        self.assertNotIn(key, sw.lb_choise)
+
+        #the connection keeps the server it is pinned to, even where the table points elsewhere
+        server_ip = sw.affinity[key][0] = [ip for ip in service.server_ips if ip != server_ip][0]
+        self.assertEqual(lb.choose_server(sw, service, key), server_ip)
+
+        #an idle connection keeps its server as long as its flow is installed, and is forgotten after that
+        sw.affinity[key][1] -= slb.AFFINITY_TIMEOUT + 1
+        sw.flows[key] = server_ip
+        lb.age_affinity_tables()
+        self.assertIn(key, sw.affinity)
+        del sw.flows[key]
+        lb.age_affinity_tables()
+        self.assertNotIn(key, sw.affinity)
+
+    def test_a_failed_server_loses_its_connections(self):
+        service = red_service()
+        lb = slb.SimpleLoadBalancer([service])
+        sw = connect_switch(lb, service)
+        key = (service.service_ip, IPAddr("10.0.1.1"), 17, 40000, 53)
+        server_ip = lb.choose_server(sw, service, key)
+        service.down_servers.add(server_ip)
+        service.build_maglev_tables()
+        self.assertNotEqual(lb.choose_server(sw, service, key), server_ip)
+        self.assertNotEqual(sw.affinity[key][0], server_ip)
+
+class ArpCacheTest(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = slb.ArpCache(ttl = 60, max_entries = 2)
+        (first, second, third) = addresses("10.0.0.1", 3)
+        cache[first] = ("00:00:00:00:00:01", 1)
+        cache[second] = ("00:00:00:00:00:02", 2)
+        self.assertEqual(cache[first], ("00:00:00:00:00:01", 1)) #first is now the most recently used
+        cache[third] = ("00:00:00:00:00:03", 3)
+        self.assertNotIn(second, cache)
+        self.assertIn(first, cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_ttl(self):
+        cache = slb.ArpCache(ttl = 60)
+        (old, new) = addresses("10.0.0.1", 2)
+        cache[old] = ("00:00:00:00:00:01", 1)
+        cache[new] = ("00:00:00:00:00:02", 2)
+        (mac, port, learned) = cache.entries[old]
+        cache.entries[old] = (mac, port, learned - 61)
+        self.assertEqual(cache.get(old), None)
+        self.assertEqual(cache.items(), [(new, ("00:00:00:00:00:02", 2))])
+
+if __name__ == '__main__':
+    unittest.main()
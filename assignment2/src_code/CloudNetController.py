@@ -1,10 +1,15 @@
 #generic imports
 import sys
 import os
-import random
 import time
 import traceback
 import csv
+import zlib
+import json
+import socket
+import threading
+from collections import OrderedDict
+from array import array
 
 #pox-specific imports
 from pox.core import core
@@ -28,6 +33,48 @@ MAX_PHYS_PORTS  = 0xFF00
 ALLOW_SPAM      = 0
 DEBUG           = 1
 
+# priorities of the rules (the reactive per-flow rules use of.OFP_DEFAULT_PRIORITY)
+FIREWALL_PRIORITY   = of.OFP_DEFAULT_PRIORITY + 1 #compiled cross-tenant drop rules, above any forwarding rule
+TABLE_MISS_PRIORITY = of.OFP_DEFAULT_PRIORITY - 3 #unknown ARP/IP packets go to the controller
+PROACTIVE_PRIORITY  = of.OFP_DEFAULT_PRIORITY - 2 #destination based (nw_dst) forwarding towards the learned hosts
+PUNT_PRIORITY       = of.OFP_DEFAULT_PRIORITY - 1 #traffic that must reach the controller despite the proactive rules
+
+def flow_hash(srcip, dstip, protonum, srcport=0, dstport=0):
+    #deterministic (unlike hash()) across runs, so a flow is put back on the same path after its rules expire
+    return zlib.crc32(("%s %s %d %d %d" % (srcip, dstip, protonum, srcport, dstport)).encode()) & 0xffffffff
+
+PORT_STATS_BATCH        = 32     #switches polled for port statistics per tick (bounds the polling overhead)
+UTILIZATION_EWMA_ALPHA  = 0.3    #weight of the newest rate sample of a link
+LINK_RATE_QUANTUM       = 125000 #bytes/s (1 Mbit/s), links whose rates differ less are considered equally loaded
+PATH_LOAD_MARGIN        = 10     #link rate quanta (10 Mbit/s) the hashed path must be busier than the least loaded one to be avoided
+
+ELEPHANT_THRESHOLD      = 1250000 #bytes/s (10 Mbit/s) above which a flow is an elephant and may be rerouted
+ELEPHANT_HOLD_TIME      = 10      #seconds an elephant stays on its path after being rerouted
+
+BARRIER_TIMEOUT         = 2       #seconds to wait for the barrier replies of a path before giving up on its packet
+PENDING_FLOW_QUEUE      = 64      #packets of a flow queued while its path is installed, the next ones are dropped
+
+POLICY_RELOAD_INTERVAL  = 2       #seconds between the checks of the firewall policy file for changes
+POLICY_CACHE_SIZE       = 65536   #firewall decisions cached per flow key
+
+# protocol names accepted in the firewall policy file
+IP_PROTOCOLS = {
+  'icmp': 1,
+  'tcp' : 6,
+  'udp' : 17
+}
+
+HOST_EXPIRY_INTERVAL    = 5     #seconds between the checks for hosts not seen for host_timeout seconds
+
+ARP_FLOOD_INTERVAL      = 1     #seconds between two floods looking for the same unknown IP
+ARP_FLOOD_TABLE_SIZE    = 65536 #unknown IPs remembered for the rate limiting of the floods
+ARP_WAIT_TIMEOUT        = 5     #seconds a host asking for an unknown IP is answered for once the IP is learned
+
+CONTROL_REQUEST_TIMEOUT = 10 #seconds a control request waits for the POX thread to apply it
+
+PATHS_QUIET_PERIOD  = 0.5 #seconds without link events before the paths are recomputed
+PATHS_MAX_DELAY     = 3   #seconds a recomputation can be postponed by a continuous burst of link events
+
 # dict of TCP and UDP proto numbers
 PROTO_NUMS = {
   6 : 'tcp',
@@ -60,49 +107,232 @@ class CloudNetController (EventMixin):
 
     _neededComponents = set(['openflow_discovery'])
 
-    def __init__(self, firewall_capability, migration_capability, firewall_policy_file, migration_events_file):
+    def __init__(self, firewall_capability, migration_capability, firewall_policy_file, migration_events_file, proactive_forwarding=True,
+                 load_share_report_interval=0, port_stats_interval=2, flow_stats_interval=5, in_place_migration=True,
+                 control_socket=None, host_timeout=0):
         super(EventMixin, self).__init__()
 
         #generic controller information
         self.switches = {}     # key=dpid, value = SwitchWithPaths instance
         self.sw_sw_ports = {}  # key = (dpid1,dpid2), value = outport of dpid1
         self.adjs = {}         # key = dpid, value = list of neighbors
-        self.arpmap = {} # key=host IP, value = (mac,dpid,port)
-        self._paths_computed = False #boolean to indicate if all paths are computed (converged routing)
+        self.arpmap = HostLocations(host_timeout) # key=host IP, value = (mac,dpid,port), indexed by switch and port
+        self._paths_computed = False #boolean to indicate if the paths are computed (routing converged at least once)
+        self.routes = NextHopPaths() #equal cost shortest paths of the fabric, shared by all switches
+        self.routing = IncrementalShortestPaths(self.routes) #recomputes only the destinations a link change affects
+        self.flow_db = FlowDatabase() #every rule installed by the controller, synced by the FlowRemoved messages
+        self.flow_programmer = FlowProgrammer(self.switches, self.flow_db) #batched, barrier confirmed flow mods
+        self.pending_flows = {} # key = (srcip, dstip, protonum[, srcport, dstport]), value = PendingFlow whose path is being installed
+        Timer(BARRIER_TIMEOUT, self.expire_pending_flows, recurring = True)
+        self._paths_timer = None #pending (debounced) path recomputation
+        self._paths_pending_since = None
         self.ignored_IPs = [IPAddr("0.0.0.0"), IPAddr("255.255.255.255")] #these are used by openflow discovery module
+        self._arp_floods = {} # key = unknown IP, value = time it was last looked for with a flood
+        self._arp_waiting = {} # key = unknown IP, value = dict of requester IP -> time it asked for it
+        if host_timeout > 0:
+            Timer(HOST_EXPIRY_INTERVAL, self.arpmap.expire_idle, recurring = True)
+        if load_share_report_interval > 0:
+            Timer(load_share_report_interval, self.print_load_share, recurring = True)
+
+        #link utilization monitor, new flows take the least loaded equal cost path
+        self.port_stats_interval = port_stats_interval
+        self.port_neighbors = {} # key = (dpid, port), value = neighbor dpid (reverse of sw_sw_ports)
+        self.link_rate = {}      # key = (dpid1, dpid2), value = EWMA of the bytes/s sent from dpid1 to dpid2
+        self._port_bytes = {}    # key = (dpid, port), value = (tx_bytes, time) of the last port statistics
+        self._stats_cursor = 0   # next switch (in dpid order) to poll
+        if self.port_stats_interval > 0:
+            Timer(self.port_stats_interval, self.request_port_stats, recurring = True)
+
+        #elephant flow detection on the edge switches (needs the link utilization monitor to move the elephants), the
+        #same statistics keep the hosts whose traffic never reaches the controller from expiring
+        self.flow_paths = {}     # key = (srcip, dstip, protonum), value = path of the per-flow rules
+        self.elephants = {}      # key = (srcip, dstip, protonum), value = time the elephant was last rerouted
+        self._flow_bytes = {}    # key = dpid, value = dict (key = (flow, in_port), value = (byte_count, duration)) of the last flow statistics
+        self._rule_bytes = {}    # key = dpid, value = dict (key = (priority, packed match), value = byte_count) of the last flow statistics
+        self._flow_stats_cursor = 0
+        if flow_stats_interval > 0 and (self.port_stats_interval > 0 or host_timeout > 0):
+            Timer(flow_stats_interval, self.request_flow_stats, recurring = True)
 
         #invoke event listeners
         if not core.listen_to_dependencies(self, self._neededComponents):
             self.listenTo(core)
         self.listenTo(core.openflow)
+        self.listenTo(self.arpmap) #HostMoved/HostExpired, other components can subscribe to them as well
 
         #module-specific information
         self.firewall_capability = firewall_capability
         self.migration_capability = migration_capability
+        self.in_place_migration = in_place_migration #make before break rewrite of the running flows instead of flushing them
+        #with the firewall, the traffic the destination based rules must not decide is punted to the controller
+        #(see install_host_firewall_rules and update_port_guards)
+        self.proactive_forwarding = proactive_forwarding
         self.firewall_policies = None
         self.migration_events = None
         self.migrated_IPs = None
         if self.firewall_capability:
             self.firewall_policies = self.read_firewall_policies(firewall_policy_file)
+            self.firewall_rules = self.firewall_policies.compile()
+            self.host_firewall_rules = {} # key = host IP, value = set of (dpid, port, priority, rule) installed for the host
+            self.port_guards = set() # (dpid, port) of the host ports whose IP traffic is punted to the controller
+            print("\033[41mFIREWALL:\033[00m\033[31m %d tenant entries and %d rules compiled into %d drop rules\033[00m" % (len(self.firewall_policies.tenants), len(self.firewall_policies.rules), len(self.firewall_rules)))
+            Timer(POLICY_RELOAD_INTERVAL, self.reload_firewall_policies, recurring = True)
         if self.migration_capability:
             self.migration_events = self.read_migration_events(migration_events_file)
             self.old_migrated_IPs = {} #key=old_IP, value=new_IP
             self.new_migrated_IPs = {} #key=new_IP, value=old_IP
+            self.scheduled_migrations = {} #key=old_IP, value=new_IP of the migrations waiting for their time
             for event in self.migration_events:
                 migration_time = event[0]
                 old_IP = event[1]
                 new_IP = event[2]
-                Timer(migration_time, self.handle_migration, args = [IPAddr(old_IP), IPAddr(new_IP)])
+                self.schedule_migration(migration_time, IPAddr(old_IP), IPAddr(new_IP))
+
+        #runtime control API (migrations, firewall policy, dumps of the state) on a local unix socket
+        self.control_server = None
+        if control_socket:
+            self.control_server = ControlServer(control_socket, self.handle_control_request)
 
     def read_firewall_policies(self, firewall_policy_file):
-        firewall_policies = {}
-        with open(firewall_policy_file, 'r') as csvfile:
-            reader = csv.reader(csvfile)
-            for row in reader:
-                tenant_id = row[0]
-                for ip in row[1:len(row)]:
-                    firewall_policies[IPAddr(ip)] = int(tenant_id)
-        return firewall_policies
+        return FirewallPolicy(firewall_policy_file)
+
+    def reload_firewall_policies(self, force=False):
+        #hot reload: when the policy file changes, swap the policy and only touch the compiled rules that differ
+        if not (force or self.firewall_policies.changed()):
+            return
+        #the host pairs of the installed per-flow rules, and the decisions the previous policy took for them
+        pairs = set(entry.owner for entry in self.flow_db.entries.values()
+                    if entry.owner is not None and entry.owner[0] is not None and entry.owner[1] is not None)
+        old_decisions = dict((pair, self.firewall_policies.decide(pair[0], pair[1])) for pair in pairs)
+        try:
+            self.firewall_policies.load()
+        except (IOError, OSError, ValueError, RuntimeError) as e:
+            warrning("Firewall policy file not reloaded, keeping the previous policy: %s" % (str(e)))
+            return
+        #the flows of the pairs whose decision changed go through the firewall checks again
+        revoked = [entry for entry in self.flow_db.entries.values()
+                   if entry.owner in old_decisions and self.firewall_policies.decide(entry.owner[0], entry.owner[1]) != old_decisions[entry.owner]]
+        if len(revoked) > 0:
+            print("\033[41mFIREWALL:\033[00m\033[31m %d rules of flows whose decision changed removed\033[00m" % (len(revoked)))
+            transaction = self.flow_programmer.transaction()
+            for entry in revoked:
+                if entry.dpid in self.switches:
+                    transaction.add(entry.dpid, self.switches[entry.dpid].delete_flow_rule_strict_msg(entry.match, entry.priority))
+            transaction.commit()
+        old_rules = set(self.firewall_rules)
+        self.firewall_rules = self.firewall_policies.compile()
+        new_rules = set(self.firewall_rules)
+        print("\033[41mFIREWALL:\033[00m\033[31m policy reloaded, %d drop rules removed and %d added\033[00m" % (len(old_rules - new_rules), len(new_rules - old_rules)))
+        for ip in set(self.host_firewall_rules.keys()) | set(self.arpmap.keys()):
+            self.install_host_firewall_rules(ip)
+        self.install_all_destination_rules()
+
+    #runs in the POX thread, returns the response of a request of the control API (see ControlServer)
+    def handle_control_request(self, request):
+        operations = {
+            'migrate'       : self.control_migrate,
+            'add_policy'    : self.control_add_policy,
+            'remove_policy' : self.control_remove_policy,
+            'dump_arpmap'   : self.control_dump_arpmap,
+            'dump_paths'    : self.control_dump_paths,
+            'dump_flows'    : self.control_dump_flows,
+        }
+        op = request.get('op')
+        if op not in operations:
+            return {'ok': False, 'error': "unknown op %s, expected one of: %s" % (op, ", ".join(sorted(operations.keys())))}
+        try:
+            result = operations[op](request)
+        except (KeyError, ValueError, TypeError, IOError, OSError, RuntimeError) as e:
+            return {'ok': False, 'error': "%s: %s" % (type(e).__name__, str(e))}
+        return {'ok': True, 'result': result}
+
+    #{"op": "migrate", "old": ip, "new": ip} or {"op": "migrate", "migrations": [[old ip, new ip], ...]}, "delay": seconds (optional)
+    def control_migrate(self, request):
+        if not self.migration_capability:
+            raise ValueError("migration capability disabled")
+        if 'migrations' in request:
+            migrations = [(IPAddr(old_IP), IPAddr(new_IP)) for (old_IP, new_IP) in request['migrations']]
+        else:
+            migrations = [(IPAddr(request['old']), IPAddr(request['new']))]
+        delay = float(request.get('delay', 0))
+        #the whole batch is checked before any migration is applied (or scheduled)
+        busy = set(self.old_migrated_IPs.keys()) | set(self.new_migrated_IPs.keys())
+        busy |= set(self.scheduled_migrations.keys()) | set(self.scheduled_migrations.values())
+        for (old_IP, new_IP) in migrations:
+            if old_IP == new_IP:
+                raise ValueError("%s cannot be migrated to itself" % (old_IP))
+            if old_IP in busy or new_IP in busy:
+                raise ValueError("%s or %s is already migrated, scheduled or used twice in the request" % (old_IP, new_IP))
+            if delay <= 0 and new_IP not in self.arpmap:
+                raise ValueError("the location of %s is not known yet" % (new_IP))
+            busy |= set([old_IP, new_IP])
+        for (old_IP, new_IP) in migrations:
+            if delay > 0:
+                self.schedule_migration(delay, old_IP, new_IP)
+            else:
+                self.handle_migration(old_IP, new_IP)
+        return {'migrations': [[str(old_IP), str(new_IP)] for (old_IP, new_IP) in migrations], 'delay': delay}
+
+    #{"op": "add_policy", "row": "<tenant id>,<ip or prefix>,..." or "allow|deny,<src>,<dst>[,<protocol>[,<ports>]]"}
+    #the row is appended to the policy file, which is reloaded at once
+    def control_add_policy(self, request):
+        if not self.firewall_capability:
+            raise ValueError("firewall capability disabled")
+        row = policy_row(request['row'])
+        parse_policy_row(row)
+        with open(self.firewall_policies.filename, 'r') as policy_file:
+            text = policy_file.read()
+        with open(self.firewall_policies.filename, 'a') as policy_file:
+            if text != '' and not text.endswith("\n"):
+                policy_file.write("\n")
+            policy_file.write(",".join(row) + "\n")
+        self.reload_firewall_policies(force = True)
+        return {'added': ",".join(row), 'drop_rules': len(self.firewall_rules)}
+
+    #{"op": "remove_policy", "row": ...}, removes the rows of the policy file equal to the given one
+    def control_remove_policy(self, request):
+        if not self.firewall_capability:
+            raise ValueError("firewall capability disabled")
+        parsed = parse_policy_row(policy_row(request['row']))
+        with open(self.firewall_policies.filename, 'r') as policy_file:
+            lines = policy_file.readlines()
+        kept = []
+        for line in lines:
+            row = policy_row(line)
+            if len(row) > 0 and row[0] != '' and not row[0].startswith('#') and parse_policy_row(row) == parsed:
+                continue
+            kept.append(line)
+        if len(kept) == len(lines):
+            raise ValueError("no such row in %s" % (self.firewall_policies.filename))
+        with open(self.firewall_policies.filename, 'w') as policy_file:
+            policy_file.writelines(kept)
+        self.reload_firewall_policies(force = True)
+        return {'removed': len(lines) - len(kept), 'drop_rules': len(self.firewall_rules)}
+
+    def control_dump_arpmap(self, request):
+        return dict((str(ip), {'mac': str(mac), 'dpid': dpid, 'port': port}) for (ip, (mac, dpid, port)) in self.arpmap.items())
+
+    #{"op": "dump_paths"}: the paths of the per-flow rules, {"op": "dump_paths", "src": dpid, "dst": dpid}: the equal cost paths
+    def control_dump_paths(self, request):
+        if 'src' in request or 'dst' in request:
+            (src, dst) = (int(request['src']), int(request['dst']))
+            return [self.routes.get_path(src, dst, k) for k in range(self.routes.count_paths(src, dst))]
+        return [{'src': str(srcip), 'dst': str(dstip), 'protocol': PROTO_NUMS.get(protonum, protonum), 'path': path}
+                for ((srcip, dstip, protonum), path) in self.flow_paths.items()]
+
+    #{"op": "dump_flows"}, optionally filtered by "dpid" or "ip"
+    def control_dump_flows(self, request):
+        if 'dpid' in request:
+            entries = self.flow_db.on_dpid(int(request['dpid']))
+        elif 'ip' in request:
+            entries = self.flow_db.of_ip(IPAddr(request['ip']))
+        else:
+            entries = list(self.flow_db.entries.values())
+        now = time.time()
+        return [{'dpid': entry.dpid, 'priority': entry.priority, 'match': str(entry.match),
+                 'idle_timeout': entry.idle_timeout, 'hard_timeout': entry.hard_timeout,
+                 'owner': None if entry.owner is None else [None if ip is None else str(ip) for ip in entry.owner],
+                 'path': entry.path, 'age': now - entry.installed}
+                for entry in sorted(entries, key = lambda entry: (entry.dpid, -entry.priority))]
 
     def read_migration_events(self, migration_info_file):
         migration_events = []
@@ -117,10 +347,14 @@ class CloudNetController (EventMixin):
 
     def _handle_ConnectionUp(self, event):
         if event.dpid not in self.switches:
-            self.switches[event.dpid] = SwitchWithPaths()
+            self.switches[event.dpid] = SwitchWithPaths(self.routes, self.flow_db)
             if event.dpid not in self.adjs:
                 self.adjs[event.dpid] = set([])
         self.switches[event.dpid].connect(event.connection)
+        #every physical port faces a host, until the discovery finds a link on it
+        sw = self.switches[event.dpid]
+        sw.host_ports = set(port.port_no for port in sw.ports if port.port_no < MAX_PHYS_PORTS) - \
+                        set(port for ((dpid, port), neighbor) in self.port_neighbors.items() if dpid == event.dpid)
         #send unknown ARP and IP packets to controller (install rules for that with low priority)
         msg_ARP = of.ofp_flow_mod()
         msg_IP  = of.ofp_flow_mod()
@@ -128,33 +362,72 @@ class CloudNetController (EventMixin):
         msg_IP.match.dl_type  = 0x0800
         msg_ARP.actions.append(of.ofp_action_output(port = of.OFPP_CONTROLLER))
         msg_IP.actions.append(of.ofp_action_output(port = of.OFPP_CONTROLLER))
-        msg_ARP.priority = of.OFP_DEFAULT_PRIORITY - 1
-        msg_IP.priority  = of.OFP_DEFAULT_PRIORITY - 1
+        msg_ARP.priority = TABLE_MISS_PRIORITY
+        msg_IP.priority  = TABLE_MISS_PRIORITY
         event.connection.send(msg_ARP)
         event.connection.send(msg_IP)
+        self.update_port_guards(event.dpid)
 
     def _handle_ConnectionDown(self, event):
-        ips_to_forget = []
-        for ip in self.arpmap:
-            (mac, dpid, port) = self.arpmap[ip]
-            if dpid == event.dpid:
-                ips_to_forget.append(ip)
-        for ip in ips_to_forget:
-            del self.arpmap[ip]
         if (event.dpid in self.switches):
             self.switches[event.dpid].disconnect()
             del self.switches[event.dpid]
+        self.flow_db.remove_dpid(event.dpid)
+        if self.firewall_capability:
+            self.port_guards = set(guard for guard in self.port_guards if guard[0] != event.dpid)
+        self.arpmap.expire_dpid(event.dpid, "switch down")
         #let the discovery module deal with the port removals...
 
+    def _handle_PortStatus(self, event):
+        sw = self.switches.get(event.dpid)
+        if sw is None or sw.connection is None or event.port >= MAX_PHYS_PORTS:
+            return
+        if event.deleted:
+            sw.ports = [port for port in sw.ports if port.port_no != event.port]
+            sw.host_ports.discard(event.port)
+            self.arpmap.expire_port(event.dpid, event.port, "port removed")
+        elif event.modified and event.ofp.desc.state & of.OFPPS_LINK_DOWN:
+            self.arpmap.expire_port(event.dpid, event.port, "port down")
+        elif event.added:
+            sw.ports = sw.ports + [event.ofp.desc]
+            if (event.dpid, event.port) not in self.port_neighbors:
+                sw.host_ports.add(event.port)
+        self.update_port_guards(event.dpid)
+
     def flood_on_all_switch_edges(self, packet, this_dpid, this_port):
+        #the host ports of every switch are kept up to date by the link events, one packet out per switch that has any
         for src_dpid in self.switches:
-            no_flood_ports = set([]) #list of non-flood ports
-            if src_dpid in self.adjs:
-                for nei_dpid in self.adjs[src_dpid]:
-                    no_flood_ports.add(self.sw_sw_ports[(src_dpid,nei_dpid)])
-            if src_dpid == this_dpid:
-                no_flood_ports.add(this_port)
-            self.switches[src_dpid].flood_on_switch_edge(packet, no_flood_ports)
+            sw = self.switches[src_dpid]
+            if sw.connection is not None and len(sw.host_ports) > 0:
+                sw.flood_on_switch_edge(packet, this_port if src_dpid == this_dpid else None)
+
+    #ARP suppression: the hosts are answered from the arpmap, and an unknown IP is looked for with at most one flood
+    #of an ARP request every ARP_FLOOD_INTERVAL, whatever the number of requests/packets towards it in the meantime;
+    #every requester waits for the IP to be learned and is answered then, not only the one whose request was flooded
+    def discover_host(self, ip, request, this_dpid, this_port):
+        now = time.time()
+        if len(self._arp_waiting) >= ARP_FLOOD_TABLE_SIZE:
+            self._arp_waiting = {}
+        self._arp_waiting.setdefault(ip, {})[IPAddr(request.next.protosrc)] = now
+        if now - self._arp_floods.get(ip, 0) < ARP_FLOOD_INTERVAL:
+            return
+        if len(self._arp_floods) >= ARP_FLOOD_TABLE_SIZE:
+            self._arp_floods = {}
+        self._arp_floods[ip] = now
+        arpprint("Looking for %s with an ARP request on all switch edges" % (str(ip)))
+        self.flood_on_all_switch_edges(request, this_dpid, this_port)
+
+    #answer the hosts that asked for ip while it was unknown, with the MAC it was just learned with
+    def answer_waiting_hosts(self, ip, waiting):
+        (mac, dpid, port) = self.arpmap[ip]
+        now = time.time()
+        for (requester, asked) in waiting.items():
+            if now - asked > ARP_WAIT_TIMEOUT or requester == ip or requester not in self.arpmap:
+                continue
+            if self.firewall_capability and not self.firewall_policies.decide(requester, ip)[0]:
+                continue
+            (req_mac, req_dpid, req_port) = self.arpmap[requester]
+            self.switches[req_dpid].send_arp_reply(arp_request(req_mac, requester, ip), req_port, mac)
 
     def update_learned_arp_info(self, packet, dpid, port):
         src_ip = None
@@ -168,7 +441,153 @@ class CloudNetController (EventMixin):
         else:
             pass
         if (src_ip != None) and (src_mac != None):
-            self.arpmap[src_ip] = (src_mac, dpid, port)
+            self._arp_floods.pop(src_ip, None)
+            location_changed = self.arpmap.learn(src_ip, (src_mac, dpid, port))
+            if self.migration_capability and src_ip in self.new_migrated_IPs:
+                self.arpmap[self.new_migrated_IPs[src_ip]] = self.arpmap[src_ip] #the old IP lives where the new host is
+            if location_changed:
+                self.install_host_firewall_rules(src_ip)
+            if location_changed and self._paths_computed:
+                self.install_destination_rules(src_ip)
+            waiting = self._arp_waiting.pop(src_ip, None)
+            if waiting:
+                if packet.type == packet.ARP_TYPE and packet.next.opcode == arp.REPLY:
+                    waiting.pop(IPAddr(packet.next.protodst), None) #the reply itself is forwarded to that requester
+                self.answer_waiting_hosts(src_ip, waiting)
+
+    #FIREWALL functionality: the compiled drop rules whose source covers a learned host are installed on its edge switch,
+    #on the traffic entering from its port with its IP, so the denied traffic is dropped where it enters the fabric and
+    #every switch holds the rules of its own hosts only (the traffic of hosts not learned yet is decided at the controller);
+    #with proactive forwarding the traffic towards the destinations the policy decides per flow is punted to the controller
+    #as well, below the drop rules and the per-flow rules but above the destination based rules;
+    #only the rules that differ from the installed ones are sent, and a host that is gone loses them all
+    def install_host_firewall_rules(self, ip):
+        if not self.firewall_capability:
+            return
+        location = self.arpmap.get(ip)
+        wanted = set()
+        if location is not None and location[1] in self.switches and self.switches[location[1]].connection is not None:
+            host = (ip.toUnsigned(), 32)
+            wanted = set((location[1], location[2], FIREWALL_PRIORITY, rule) for rule in self.firewall_rules if prefixes_overlap(rule[1], host))
+            if self.proactive_forwarding:
+                wanted |= set((location[1], location[2], PUNT_PRIORITY, (0x0800, (0, 0), prefix, None, None))
+                              for prefix in self.firewall_policies.undecided(ip))
+        installed = self.host_firewall_rules.get(ip, set())
+        transaction = self.flow_programmer.transaction()
+        for (dpid, port, priority, rule) in installed - wanted:
+            if dpid in self.switches:
+                transaction.add(dpid, self.switches[dpid].delete_flow_rule_strict_msg(host_firewall_match(rule, ip, port), priority=priority))
+        for (dpid, port, priority, rule) in wanted - installed:
+            if priority == FIREWALL_PRIORITY:
+                transaction.add(dpid, self.switches[dpid].drop_flow_rule_msg(host_firewall_match(rule, ip, port), priority=priority))
+            else:
+                transaction.add(dpid, self.switches[dpid].output_flow_rule_msg(of.OFPP_CONTROLLER, host_firewall_match(rule, ip, port), priority=priority))
+        transaction.commit()
+        if len(wanted) > 0:
+            self.host_firewall_rules[ip] = wanted
+        else:
+            self.host_firewall_rules.pop(ip, None)
+        if location is not None:
+            self.update_port_guards(location[1])
+
+    #FIREWALL functionality with proactive forwarding: the IP traffic entering from a host port without a single learned
+    #host (not learned yet, forgotten, or several hosts behind the port) is not covered by the rules of a learned host,
+    #so it goes to the controller instead of following the destination based rules
+    def update_port_guards(self, dpid):
+        sw = self.switches.get(dpid)
+        if not (self.firewall_capability and self.proactive_forwarding) or sw is None or sw.connection is None:
+            return
+        transaction = self.flow_programmer.transaction()
+        for port in sw.host_ports | set(port for (guard_dpid, port) in self.port_guards if guard_dpid == dpid):
+            wanted = port in sw.host_ports and len(self.arpmap.at_port(dpid, port)) != 1
+            if wanted == ((dpid, port) in self.port_guards):
+                continue
+            match = of.ofp_match(dl_type = 0x0800, in_port = port)
+            if wanted:
+                transaction.add(dpid, sw.output_flow_rule_msg(of.OFPP_CONTROLLER, match, priority=PUNT_PRIORITY))
+                self.port_guards.add((dpid, port))
+            else:
+                transaction.add(dpid, sw.delete_flow_rule_strict_msg(match, priority=PUNT_PRIORITY))
+                self.port_guards.discard((dpid, port))
+        transaction.commit()
+
+    def _handle_HostMoved(self, event):
+        warrning("Host %s moved from switch %s port %s to switch %s port %s" % (event.ip, event.old_location[1], event.old_location[2], event.new_location[1], event.new_location[2]))
+        #the destination based rules are replaced by install_destination_rules, the per-flow rules are routed again
+        self.remove_rules_towards(event.ip, per_flow_only = self.proactive_forwarding)
+        self.update_port_guards(event.old_location[1])
+
+    def _handle_HostExpired(self, event):
+        warrning("Host %s forgotten (%s)" % (event.ip, event.reason))
+        self.remove_rules_towards(event.ip)
+        self.install_host_firewall_rules(event.ip)
+        self.update_port_guards(event.location[1])
+
+    def remove_rules_towards(self, ip, per_flow_only=False):
+        #the rules recorded for the traffic towards ip, found through the flow database index instead of a scan
+        transaction = self.flow_programmer.transaction()
+        for entry in self.flow_db.of_ip(ip):
+            if entry.owner[1] != ip or (per_flow_only and entry.owner[0] is None) or entry.dpid not in self.switches:
+                continue
+            transaction.add(entry.dpid, self.switches[entry.dpid].delete_flow_rule_strict_msg(entry.match, entry.priority))
+        transaction.commit()
+
+    def install_destination_rules(self, ip):
+        #proactively forward everything destined to a learned host: one nw_dst rule per switch, or one per
+        #in_port where there are equal cost next hops, so that the sources entering from different ports are spread;
+        #the rules are replaced in place, only the ones whose output changed are sent, and the destination rules of
+        #a previous location/topology that are not replaced are removed one by one (strict deletes)
+        if (not self.proactive_forwarding) or (ip in self.ignored_IPs) or (ip not in self.arpmap):
+            return
+        if self.migration_capability and ip in self.old_migrated_IPs:
+            return #the traffic towards a migrated IP is rewritten by per-flow rules
+        (dst_mac, dst_dpid, dst_port) = self.arpmap[ip]
+        #with the firewall, an IP outside the tenants is only reached through the per-flow rules of the allowed flows
+        reachable = not (self.firewall_capability and self.firewall_policies.tenant_of(ip) is None)
+
+        match = of.ofp_match()
+        match.dl_type = 0x0800
+        match.nw_dst = ip
+        transaction = self.flow_programmer.transaction(owner = (None, ip))
+        installed = set() # keys of the destination rules wanted now
+        def install(dpid, outport, match):
+            installed.add((dpid, match.pack()))
+            entry = self.flow_db.get(dpid, match, PROACTIVE_PRIORITY)
+            if entry is not None and entry.owner == (None, ip) and [getattr(action, 'port', None) for action in entry.actions] == [outport]:
+                return #already there
+            transaction.add(dpid, self.switches[dpid].output_flow_rule_msg(outport, match, priority=PROACTIVE_PRIORITY))
+        for dpid in (self.switches if reachable else []):
+            sw = self.switches[dpid]
+            if sw.connection is None:
+                continue
+            if dpid == dst_dpid:
+                install(dpid, dst_port, match)
+                continue
+            next_hops = self.routes.get_next_hops(dpid, dst_dpid)
+            if next_hops:
+                #skip the removed links the routes may still use until they are recomputed
+                next_hops = [next_hop for next_hop in next_hops if (dpid, next_hop) in self.sw_sw_ports]
+            if not next_hops:
+                continue
+            if len(next_hops) == 1:
+                install(dpid, self.sw_sw_ports[(dpid, next_hops[0])], match)
+                continue
+            for port in sw.ports:
+                if port.port_no >= MAX_PHYS_PORTS:
+                    continue
+                port_match = of.ofp_match(dl_type = 0x0800, nw_dst = ip, in_port = port.port_no)
+                next_hop = next_hops[(port.port_no + ip.toUnsigned()) % len(next_hops)]
+                install(dpid, self.sw_sw_ports[(dpid, next_hop)], port_match)
+        for entry in self.flow_db.of_ip(ip):
+            if entry.owner != (None, ip) or (entry.dpid, entry.match.pack()) in installed or entry.dpid not in self.switches:
+                continue
+            transaction.add(entry.dpid, self.switches[entry.dpid].delete_flow_rule_strict_msg(entry.match, entry.priority))
+        transaction.commit()
+
+    def install_all_destination_rules(self):
+        if self.proactive_forwarding:
+            for ip in list(self.arpmap.keys()):
+                self.install_destination_rules(ip)
 
     def _handle_PacketIn(self, event):
         packet = event.parsed
@@ -189,14 +608,14 @@ class CloudNetController (EventMixin):
 
                 #FIREWALL functionality
                 if self.firewall_capability:
-                    try:#CP CODE
-                        if(self.firewall_policies[srcip]!=self.firewall_policies[dstip]):
-                            print("\033[41mFIREWALL:\033[00m\033[31m Illegal packet detected from %s to %s\033[00m" %(srcip,dstip))
-                            self.drop_packets(dpid,packet)
-                            return
-                    except KeyError:
+                    allowed = self.firewall_policies.decide(srcip, dstip)[0]
+                    if allowed is None:
                         arpprint("IPs not covered by policy!")
                         return
+                    if not allowed:
+                        print("\033[41mFIREWALL:\033[00m\033[31m Illegal packet detected from %s to %s\033[00m" %(srcip,dstip))
+                        self.drop_packets(dpid,packet)
+                        return
 
                 if self.migration_capability:
                     #ignore ARP requests coming from old migrated IPs or directed to new ones
@@ -210,8 +629,7 @@ class CloudNetController (EventMixin):
                     (dst_mac, dst_dpid, dst_port) = self.arpmap[srcip]
                     self.switches[dst_dpid].send_arp_reply(packet, dst_port, req_mac)
                 else:
-                    arpprint("Flooding initial ARP request on all switch edges")
-                    self.flood_on_all_switch_edges(packet, dpid, inport)
+                    self.discover_host(dstip, packet, dpid, inport)
 
             elif packet.next.opcode == arp.REPLY:
                 arpprint("Handling ARP packet: %s responds to %s" % (str(srcip), str(dstip)))
@@ -219,12 +637,12 @@ class CloudNetController (EventMixin):
 
                 #FIREWALL functionality
                 if self.firewall_capability:
-                    try:#CP CODE
-                        if(self.firewall_policies[srcip]!=self.firewall_policies[dstip]):
-                            print("\033[41mFIREWALL:\033[00m\033[31m Illegal packet detected from %s to %s\033[00m" %(srcip,dstip))
-                            self.drop_packets(dpid,packet)
-                            return
-                    except KeyError:
+                    allowed = self.firewall_policies.decide(srcip, dstip)[0]
+                    if allowed is None:
+                        return
+                    if not allowed:
+                        print("\033[41mFIREWALL:\033[00m\033[31m Illegal packet detected from %s to %s\033[00m" %(srcip,dstip))
+                        self.drop_packets(dpid,packet)
                         return
 
                 if self.migration_capability:
@@ -253,15 +671,19 @@ class CloudNetController (EventMixin):
             ipprint("Handling IP packet between %s and %s" % (str(srcip), str(dstip)))
 
             #FIREWALL functionality
+            exact_match = False
             if self.firewall_capability:
-                try:#CP CODE
-                    if(self.firewall_policies[srcip]!=self.firewall_policies[dstip]):
-                        print("\033[41mFIREWALL:\033[00m\033[31m Illegal packet detected from %s to %s\033[00m" %(srcip,dstip))
-                        self.drop_packets(dpid,packet)
-                        return
-                except KeyError:
+                protocol = packet.next.protocol
+                dstport = getattr(packet.next.next, 'dstport', None) if protocol in [6, 17] else None
+                srcport = getattr(packet.next.next, 'srcport', None) if protocol in [6, 17] else None
+                (allowed, exact_match) = self.firewall_policies.decide(srcip, dstip, protocol, dstport, srcport)
+                if allowed is None:
                     ipprint("\033[41mFIREWALL:\033[00m\033[31mIPs not covered by policy!\033[00m")
                     return
+                if not allowed:
+                    print("\033[41mFIREWALL:\033[00m\033[31m Illegal packet detected from %s to %s\033[00m" %(srcip,dstip))
+                    self.drop_packets(dpid,packet)
+                    return
 
             if self._paths_computed:
                 debug("Routing calculations have converged")
@@ -287,11 +709,13 @@ class CloudNetController (EventMixin):
                             self.install_migrated_end_to_end_IP_path(event, dst_dpid, dst_port, packet, forward_path=False)
                             migrationprint("Reverse migrated path installed")
                         else:
-                            self.install_end_to_end_IP_path(event, dst_dpid, dst_port, packet)
+                            self.install_end_to_end_IP_path(event, dst_dpid, dst_port, packet, exact_match)
                     else:
-                        self.install_end_to_end_IP_path(event, dst_dpid, dst_port, packet)
+                        self.install_end_to_end_IP_path(event, dst_dpid, dst_port, packet, exact_match)
                 else:
-                    self.flood_on_all_switch_edges(packet, dpid, inport)
+                    #the packet is not flooded, the destination is looked for with an ARP request on behalf of the source
+                    #and the packet is dropped, the next one (or its retransmission) follows the path of the learned host
+                    self.discover_host(dstip, arp_request(packet.src, srcip, dstip), dpid, inport)
             else:
                 debug("Routing calculations have not converged, discarding packet")
                 return
@@ -313,39 +737,81 @@ class CloudNetController (EventMixin):
             return
 
 
-    def install_end_to_end_IP_path(self, event, dst_dpid, final_port, packet): #CP CODE
-        source_sw = self.switches[event.dpid]
+    #the packet-ins of a flow whose path is being installed (further packets of the source, or the first packets at
+    #the downstream switches that got their rules last) are queued and released along with the first packet
+    def coalesce_pending_flow(self, key, packet):
+        pending = self.pending_flows.get(key)
+        if pending is None:
+            return False
+        if time.time() > pending.deadline:
+            del self.pending_flows[key] #the barrier replies never came, the flow is set up again
+            return False
+        if len(pending.packets) < PENDING_FLOW_QUEUE:
+            pending.packets.append(packet)
+        return True
 
-        print("\033[35mInstalling new e2e IP path %s -> %s \033[00m" %(event.parsed.next.srcip,event.parsed.next.dstip))
+    #commit the transaction of a flow's path, release(*args, packet) sends a packet of the flow once it is in place
+    def commit_pending_flow(self, key, transaction, packet, release, *args):
+        self.pending_flows[key] = PendingFlow(packet, release, args)
+        transaction.commit(self.release_pending_flow, key)
+
+    def release_pending_flow(self, key):
+        pending = self.pending_flows.pop(key, None)
+        if pending is None:
+            return
+        for packet in pending.packets:
+            pending.release(*(pending.args + (packet,)))
+
+    def expire_pending_flows(self):
+        now = time.time()
+        for key in [key for (key, pending) in self.pending_flows.items() if now > pending.deadline]:
+            del self.pending_flows[key]
+
+    def install_end_to_end_IP_path(self, event, dst_dpid, final_port, packet, exact_match=False): #CP CODE
         if(packet.next.protocol==6):protonum=6
         else: protonum=17
+        pending_key = (IPAddr(event.parsed.next.srcip), IPAddr(event.parsed.next.dstip), protonum)
+        if exact_match and packet.next.protocol in [6, 17]:
+            pending_key += (packet.next.next.srcport, packet.next.next.dstport)
+        if self.coalesce_pending_flow(pending_key, event.parsed):
+            return
 
-        paths = source_sw._paths_per_proto[dst_dpid][protonum]
-        # debug("Available paths: "+str(paths))
+        print("\033[35mInstalling new e2e IP path %s -> %s \033[00m" %(event.parsed.next.srcip,event.parsed.next.dstip))
 
-        selected_path = paths[random.randint(0,len(paths)-1)]
+        selected_path = self.select_path(event.dpid, dst_dpid, flow_hash(event.parsed.next.srcip, event.parsed.next.dstip, protonum))
+        if selected_path is None:
+            debug("No path from switch %s to switch %s, discarding packet" % (event.dpid, dst_dpid))
+            return
         # debug("Selected Path :"+str(selected_path))
+        self.flow_paths[(IPAddr(event.parsed.next.srcip), IPAddr(event.parsed.next.dstip), protonum)] = selected_path
 
         my_match            = of.ofp_match()
         my_match.dl_type    = 0x0800
         my_match.nw_src     = event.parsed.next.srcip
         my_match.nw_dst     = event.parsed.next.dstip
         if(packet.next.protocol==6):my_match.nw_proto = 6
-
-        self.switches[selected_path[-1]].install_output_flow_rule(final_port, my_match,10)
+        if exact_match: #the firewall decision depends on the protocol/ports, so the rules must not cover other flows
+            my_match.nw_proto = packet.next.protocol
+            if packet.next.protocol in [6, 17]:
+                my_match.tp_src = packet.next.next.srcport
+                my_match.tp_dst = packet.next.next.dstport
+
+        transaction = self.flow_programmer.transaction(owner = (IPAddr(event.parsed.next.srcip), IPAddr(event.parsed.next.dstip)), path = selected_path)
+        transaction.add(selected_path[-1], self.switches[selected_path[-1]].output_flow_rule_msg(final_port, my_match,10))
         # debug("Installed new flow rule (%s -> %s)" % (selected_path[-1],"FINAL_HOST"))
         
         for linkindex in range( len(selected_path)-2, 0-1, -1): #reverse count
-            self.switches[selected_path[linkindex]].install_output_flow_rule(self.sw_sw_ports[(selected_path[linkindex],selected_path[linkindex+1])], my_match, 10)
+            transaction.add(selected_path[linkindex], self.switches[selected_path[linkindex]].output_flow_rule_msg(self.sw_sw_ports[(selected_path[linkindex],selected_path[linkindex+1])], my_match, 10))
             # debug("Installed new flow rule (%s -> %s)" % (selected_path[linkindex],selected_path[linkindex+1]))
 
-        if event.dpid == dst_dpid:
-            source_sw.send_packet(final_port, event.parsed)
-        else:
-            self.switches[dst_dpid].send_packet(final_port, event.parsed)
+        #the packet is released at the destination switch once every rule of the path is in place
+        self.commit_pending_flow(pending_key, transaction, event.parsed, self.switches[dst_dpid].send_packet, final_port)
 
     def install_migrated_end_to_end_IP_path(self, event, dst_dpid, dst_port, packet, forward_path=True):#CP CODE
         source_sw = self.switches[event.dpid]
+        pending_key = (IPAddr(event.parsed.next.srcip), IPAddr(event.parsed.next.dstip), 6 if packet.next.protocol == 6 else 17)
+        if self.coalesce_pending_flow(pending_key, event.parsed):
+            return
         
         #calculate data for the new path
         if forward_path:
@@ -359,10 +825,10 @@ class CloudNetController (EventMixin):
         if(packet.next.protocol==6):protonum=6
         else: protonum=17
 
-        paths = source_sw._paths_per_proto[dst_dpid][protonum]
-        # debug("Available paths: "+str(paths))
-
-        selected_path = paths[random.randint(0,len(paths)-1)]
+        selected_path = self.select_path(event.dpid, dst_dpid, flow_hash(event.parsed.next.srcip, event.parsed.next.dstip, protonum))
+        if selected_path is None:
+            debug("No path from switch %s to switch %s, discarding packet" % (event.dpid, dst_dpid))
+            return
         # debug("Selected Path :"+str(selected_path))
 
 
@@ -389,35 +855,52 @@ class CloudNetController (EventMixin):
             new_match.nw_proto          = 6
             before_rw_match.nw_proto    = 6
 
+        transaction = self.flow_programmer.transaction(owner = (IPAddr(event.parsed.next.srcip), IPAddr(event.parsed.next.dstip)), path = selected_path)
         if event.dpid == dst_dpid:
             if forward_path:
-                source_sw.install_forward_migration_rule(dst_port, new_host_mac, new_host_ip, before_rw_match, 10)
-                source_sw.send_forward_migrated_packet(dst_port, new_host_mac, new_host_ip, event.parsed)
+                transaction.add(event.dpid, source_sw.forward_migration_rule_msg(dst_port, new_host_mac, new_host_ip, before_rw_match, 10))
+                self.commit_pending_flow(pending_key, transaction, event.parsed, source_sw.send_forward_migrated_packet, dst_port, new_host_mac, new_host_ip)
             
             else:
-                source_sw.install_reverse_migration_rule(dst_port, new_host_mac, new_host_ip, before_rw_match, 10)
-                source_sw.send_reverse_migrated_packet(dst_port, new_host_mac, new_host_ip, event.parsed)
+                transaction.add(event.dpid, source_sw.reverse_migration_rule_msg(dst_port, new_host_mac, new_host_ip, before_rw_match, 10))
+                self.commit_pending_flow(pending_key, transaction, event.parsed, source_sw.send_reverse_migrated_packet, dst_port, new_host_mac, new_host_ip)
 
         else:
             if forward_path:
-                source_sw.install_forward_migration_rule(self.sw_sw_ports[(selected_path[0],selected_path[1])], new_host_mac, new_host_ip, before_rw_match, 10)
+                transaction.add(event.dpid, source_sw.forward_migration_rule_msg(self.sw_sw_ports[(selected_path[0],selected_path[1])], new_host_mac, new_host_ip, before_rw_match, 10))
             else:
-                source_sw.install_reverse_migration_rule(self.sw_sw_ports[(selected_path[0],selected_path[1])], new_host_mac, new_host_ip, before_rw_match, 10)
+                transaction.add(event.dpid, source_sw.reverse_migration_rule_msg(self.sw_sw_ports[(selected_path[0],selected_path[1])], new_host_mac, new_host_ip, before_rw_match, 10))
 
-            self.switches[selected_path[-1]].install_output_flow_rule(dst_port, new_match,10)
+            transaction.add(selected_path[-1], self.switches[selected_path[-1]].output_flow_rule_msg(dst_port, new_match,10))
             # debug("Installed new flow rule (%s -> %s)" % (selected_path[-1],"FINAL_HOST"))
             
             for linkindex in range( len(selected_path)-3, 0-1, -1): #reverse count
-                self.switches[selected_path[linkindex]].install_output_flow_rule(self.sw_sw_ports[(selected_path[linkindex],selected_path[linkindex+1])], new_match, 10)
+                transaction.add(selected_path[linkindex], self.switches[selected_path[linkindex]].output_flow_rule_msg(self.sw_sw_ports[(selected_path[linkindex],selected_path[linkindex+1])], new_match, 10))
                 # debug("Installed new flow rule (%s -> %s)" % (selected_path[linkindex],selected_path[linkindex+1]))
 
             if forward_path:
-                self.switches[dst_dpid].send_forward_migrated_packet(dst_port, new_host_mac, new_host_ip, event.parsed)
+                self.commit_pending_flow(pending_key, transaction, event.parsed, self.switches[dst_dpid].send_forward_migrated_packet, dst_port, new_host_mac, new_host_ip)
             else:
-                self.switches[dst_dpid].send_reverse_migrated_packet(dst_port, new_host_mac, new_host_ip, event.parsed)
+                self.commit_pending_flow(pending_key, transaction, event.parsed, self.switches[dst_dpid].send_reverse_migrated_packet, dst_port, new_host_mac, new_host_ip)
+
+    def schedule_migration(self, delay, old_IP, new_IP):
+        self.scheduled_migrations[old_IP] = new_IP
+        Timer(delay, self.run_scheduled_migration, args = [old_IP, new_IP])
+
+    def run_scheduled_migration(self, old_IP, new_IP):
+        del self.scheduled_migrations[old_IP]
+        self.handle_migration(old_IP, new_IP)
 
     def handle_migration(self, old_IP, new_IP):
         migrationprint("Handling migration from %s to %s..." % (str(old_IP), str(new_IP)))
+        if self.in_place_migration and new_IP in self.arpmap:
+            self.old_migrated_IPs[old_IP] = new_IP
+            self.new_migrated_IPs[new_IP] = old_IP
+            self.arpmap[old_IP] = self.arpmap[new_IP]
+            migrationprint("Arpmap for old ip updated")
+            if self.migrate_in_place(old_IP, new_IP):
+                return
+            warrning("Routes are being recomputed, flushing the rules of the migration instead")
         # create ofp_flow_mod message to delete all flows
         # to the destination to be migrated
         msg_1 = of.ofp_flow_mod()
@@ -445,15 +928,117 @@ class CloudNetController (EventMixin):
         self.old_migrated_IPs[old_IP] = new_IP
         self.new_migrated_IPs[new_IP] = old_IP
         (new_mac, new_dpid, new_inport) = self.arpmap[self.old_migrated_IPs[old_IP]]
+        if self.proactive_forwarding:
+            #the replies of the new host must have their source rewritten, keep them off the proactive rules
+            punt_match = of.ofp_match()
+            punt_match.dl_type = 0x0800
+            punt_match.nw_src = new_IP
+            self.switches[new_dpid].install_output_flow_rule(of.OFPP_CONTROLLER, punt_match, priority=PUNT_PRIORITY)
         self.arpmap[old_IP] = (new_mac, new_dpid, new_inport)
         migrationprint("Arpmap for old ip updated")
 
+    #returns False (and does nothing) while the routes wait for the recomputation of a link change
+    def migrate_in_place(self, old_IP, new_IP):
+        if not self.paths_settled():
+            return False
+        (new_mac, new_dpid, new_port) = self.arpmap[new_IP]
+        #the rules of the running flows towards the old IP (and of the destination based rules) and from the new IP
+        old_entries = [entry for entry in self.flow_db.of_ip(old_IP) if entry.owner[1] == old_IP] + \
+                      [entry for entry in self.flow_db.of_ip(new_IP) if entry.owner[0] == new_IP]
+        peers = set(entry.owner[0] for entry in old_entries) | set(entry.owner[1] for entry in old_entries)
+        if self.proactive_forwarding:
+            peers |= set(self.arpmap.keys()) #every learned host reaches the old IP through the destination based rules
+        peers = [ip for ip in peers if ip is not None and ip in self.arpmap and ip not in [old_IP, new_IP] and ip not in self.ignored_IPs
+                 and ip not in self.old_migrated_IPs and ip not in self.new_migrated_IPs]
+
+        def allowed(srcip, dstip):
+            if not self.firewall_capability:
+                return True
+            #the flows whose decision depends on the protocol/ports keep going through the firewall checks
+            (allowed, port_specific) = self.firewall_policies.decide(srcip, dstip)
+            return allowed == True and not port_specific
+
+        #make before break: the rewritten paths are committed first, then the ingress switches of the peers (and of the
+        #new host) start rewriting the headers, in place for the rules of the running flows, and once that is committed
+        #too the rules left towards the old location are removed, so the live traffic never falls back to the controller
+        path_rules = self.flow_programmer.transaction()
+        ingress_rules = self.flow_programmer.transaction()
+        kept = set() # (dpid, priority, packed match) of the rules installed by the migration
+        def add(transaction, dpid, msg, owner, path):
+            transaction.add(dpid, msg, owner, path)
+            kept.add((dpid, msg.priority, msg.match.pack()))
+
+        def add_rewrite_path(owner, src_dpid, dst_dpid, dst_port, new_match, rewrite_msg):
+            if src_dpid == dst_dpid:
+                path = [src_dpid]
+                ingress_port = dst_port
+            else:
+                path = self.select_path(src_dpid, dst_dpid, flow_hash(owner[0], owner[1], 0))
+                if path is None:
+                    return
+                ingress_port = self.sw_sw_ports[(path[0], path[1])]
+                add(path_rules, path[-1], self.switches[path[-1]].output_flow_rule_msg(dst_port, new_match, 10), owner, path)
+                for linkindex in range(len(path)-2, 0, -1):
+                    add(path_rules, path[linkindex], self.switches[path[linkindex]].output_flow_rule_msg(self.sw_sw_ports[(path[linkindex], path[linkindex+1])], new_match, 10), owner, path)
+            match = of.ofp_match()
+            match.dl_type = 0x0800
+            match.nw_src = owner[0]
+            match.nw_dst = owner[1]
+            add(ingress_rules, src_dpid, rewrite_msg(ingress_port, match), owner, path)
+            #the rules of the flows already running from the ingress switch are modified to rewrite the headers as well
+            for entry in old_entries:
+                if entry.owner == owner and entry.dpid == src_dpid and (entry.dpid, entry.priority, entry.match.pack()) not in kept:
+                    msg = rewrite_msg(ingress_port, entry.match)
+                    msg.command = of.OFPFC_MODIFY_STRICT
+                    msg.priority = entry.priority
+                    add(ingress_rules, src_dpid, msg, owner, path)
+
+        for peer in sorted(peers):
+            (peer_mac, peer_dpid, peer_port) = self.arpmap[peer]
+            if peer_dpid not in self.switches or new_dpid not in self.switches:
+                continue
+            if allowed(peer, old_IP):
+                new_match = of.ofp_match()
+                new_match.dl_type = 0x0800
+                new_match.nw_src = peer
+                new_match.nw_dst = new_IP
+                add_rewrite_path((peer, old_IP), peer_dpid, new_dpid, new_port, new_match,
+                                 lambda outport, match: self.switches[peer_dpid].forward_migration_rule_msg(outport, new_mac, new_IP, match, 10))
+            if allowed(old_IP, peer):
+                new_match = of.ofp_match()
+                new_match.dl_type = 0x0800
+                new_match.nw_src = old_IP
+                new_match.nw_dst = peer
+                add_rewrite_path((new_IP, peer), new_dpid, peer_dpid, peer_port, new_match,
+                                 lambda outport, match: self.switches[new_dpid].reverse_migration_rule_msg(outport, new_mac, old_IP, match, 10))
+        if self.proactive_forwarding and new_dpid in self.switches:
+            #the replies of the new host towards hosts learned later must have their source rewritten, keep them off the proactive rules
+            punt_match = of.ofp_match()
+            punt_match.dl_type = 0x0800
+            punt_match.nw_src = new_IP
+            ingress_rules.add(new_dpid, self.switches[new_dpid].output_flow_rule_msg(of.OFPP_CONTROLLER, punt_match, priority=PUNT_PRIORITY))
+        migrationprint("Rewriting the flows of %d peers of %s towards %s" % (len(peers), str(old_IP), str(new_IP)))
+
+        def remove_old_rules():
+            transaction = self.flow_programmer.transaction()
+            removed = 0
+            for entry in old_entries:
+                if (entry.dpid, entry.priority, entry.match.pack()) not in kept and entry.dpid in self.switches:
+                    transaction.add(entry.dpid, self.switches[entry.dpid].delete_flow_rule_strict_msg(entry.match, entry.priority))
+                    removed += 1
+            transaction.commit()
+            migrationprint("Migration from %s to %s done, %d old rules removed" % (str(old_IP), str(new_IP), removed))
+
+        path_rules.commit(ingress_rules.commit, remove_old_rules)
+        return True
+
     def drop_packets(self, dpid, packet):
+        #the compiled rules drop the cross-tenant traffic, this only covers what slipped through (e.g. during a reconnect),
+        #so the exact rule expires instead of filling the flow table
         match = of.ofp_match.from_packet(packet)
-        self.switches[dpid].install_drop_flow_rule(match, idle_timeout=0, hard_timeout=0)
+        self.switches[dpid].install_drop_flow_rule(match, idle_timeout=10, hard_timeout=0)
 
     def _handle_openflow_discovery_LinkEvent(self, event):
-        self._paths_computed = False
         link = event.link
         dpid1 = link.dpid1
         port1 = link.port1
@@ -468,9 +1053,24 @@ class CloudNetController (EventMixin):
         if event.added:
             self.sw_sw_ports[(dpid1,dpid2)] = port1
             self.sw_sw_ports[(dpid2,dpid1)] = port2
+            self.port_neighbors[(dpid1,port1)] = dpid2
+            self.port_neighbors[(dpid2,port2)] = dpid1
+            for (dpid, port) in [(dpid1,port1), (dpid2,port2)]:
+                if dpid in self.switches:
+                    self.switches[dpid].host_ports.discard(port)
+                self.arpmap.expire_port(dpid, port, "port is a switch link") #wrongly learned there (e.g. flooded packets)
             self.adjs[dpid1].add(dpid2)
             self.adjs[dpid2].add(dpid1)
         else:
+            for key in [(dpid1,port1), (dpid2,port2)]:
+                self.port_neighbors.pop(key, None)
+                self._port_bytes.pop(key, None)
+                #the port may face a host now (a link that is down because the port is gone is removed by the PortStatus)
+                if key[0] in self.switches and key[1] in self.switches[key[0]].physical_ports():
+                    self.switches[key[0]].host_ports.add(key[1])
+            self.link_rate.pop((dpid1,dpid2), None)
+            self.link_rate.pop((dpid2,dpid1), None)
+            self.invalidate_link(dpid1, dpid2)
             if (dpid1,dpid2) in self.sw_sw_ports:
                 del self.sw_sw_ports[(dpid1,dpid2)]
             if (dpid2,dpid1) in self.sw_sw_ports:
@@ -480,15 +1080,44 @@ class CloudNetController (EventMixin):
             if dpid1 in self.adjs[dpid2]:
                 self.adjs[dpid2].remove(dpid1)
 
-        # print("Current switch-to-switch ports:")
-        # spampp(self.sw_sw_ports)
-        # print("Current adjacencies:")
-        # spampp(self.adjs)
-        self._paths_computed=False
+        self.update_port_guards(dpid1)
+        self.update_port_guards(dpid2)
+
+        #coalesce bursts of link events (e.g. during discovery) into a single recomputation after a quiet period,
+        #meanwhile the new flows keep being served from the previous routes (see path_is_up)
+        self.routing.link_changed(dpid1, dpid2)
+        self.schedule_paths_update()
+
+    def invalidate_link(self, dpid1, dpid2):
+        #remove only the per-flow rules of the paths that crossed the failed link, their next packets are routed again
+        entries = self.flow_db.on_link(dpid1, dpid2) + self.flow_db.on_link(dpid2, dpid1)
+        if len(entries) > 0:
+            warrning("Link %s-%s removed, invalidating the %d rules of the paths crossing it" % (dpid1, dpid2, len(entries)))
+        transaction = self.flow_programmer.transaction()
+        for entry in entries:
+            if entry.dpid in self.switches:
+                transaction.add(entry.dpid, self.switches[entry.dpid].delete_flow_rule_strict_msg(entry.match, entry.priority))
+        transaction.commit()
+
+    def _handle_FlowRemoved(self, event):
+        self.flow_db.removed(event.dpid, event.ofp.match, event.ofp.priority, event.ofp.cookie)
+
+    def schedule_paths_update(self):
+        if self._paths_timer is not None:
+            self._paths_timer.cancel()
+        if self._paths_pending_since is None:
+            self._paths_pending_since = time.time()
+        delay = min(PATHS_QUIET_PERIOD, max(0, self._paths_pending_since + PATHS_MAX_DELAY - time.time()))
+        self._paths_timer = Timer(delay, self.update_paths)
+
+    def update_paths(self):
+        self._paths_timer = None
+        self._paths_pending_since = None
         self.checkPaths()
         if self._paths_computed == False:
             warrning("Disjoint topology, Shortest Path Routing converging")
         else:
+            self.install_all_destination_rules()
             # print("Topology connected, Shortest paths (re)computed successfully, Routing converged")
             # print("--------------------------")
             for dpid in self.switches:
@@ -496,63 +1125,267 @@ class CloudNetController (EventMixin):
                 # self.switches[dpid].printPaths()
             # print("--------------------------")
 
-    def checkPaths(self):
+    #returns None if there is no path (e.g. a switch that is not in the routes yet)
+    def select_path(self, src_dpid, dst_dpid, hash_value):
+        count = self.routes.count_paths(src_dpid, dst_dpid)
+        if count == 0:
+            return None
+        #the flow hash places the flows, the link load only overrides it when the hashed path is clearly busier
+        #(the elephants already placed are moved by the flow monitor instead)
+        path = self.routes.select_path(src_dpid, dst_dpid, hash_value)
+        if self.port_stats_interval > 0:
+            least_loaded = self.routes.least_loaded_path(src_dpid, dst_dpid, hash_value, self.link_cost)
+            if self.path_cost(path) - self.path_cost(least_loaded) >= PATH_LOAD_MARGIN:
+                path = least_loaded
+        if self.path_is_up(path):
+            return path
+        #the routes still wait for the recomputation of a link removal, only the paths crossing it are skipped
+        for k in range(count):
+            path = self.routes.get_path(src_dpid, dst_dpid, (hash_value + k) % count)
+            if self.path_is_up(path):
+                return path
+        return None
+
+    #the cost of the busiest link of a path
+    def path_cost(self, path):
+        return max([self.link_cost(dpid1, dpid2) for (dpid1, dpid2) in zip(path[:-1], path[1:])] + [0])
+
+    def path_is_up(self, path):
+        return all((dpid1, dpid2) in self.sw_sw_ports for (dpid1, dpid2) in zip(path[:-1], path[1:]))
+
+    #routes recomputed after the last link change
+    def paths_settled(self):
+        return self._paths_computed and self._paths_timer is None
+
+    def link_cost(self, dpid1, dpid2):
+        if (dpid1, dpid2) not in self.sw_sw_ports:
+            return sys.maxsize #removed link, still in the routes until they are recomputed
+        return int(self.link_rate.get((dpid1, dpid2), 0) / LINK_RATE_QUANTUM)
+
+    def request_port_stats(self):
+        #poll a bounded batch of switches per tick, going round the fabric
+        dpids = sorted(self.switches.keys())
+        for i in range(min(PORT_STATS_BATCH, len(dpids))):
+            self._stats_cursor = self._stats_cursor % len(dpids)
+            sw = self.switches[dpids[self._stats_cursor]]
+            self._stats_cursor += 1
+            if sw.connection is not None:
+                sw.connection.send(of.ofp_stats_request(body=of.ofp_port_stats_request()))
+
+    def _handle_PortStatsReceived(self, event):
+        now = time.time()
+        for stats in event.stats:
+            key = (event.dpid, stats.port_no)
+            if key not in self.port_neighbors:
+                continue #only the switch-to-switch links are monitored
+            previous = self._port_bytes.get(key)
+            self._port_bytes[key] = (stats.tx_bytes, now)
+            if previous is None or now <= previous[1] or stats.tx_bytes < previous[0]:
+                continue
+            rate = (stats.tx_bytes - previous[0]) / (now - previous[1])
+            link = (event.dpid, self.port_neighbors[key])
+            self.link_rate[link] = UTILIZATION_EWMA_ALPHA * rate + (1 - UTILIZATION_EWMA_ALPHA) * self.link_rate.get(link, rate)
+
+    def request_flow_stats(self):
+        #the elephants are detected at their ingress, so only the switches with hosts are polled
+        now = time.time()
+        for flow in [flow for (flow, rerouted) in self.elephants.items() if now - rerouted >= ELEPHANT_HOLD_TIME]:
+            del self.elephants[flow]
+        dpids = sorted(dpid for dpid in self.arpmap.dpids() if dpid in self.switches)
+        for i in range(min(PORT_STATS_BATCH, len(dpids))):
+            self._flow_stats_cursor = self._flow_stats_cursor % len(dpids)
+            sw = self.switches[dpids[self._flow_stats_cursor]]
+            self._flow_stats_cursor += 1
+            if sw.connection is not None:
+                sw.connection.send(of.ofp_stats_request(body=of.ofp_flow_stats_request()))
+
+    def _handle_FlowStatsReceived(self, event):
+        #a host whose rules at its switch (from its port/IP or towards it) count new bytes is alive
+        previous_bytes = self._rule_bytes.get(event.dpid, {})
+        rule_bytes = {}
+        for stats in event.stats:
+            key = (stats.priority, stats.match.pack())
+            rule_bytes[key] = stats.byte_count
+            if stats.byte_count <= previous_bytes.get(key, 0):
+                continue
+            match = stats.match
+            ips = self.arpmap.at_port(event.dpid, match.in_port) if match.in_port is not None else []
+            ips += [IPAddr(field) for field in [match.nw_src, match.nw_dst] if field is not None]
+            for ip in ips:
+                if ip in self.arpmap and self.arpmap[ip][1] == event.dpid:
+                    self.arpmap.seen(ip)
+        self._rule_bytes[event.dpid] = rule_bytes
+        if self.port_stats_interval <= 0:
+            return #no link utilization to move the elephants to
+
+        previous = self._flow_bytes.get(event.dpid, {})
+        current = {}
+        for stats in event.stats:
+            match = stats.match
+            if match.nw_dst is None or match.tp_dst is not None:
+                continue #the port specific rules of the firewall are not rerouted
+            dstip = IPAddr(match.nw_dst)
+            if match.nw_src is not None: #per-flow rule
+                srcip = IPAddr(match.nw_src)
+                in_port = None
+            elif match.in_port is not None and stats.priority == PROACTIVE_PRIORITY and len(self.arpmap.at_port(event.dpid, match.in_port)) > 0:
+                srcip = self.arpmap.at_port(event.dpid, match.in_port)[0] #proactive rule of the host on that port
+                in_port = match.in_port
+            else:
+                continue
+            if srcip not in self.arpmap or self.arpmap[srcip][1] != event.dpid:
+                continue #not the ingress switch of the flow
+            flow = (srcip, dstip, 6 if match.nw_proto == 6 else 17)
+            duration = stats.duration_sec + stats.duration_nsec / 1e9
+            current[(flow, in_port)] = (stats.byte_count, duration)
+            last = previous.get((flow, in_port))
+            if last is None or duration <= last[1] or stats.byte_count < last[0]:
+                continue
+            rate = (stats.byte_count - last[0]) / (duration - last[1])
+            if rate >= ELEPHANT_THRESHOLD:
+                self.reroute_elephant(flow, in_port, rate)
+        self._flow_bytes[event.dpid] = current
+
+        #forget the paths of the per-flow rules that have expired at this ingress switch
+        for flow in list(self.flow_paths.keys()):
+            if self.flow_paths[flow][0] == event.dpid and (flow, None) not in current:
+                del self.flow_paths[flow]
+
+    def proactive_path(self, src_dpid, in_port, dst_dpid, dstip):
+        #the path the destination based rules give to the packets entering src_dpid from in_port
+        path = [src_dpid]
+        while path[-1] != dst_dpid:
+            next_hops = self.routes.get_next_hops(path[-1], dst_dpid)
+            if not next_hops:
+                return None
+            next_hop = next_hops[(in_port + dstip.toUnsigned()) % len(next_hops)] if len(next_hops) > 1 else next_hops[0]
+            in_port = self.sw_sw_ports[(next_hop, path[-1])]
+            path.append(next_hop)
+        return path
+
+    def reroute_elephant(self, flow, in_port, rate):
+        (srcip, dstip, protonum) = flow
+        if not self.paths_settled():
+            return #the routes (and sw_sw_ports) disagree until a link change is recomputed
+        if time.time() - self.elephants.get(flow, 0) < ELEPHANT_HOLD_TIME or dstip not in self.arpmap:
+            return
+        if self.migration_capability and (dstip in self.old_migrated_IPs or srcip in self.new_migrated_IPs):
+            return #the migrated flows rewrite their headers on the way
+        src_dpid = self.arpmap[srcip][1]
+        (dst_mac, dst_dpid, dst_port) = self.arpmap[dstip]
+        if in_port is None:
+            old_path = self.flow_paths.get(flow)
+        else:
+            old_path = self.proactive_path(src_dpid, in_port, dst_dpid, dstip)
+        if old_path is None or len(old_path) < 3:
+            return #no equal cost alternative
+
+        #judge the links without the elephant's own load, and move it only to a strictly less loaded path
+        old_links = set(zip(old_path[:-1], old_path[1:]))
+        def cost_without_flow(dpid1, dpid2):
+            link_rate = self.link_rate.get((dpid1, dpid2), 0)
+            if (dpid1, dpid2) in old_links:
+                link_rate = max(0, link_rate - rate)
+            return int(link_rate / LINK_RATE_QUANTUM)
+        new_path = self.routes.least_loaded_path(src_dpid, dst_dpid, flow_hash(srcip, dstip, protonum), cost_without_flow)
+        if max(map(cost_without_flow, new_path[:-1], new_path[1:])) >= max(map(cost_without_flow, old_path[:-1], old_path[1:])):
+            return
+
+        print("\033[35mRerouting elephant flow %s -> %s (%.1f Mbit/s): %s -> %s\033[00m" % (srcip, dstip, rate * 8 / 1e6, old_path, new_path))
+        match = of.ofp_match()
+        match.dl_type = 0x0800
+        match.nw_src = srcip
+        match.nw_dst = dstip
+        if protonum == 6: match.nw_proto = 6
+
+        #make before break: the new path is committed, then the ingress switch is redirected
+        #and only once that is committed too the rules that are left off the new path are removed
+        def remove_old_rules():
+            if in_port is None:
+                transaction = self.flow_programmer.transaction(owner = (srcip, dstip))
+                for dpid in old_path[1:]:
+                    if dpid not in new_path and dpid in self.switches:
+                        transaction.add(dpid, self.switches[dpid].delete_flow_rule_strict_msg(match))
+                transaction.commit()
+
+        def redirect_ingress():
+            transaction = self.flow_programmer.transaction(owner = (srcip, dstip), path = new_path)
+            transaction.add(new_path[0], self.switches[new_path[0]].output_flow_rule_msg(self.sw_sw_ports[(new_path[0], new_path[1])], match, 10))
+            transaction.commit(remove_old_rules)
+
+        transaction = self.flow_programmer.transaction(owner = (srcip, dstip), path = new_path)
+        transaction.add(new_path[-1], self.switches[new_path[-1]].output_flow_rule_msg(dst_port, match, 10))
+        for linkindex in range(len(new_path)-2, 0, -1):
+            transaction.add(new_path[linkindex], self.switches[new_path[linkindex]].output_flow_rule_msg(self.sw_sw_ports[(new_path[linkindex], new_path[linkindex+1])], match, 10))
+        transaction.commit(redirect_ingress)
+        self.flow_paths[flow] = new_path
+        self.elephants[flow] = time.time()
+
+    def _handle_BarrierIn(self, event):
+        self.flow_programmer.barrier_in(event.xid)
+
+    def load_share_report(self):
+        #share of the (src IP, dst IP, protocol) flows between the learned hosts that the path selector puts on each link
+        link_flows = {} # key = (dpid1, dpid2), value = number of flows
+        flows = 0
+        for srcip in self.arpmap:
+            for dstip in self.arpmap:
+                if srcip == dstip or srcip in self.ignored_IPs or dstip in self.ignored_IPs:
+                    continue
+                src_dpid = self.arpmap[srcip][1]
+                dst_dpid = self.arpmap[dstip][1]
+                if self.routes.count_paths(src_dpid, dst_dpid) == 0:
+                    continue
+                for protonum in PROTO_NUMS:
+                    path = self.select_path(src_dpid, dst_dpid, flow_hash(srcip, dstip, protonum))
+                    if path is None:
+                        continue
+                    for i in range(len(path) - 1):
+                        link_flows[(path[i], path[i+1])] = link_flows.get((path[i], path[i+1]), 0) + 1
+                    flows += 1
+        return dict((link, float(count) / flows) for (link, count) in link_flows.items())
+
+    def print_load_share(self):
         if not self._paths_computed:
-            self._paths_computed = ShortestPaths(self.switches, self.adjs)
+            return
+        report = self.load_share_report()
+        print("\033[36mLoad share of the inter-switch links (%d links used):\033[00m" % (len(report)))
+        for link in sorted(report.keys()):
+            print("\033[36m  %s -> %s : %5.1f%% of the flows\033[00m" % (link[0], link[1], 100 * report[link]))
+        occupancy = self.flow_db.occupancy()
+        print("\033[36mRules installed per switch: %s\033[00m" % (", ".join("%s=%d" % (dpid, occupancy[dpid]) for dpid in sorted(occupancy.keys()))))
+
+    def checkPaths(self):
+        self._paths_computed = self.routing.update(self.switches, self.adjs)
         return self._paths_computed
 
     def __str__(self):
         return "Cloud Network Controller"
 
 class SwitchWithPaths (EventMixin):
-    def __init__(self):
+    def __init__(self, routes, flow_db):
         self.connection = None
         self.dpid = None
         self.ports = None
+        self.host_ports = set() #ports facing hosts (not part of a discovered link)
         self._listeners = None
-        self._paths = {}
-        self._paths_per_proto = {}
+        self.routes = routes #the shared NextHopPaths of the fabric
+        self.flow_db = flow_db #the shared FlowDatabase
 
     def __repr__(self):
         return str(self.dpid)
 
-    def appendPaths(self, dst, paths_list):
-        if dst not in self._paths:
-            self._paths[dst] = []
-        self._paths[dst] = paths_list
-        self.getPathsperProto(dst)
-
-    def clearPaths(self):
-        self._paths = {}
-        self._paths_per_proto = {}
-
-    def getPathsperProto(self, dst):
-        self._paths_per_proto[dst] = {}
-        # populate the per-protocol paths
-        list_of_proto_nums = sorted(list(PROTO_NUMS.keys()))
-        for proto_num in list_of_proto_nums:
-            self._paths_per_proto[dst][proto_num] = []         
-        for i,path in enumerate(self._paths[dst]):
-            proto_num = list_of_proto_nums[i % len(PROTO_NUMS)]
-            self._paths_per_proto[dst][proto_num].append(self._paths[dst][i])
-        # if no paths for a specific protocol, get one from the pool randomly
-        for proto_num in list_of_proto_nums:
-            if len(self._paths_per_proto[dst][proto_num]) == 0:
-                self._paths_per_proto[dst][proto_num] = [random.choice(self._paths[dst])]
-
     def printPaths(self):
-        for dst in self._paths:
-            equal_paths_number = len(self._paths[dst])
+        for dst in self.routes.destinations():
+            equal_paths_number = self.routes.count_paths(self.dpid, dst)
+            if equal_paths_number == 0:
+                continue
             if equal_paths_number > 1:
                 print("There are %i shortest paths from switch %i to switch %i:" % (equal_paths_number, self.dpid, dst))
             else:
                 print("There is exactly one shortest path from switch %i to switch %i:" % (self.dpid, dst))
-            for proto_num in self._paths_per_proto[dst]:
-                print("---%s (%s) paths---" % (str(PROTO_NUMS[proto_num]), str(proto_num)))
-                for path in self._paths_per_proto[dst][proto_num]:
-                    for u in path:
-                        print("%i," % (u),)
-                    print("")
+            for k in range(equal_paths_number):
+                print(",".join("%i" % (u) for u in self.routes.get_path(self.dpid, dst, k)))
 
     def connect(self, connection):
         if self.dpid is None:
@@ -571,17 +1404,19 @@ class SwitchWithPaths (EventMixin):
             self.connection = None
             self._listeners = None
 
-    def flood_on_switch_edge(self, packet, no_flood_ports): #CP CODE
-        # debug("flooding given packet on all switch edges (sw:%d)" % (self.dpid))
-        
-        for port in self.ports:
-            # debug("DC: %s in %s"%(port.port_no,no_flood_ports))
-            if (port.port_no in no_flood_ports) or (port.port_no == 65534):
-                # debug("no_flood_port detected (%d)"%port.port_no)
-                continue
-            # debug("forwarding packet to port: "+str(port))
-            self.send_packet(port.port_no, packet)
-        
+    def physical_ports(self):
+        return set(port.port_no for port in self.ports if port.port_no < MAX_PHYS_PORTS)
+
+    def flood_on_switch_edge(self, packet, no_flood_port=None): #CP CODE
+        #a single packet out with an output action per host port
+        msg = of.ofp_packet_out(in_port=of.OFPP_NONE)
+        msg.data = packet
+        for port in sorted(self.host_ports):
+            if port != no_flood_port:
+                msg.actions.append(of.ofp_action_output(port=port))
+        if len(msg.actions) > 0:
+            self.connection.send(msg)
+
     def send_packet(self, outport, packet_data=None):
         msg = of.ofp_packet_out(in_port=of.OFPP_NONE)
         msg.data = packet_data
@@ -611,23 +1446,43 @@ class SwitchWithPaths (EventMixin):
         arpprint("Sending arp packet (%s) to port %s"%(str(e),str(dst_port)))
         self.send_packet(dst_port,e.pack())
 
-    def install_output_flow_rule(self, outport, match, idle_timeout=0, hard_timeout=0):
+    def install_output_flow_rule(self, outport, match, idle_timeout=0, hard_timeout=0, priority=of.OFP_DEFAULT_PRIORITY):
+        msg = self.output_flow_rule_msg(outport, match, idle_timeout, hard_timeout, priority)
+        self.flow_db.track(self.dpid, msg)
+        self.connection.send(msg)
+
+    # the *_msg methods build the flow mods for a FlowProgrammer transaction
+    def output_flow_rule_msg(self, outport, match, idle_timeout=0, hard_timeout=0, priority=of.OFP_DEFAULT_PRIORITY):
         msg=of.ofp_flow_mod()
         msg.match = match
         msg.command = of.OFPFC_MODIFY_STRICT
         msg.idle_timeout = idle_timeout
         msg.hard_timeout = hard_timeout
+        msg.priority = priority
         msg.actions.append(of.ofp_action_output(port=outport))
-        self.connection.send(msg)
+        return msg
+
+    def delete_flow_rule_strict_msg(self, match, priority=of.OFP_DEFAULT_PRIORITY):
+        msg=of.ofp_flow_mod()
+        msg.match = match
+        msg.command = of.OFPFC_DELETE_STRICT #only the rule with exactly this match and priority
+        msg.priority = priority
+        return msg
 
     def install_drop_flow_rule(self, match, idle_timeout=0, hard_timeout=0):
+        msg = self.drop_flow_rule_msg(match, idle_timeout, hard_timeout)
+        self.flow_db.track(self.dpid, msg)
+        self.connection.send(msg)
+
+    def drop_flow_rule_msg(self, match, idle_timeout=0, hard_timeout=0, priority=of.OFP_DEFAULT_PRIORITY):
         msg=of.ofp_flow_mod()
         msg.match = match
         msg.command = of.OFPFC_MODIFY_STRICT
         msg.idle_timeout = idle_timeout
         msg.hard_timeout = hard_timeout
+        msg.priority = priority
         msg.actions = [] #empty action list for dropping packets
-        self.connection.send(msg)
+        return msg
 
     '''DEBUG: {'src': EthAddr('00:00:00:00:00:02'), 'hdr_len': 14, 'dst': EthAddr('00:00:00:00:00:04'), 'payload_len': 84, 'next': <pox.lib.packet.ipv4.ipv4 object at 0xa94efec>, 'prev': None, 'type': 2048, 'parsed': True}
     DEBUG: {'frag': 0, 'csum': 42839, 'dstip': IPAddr('10.0.0.4'), 'protocol': 1, 'srcip': IPAddr('10.0.0.2'), 'tos': 0, 'ttl': 64, 'iplen': 84, 'next': <pox.lib.packet.icmp.icmp object at 0xa94ef4c>, 'flags': 0, 'hl': 5, 'v': 4, 'id': 48972, 'prev': <pox.lib.packet.ethernet.ethernet object at 0xa94ef8c>, 'parsed': True}'''
@@ -646,7 +1501,7 @@ class SwitchWithPaths (EventMixin):
 
         self.send_packet(outport, packet_data)
         
-    def install_forward_migration_rule(self, outport, dst_mac, dst_ip, match, idle_timeout=0, hard_timeout=0):#CP CODE
+    def forward_migration_rule_msg(self, outport, dst_mac, dst_ip, match, idle_timeout=0, hard_timeout=0):#CP CODE
         migrationprint("Installed rewriting rule to switch %s for migrated address: %s through port %s" %(str(self.dpid), str(dst_ip), str(outport)))
         
         msg = of.ofp_flow_mod()
@@ -659,9 +1514,9 @@ class SwitchWithPaths (EventMixin):
         msg.actions.append(of.ofp_action_dl_addr.set_dst(EthAddr(dst_mac)))#mac address of the chosen server
         msg.actions.append(of.ofp_action_output(port = outport)) #and send it to the chosen server's port
 
-        self.connection.send(msg)
+        return msg
 
-    def install_reverse_migration_rule(self, outport, src_mac, src_ip, match, idle_timeout=0, hard_timeout=0):#CP CODE
+    def reverse_migration_rule_msg(self, outport, src_mac, src_ip, match, idle_timeout=0, hard_timeout=0):#CP CODE
         migrationprint("Installed \033[04mreturn\033[00m\033[35m rewriting rule to switch %s for migrated address: %s through port %s" %(str(self.dpid), str(src_ip), str(outport)))
         
         msg = of.ofp_flow_mod()
@@ -673,11 +1528,540 @@ class SwitchWithPaths (EventMixin):
         msg.actions.append(of.ofp_action_dl_addr.set_src(EthAddr(src_mac)))#mac address of the chosen server
         msg.actions.append(of.ofp_action_output(port = outport)) #and send it to the chosen server's port
 
-        self.connection.send(msg)
-        pass
+        return msg
+
+
+class HostMoved(Event):
+    def __init__(self, ip, old_location, new_location):
+        Event.__init__(self)
+        self.ip = ip
+        self.old_location = old_location # (mac, dpid, port)
+        self.new_location = new_location
+
+class HostExpired(Event):
+    def __init__(self, ip, location, reason):
+        Event.__init__(self)
+        self.ip = ip
+        self.location = location # (mac, dpid, port) where the host was last seen
+        self.reason = reason
+
+#the arpmap (key = host IP, value = (mac, dpid, port)) indexed by switch and by switch port, so that the hosts behind
+#a failed switch or port are found in time proportional to their number; learn() raises HostMoved when a host shows up
+#somewhere else and the expire methods raise HostExpired, for the controller and any other component listening
+class HostLocations(dict, EventMixin):
+    _eventMixin_events = set([HostMoved, HostExpired])
+
+    def __init__(self, timeout=0):
+        dict.__init__(self)
+        self.by_dpid = {} # key = dpid, value = set of IPs
+        self.by_port = {} # key = (dpid, port), value = set of IPs
+        self.timeout = timeout #seconds a host is kept without being seen again, 0 keeps it until its switch/port fails
+        self.last_seen = OrderedDict() # key = IP, value = time it was last seen (least recently seen first)
+
+    def __setitem__(self, ip, location):
+        self._unindex(ip)
+        dict.__setitem__(self, ip, location)
+        (mac, dpid, port) = location
+        self.by_dpid.setdefault(dpid, set()).add(ip)
+        self.by_port.setdefault((dpid, port), set()).add(ip)
+        self.last_seen.pop(ip, None)
+        self.last_seen[ip] = time.time()
+
+    def __delitem__(self, ip):
+        self._unindex(ip)
+        dict.__delitem__(self, ip)
+        self.last_seen.pop(ip, None)
+
+    def pop(self, ip, *default):
+        if ip not in self:
+            return dict.pop(self, ip, *default)
+        location = self[ip]
+        del self[ip]
+        return location
+
+    def _unindex(self, ip):
+        location = self.get(ip)
+        if location is None:
+            return
+        (mac, dpid, port) = location
+        for (index, key) in [(self.by_dpid, dpid), (self.by_port, (dpid, port))]:
+            ips = index.get(key)
+            if ips is not None:
+                ips.discard(ip)
+                if len(ips) == 0:
+                    del index[key]
+
+    #a host known to be alive (e.g. its rules count traffic) without being seen by the controller
+    def seen(self, ip):
+        if ip in self.last_seen:
+            self.last_seen.pop(ip)
+            self.last_seen[ip] = time.time()
+
+    #a host seen at location, returns True if it is new there
+    def learn(self, ip, location):
+        old_location = self.get(ip)
+        self[ip] = location
+        if old_location == location:
+            return False
+        if old_location is not None:
+            self.raiseEvent(HostMoved, ip, old_location, location)
+        return True
+
+    def dpids(self):
+        return list(self.by_dpid.keys())
+
+    def at_dpid(self, dpid):
+        return list(self.by_dpid.get(dpid, ()))
+
+    def at_port(self, dpid, port):
+        return list(self.by_port.get((dpid, port), ()))
+
+    def expire(self, ip, reason):
+        location = self[ip]
+        del self[ip]
+        self.raiseEvent(HostExpired, ip, location, reason)
 
+    def expire_dpid(self, dpid, reason):
+        for ip in self.at_dpid(dpid):
+            self.expire(ip, reason)
+
+    def expire_port(self, dpid, port, reason):
+        for ip in self.at_port(dpid, port):
+            self.expire(ip, reason)
+
+    def expire_idle(self):
+        if self.timeout <= 0:
+            return
+        deadline = time.time() - self.timeout
+        while len(self.last_seen) > 0:
+            ip = next(iter(self.last_seen))
+            if self.last_seen[ip] > deadline:
+                break
+            self.expire(ip, "not seen for %s seconds" % (self.timeout))
+
+
+class FlowEntry(object):
+    def __init__(self, dpid, match, priority, idle_timeout, hard_timeout, owner, path, actions, cookie):
+        self.dpid = dpid
+        self.match = match
+        self.priority = priority
+        self.actions = actions
+        self.cookie = cookie # unique per install, tells the FlowRemoved of this rule from one of a rule it replaced
+        self.idle_timeout = idle_timeout
+        self.hard_timeout = hard_timeout
+        self.owner = owner # (src IP, dst IP) of the host pair, either may be None (e.g. a destination based rule)
+        self.path = path   # switches of the path the rule belongs to (None for a rule that is not part of a path)
+        self.installed = time.time()
+
+#every rule the controller has installed, indexed by switch, by the IPs of its owner and by the links of its path;
+#the rules are installed with OFPFF_SEND_FLOW_REM, so the FlowRemoved messages (expiry/deletion) keep it in sync
+class FlowDatabase(object):
+    def __init__(self):
+        self.next_cookie = 1
+        self.entries = {} # key = (dpid, priority, packed match), value = FlowEntry
+        self.by_dpid = {} # key = dpid, value = set of entry keys
+        self.by_ip = {}   # key = IP, value = set of entry keys (whose owner has that source/destination IP)
+        self.by_link = {} # key = (dpid1, dpid2), value = set of entry keys (whose path crosses the link)
+
+    def _key(self, dpid, match, priority):
+        return (dpid, priority, match.pack())
+
+    def _index(self, entry):
+        indexes = [(self.by_dpid, entry.dpid)]
+        if entry.owner is not None:
+            indexes += [(self.by_ip, ip) for ip in set(entry.owner) if ip is not None]
+        if entry.path is not None:
+            indexes += [(self.by_link, link) for link in zip(entry.path[:-1], entry.path[1:])]
+        return indexes
+
+    # record a flow mod about to be sent to dpid
+    def track(self, dpid, msg, owner=None, path=None):
+        if msg.command in [of.OFPFC_ADD, of.OFPFC_MODIFY, of.OFPFC_MODIFY_STRICT]:
+            msg.flags |= of.OFPFF_SEND_FLOW_REM
+            msg.cookie = self.next_cookie #a modify carries it to the existing rule too (as Open vSwitch does for OpenFlow 1.0)
+            self.next_cookie += 1
+            key = self._key(dpid, msg.match, msg.priority)
+            self.remove_key(key)
+            entry = FlowEntry(dpid, msg.match, msg.priority, msg.idle_timeout, msg.hard_timeout, owner, path, list(msg.actions), msg.cookie)
+            self.entries[key] = entry
+            for (index, value) in self._index(entry):
+                index.setdefault(value, set()).add(key)
+        elif msg.command == of.OFPFC_DELETE_STRICT:
+            self.remove(dpid, msg.match, msg.priority)
+        #the rules removed by a non strict delete are reported by their FlowRemoved messages
+
+    def remove(self, dpid, match, priority):
+        self.remove_key(self._key(dpid, match, priority))
+
+    # a rule was reported removed, ignored if the rule has been installed again since (its cookie changed)
+    def removed(self, dpid, match, priority, cookie):
+        key = self._key(dpid, match, priority)
+        entry = self.entries.get(key)
+        if entry is not None and entry.cookie == cookie:
+            self.remove_key(key)
+
+    def get(self, dpid, match, priority):
+        return self.entries.get(self._key(dpid, match, priority))
+
+    def remove_key(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for (index, value) in self._index(entry):
+            keys = index.get(value)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del index[value]
+
+    def remove_dpid(self, dpid):
+        for key in list(self.by_dpid.get(dpid, ())):
+            self.remove_key(key)
+
+    def on_dpid(self, dpid):
+        return [self.entries[key] for key in self.by_dpid.get(dpid, ())]
+
+    def of_ip(self, ip):
+        return [self.entries[key] for key in self.by_ip.get(ip, ())]
+
+    def on_link(self, dpid1, dpid2):
+        return [self.entries[key] for key in self.by_link.get((dpid1, dpid2), ())]
+
+    def occupancy(self):
+        return dict((dpid, len(keys)) for (dpid, keys) in self.by_dpid.items())
+
+#a flow whose path is being installed and the packets waiting for it
+class PendingFlow(object):
+    def __init__(self, packet, release, args):
+        self.packets = [packet]
+        self.release = release
+        self.args = args
+        self.deadline = time.time() + BARRIER_TIMEOUT #the transaction gives up on the packets by then
+
+
+#programs the rules of a path: the flow mods of each switch are packed into a single write followed by a
+#barrier request, and the commit callback (e.g. releasing the packet) runs once every switch has answered
+class FlowProgrammer(object):
+    def __init__(self, switches, flow_db):
+        self.switches = switches
+        self.flow_db = flow_db
+        self.pending = {} # key = barrier xid, value = FlowTransaction waiting for it
+        Timer(BARRIER_TIMEOUT, self.expire, recurring = True)
+
+    # owner = (src IP, dst IP) and path of the rules, as recorded in the flow database
+    def transaction(self, owner=None, path=None):
+        return FlowTransaction(self, owner, path)
+
+    def barrier_in(self, xid):
+        transaction = self.pending.pop(xid, None)
+        if transaction is not None:
+            transaction.barrier_in(xid)
+
+    def expire(self):
+        now = time.time()
+        for (xid, transaction) in list(self.pending.items()):
+            if transaction.deadline <= now:
+                del self.pending[xid]
+                transaction.expire()
+
+class FlowTransaction(object):
+    def __init__(self, programmer, owner=None, path=None):
+        self.programmer = programmer
+        self.owner = owner
+        self.path = path
+        self.messages = OrderedDict() # key = dpid, value = list of (flow mod, owner, path) (in the order they were added)
+        self.waiting = set()          # xids of the barriers not answered yet
+        self.callback = None
+        self.deadline = None
+
+    # owner/path default to the ones of the transaction
+    def add(self, dpid, msg, owner=None, path=None):
+        self.messages.setdefault(dpid, []).append((msg, owner or self.owner, path or self.path))
+
+    def commit(self, callback=None, *args):
+        if callback is not None:
+            self.callback = (callback, args)
+        self.deadline = time.time() + BARRIER_TIMEOUT
+        for (dpid, msgs) in self.messages.items():
+            sw = self.programmer.switches.get(dpid)
+            if sw is None or sw.connection is None:
+                continue
+            for (msg, owner, path) in msgs:
+                self.programmer.flow_db.track(dpid, msg, owner, path)
+            data = b"".join(msg.pack() for (msg, owner, path) in msgs)
+            if self.callback is not None:
+                barrier = of.ofp_barrier_request()
+                data += barrier.pack()
+                self.waiting.add(barrier.xid)
+                self.programmer.pending[barrier.xid] = self
+            sw.connection.send(data)
+        if len(self.waiting) == 0:
+            self.finish()
+
+    def barrier_in(self, xid):
+        self.waiting.discard(xid)
+        if len(self.waiting) == 0:
+            self.finish()
+
+    def expire(self):
+        if self.callback is not None:
+            warrning("Barrier replies missing after %s seconds, the path is not confirmed" % (BARRIER_TIMEOUT))
+            self.callback = None #the packet is not released, the host will retransmit it
+
+    def finish(self):
+        if self.callback is not None:
+            (callback, args) = self.callback
+            self.callback = None
+            callback(*args)
+
+
+#local control API: a unix socket accepting one JSON request per line and answering one JSON response per line, e.g.
+#  echo '{"op": "dump_arpmap"}' | nc -U /tmp/cloudnet.sock
+#the requests are read by a thread of their own and handed to the POX thread, where handler applies them
+class ControlServer(object):
+    def __init__(self, path, handler):
+        self.path = path
+        self.handler = handler
+        if os.path.exists(path):
+            os.unlink(path) #left over by a previous run
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        os.chmod(path, 0o600) #only the user running the controller may control it
+        self.sock.listen(4)
+        self.thread = threading.Thread(target = self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+        print("\033[32mControl API listening on %s\033[00m" % (path))
+
+    def serve(self):
+        while True:
+            (connection, address) = self.sock.accept()
+            try:
+                for line in connection.makefile('r'):
+                    if line.strip() == '':
+                        continue
+                    connection.sendall((json.dumps(self.request(line)) + "\n").encode())
+            except socket.error as e:
+                warrning("Control API connection closed: %s" % (str(e)))
+            finally:
+                connection.close()
+
+    def request(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return {'ok': False, 'error': "invalid JSON: %s" % (str(e))}
+        if not isinstance(request, dict):
+            return {'ok': False, 'error': "the request must be a JSON object"}
+        done = threading.Event()
+        response = {}
+        def apply():
+            try:
+                response.update(self.handler(request))
+            except Exception as e:
+                traceback.print_exc()
+                response.update({'ok': False, 'error': "%s: %s" % (type(e).__name__, str(e))})
+            done.set()
+        core.callLater(apply)
+        if not done.wait(CONTROL_REQUEST_TIMEOUT):
+            return {'ok': False, 'error': "timed out waiting for the controller"}
+        return response
+
+
+#detect the tier of each switch of a clean Clos fabric (as built by clos_topo.py): cores and edges are linked
+#to every aggregation switch and to nothing else, so the fabric is a complete bipartite graph
+#returns a dict (key = dpid, value = 'core'/'aggr'/'edge') or None if the topology is not a clean Clos
+def detect_clos_tiers(adjs):
+    nodes = list(adjs.keys())
+    if len(nodes) < 2:
+        return None
+
+    #2-color the graph, a clean Clos is connected and bipartite
+    side = {nodes[0]: 0}
+    queue = [nodes[0]]
+    while queue:
+        dpid = queue.pop()
+        for neighbor in adjs[dpid]:
+            if neighbor not in adjs:
+                return None
+            if neighbor not in side:
+                side[neighbor] = 1 - side[dpid]
+                queue.append(neighbor)
+            elif side[neighbor] == side[dpid]:
+                return None
+    if len(side) != len(nodes):
+        return None
+
+    #and complete: every switch is linked to the whole other side
+    sides = (set(dpid for dpid in nodes if side[dpid] == 0), set(dpid for dpid in nodes if side[dpid] == 1))
+    for dpid in nodes:
+        if adjs[dpid] != sides[1 - side[dpid]]:
+            return None
+
+    #the aggregation layer (c*f switches) is smaller than the cores and edges together (c + c*f*f switches)
+    aggr = sides[0] if len(sides[0]) < len(sides[1]) else sides[1]
+    tiers = {}
+    for dpid in nodes:
+        if dpid in aggr:
+            tiers[dpid] = 'aggr'
+        elif dpid < min(aggr): #clos_topo.py numbers the cores before the aggregation and edge switches
+            tiers[dpid] = 'core'
+        else:
+            tiers[dpid] = 'edge'
+    return tiers
+
+#the equal cost shortest paths of the whole fabric, kept as a next hop DAG per destination: an array with the
+#hop distance of every switch and the (interned, so shared) tuple of its next hops; paths are generated on demand
+class NextHopPaths(object):
+    def __init__(self):
+        self.dpids = []      # position in the per-destination arrays -> dpid
+        self.index = {}      # key = dpid, value = position in the per-destination arrays
+        self.dist = {}       # key = dst dpid, value = array of hops towards dst (-1 if unreachable)
+        self.next_hops = {}  # key = dst dpid, value = list (per position) of the next hops towards dst
+        self.counts = {}     # key = dst dpid, value = list (per position) of the number of shortest paths, filled on demand
+        self.shared = {}     # interned next hop tuples, every distinct set is stored once
+
+    def reset(self, dpids):
+        self.dpids = sorted(dpids)
+        self.index = dict((dpid, i) for (i, dpid) in enumerate(self.dpids))
+        self.dist = {}
+        self.next_hops = {}
+        self.counts = {}
+        self.shared = {}
+
+    def destinations(self):
+        return sorted(self.dist.keys())
+
+    # dist: dict (key = dpid, value = hops towards dst), next_hops: dict (key = dpid, value = tuple of next hops)
+    def set_destination(self, dst, dist, next_hops):
+        hops = array('i', [-1]) * len(self.dpids)
+        per_position = [None] * len(self.dpids)
+        for (dpid, hop) in dist.items():
+            hops[self.index[dpid]] = hop
+        for (dpid, next_hop) in next_hops.items():
+            per_position[self.index[dpid]] = self.shared.setdefault(next_hop, next_hop)
+        self.dist[dst] = hops
+        self.next_hops[dst] = per_position
+        self.counts.pop(dst, None)
+
+    def set_destination_from_distances(self, dst, dist, adjs):
+        next_hops = {}
+        for (dpid, hop) in dist.items():
+            if hop > 0:
+                next_hops[dpid] = tuple(sorted(neighbor for neighbor in adjs[dpid] if dist.get(neighbor) == hop - 1))
+        self.set_destination(dst, dist, next_hops)
+
+    def remove_destination(self, dst):
+        self.dist.pop(dst, None)
+        self.next_hops.pop(dst, None)
+        self.counts.pop(dst, None)
+
+    def get_next_hops(self, src, dst):
+        if self.distance(src, dst) is None:
+            return None
+        return self.next_hops[dst][self.index[src]]
+
+    def distance(self, src, dst):
+        if dst not in self.dist or src not in self.index:
+            return None
+        hop = self.dist[dst][self.index[src]]
+        if hop < 0:
+            return None
+        return hop
+
+    def _counts(self, dst):
+        counts = self.counts.get(dst)
+        if counts is None:
+            hops = self.dist[dst]
+            counts = [0] * len(self.dpids)
+            for i in sorted((i for i in range(len(self.dpids)) if hops[i] >= 0), key = lambda i: hops[i]):
+                if hops[i] == 0:
+                    counts[i] = 1
+                else:
+                    counts[i] = sum(counts[self.index[next_hop]] for next_hop in self.next_hops[dst][i])
+            self.counts[dst] = counts
+        return counts
+
+    def count_paths(self, src, dst):
+        if self.distance(src, dst) is None:
+            return 0
+        return self._counts(dst)[self.index[src]]
+
+    #the k-th (0 <= k < count_paths) shortest path from src to dst, walking down the DAG without enumerating the others
+    def get_path(self, src, dst, k):
+        counts = self._counts(dst)
+        path = [src]
+        while path[-1] != dst:
+            for next_hop in self.next_hops[dst][self.index[path[-1]]]:
+                if k < counts[self.index[next_hop]]:
+                    break
+                k -= counts[self.index[next_hop]]
+            path.append(next_hop)
+        return path
+
+    #the path of a flow, its hash spreads the flows evenly over the equal cost paths
+    def select_path(self, src, dst, hash_value):
+        return self.get_path(src, dst, hash_value % self.count_paths(src, dst))
+
+    #the equal cost path whose busiest link (by link_cost(dpid1, dpid2)) is the least loaded one,
+    #the paths that tie are picked by the flow hash as in select_path
+    def least_loaded_path(self, src, dst, hash_value, link_cost):
+        counts = self._counts(dst)
+        next_hops = self.next_hops[dst]
+        bottleneck = {dst: 0}
+        def solve(dpid):
+            if dpid not in bottleneck:
+                bottleneck[dpid] = min(max(link_cost(dpid, next_hop), solve(next_hop)) for next_hop in next_hops[self.index[dpid]])
+            return bottleneck[dpid]
+
+        path = [src]
+        k = hash_value
+        while path[-1] != dst:
+            dpid = path[-1]
+            best = solve(dpid)
+            tied = [next_hop for next_hop in next_hops[self.index[dpid]] if max(link_cost(dpid, next_hop), solve(next_hop)) == best]
+            k %= sum(counts[self.index[next_hop]] for next_hop in tied)
+            for next_hop in tied:
+                if k < counts[self.index[next_hop]]:
+                    break
+                k -= counts[self.index[next_hop]]
+            path.append(next_hop)
+        return path
+
+#generate the equal cost shortest paths of a clean Clos fabric without any graph search: linked switches
+#meet directly, two aggregation switches through any core/edge switch and the rest through any aggregation switch
+#returns False if the topology is not a clean Clos
+def ClosShortestPaths(routes, switches, adjs):
+    tiers = detect_clos_tiers(adjs)
+    if tiers is None or any(switch not in tiers for switch in switches):
+        return False
+
+    aggr = tuple(sorted(dpid for dpid in tiers if tiers[dpid] == 'aggr'))
+    others = tuple(sorted(dpid for dpid in tiers if tiers[dpid] != 'aggr'))
+    routes.reset(tiers.keys())
+    for target in tiers:
+        dist = {target: 0}
+        next_hops = {}
+        for switch in tiers:
+            if switch == target:
+                continue
+            elif switch in adjs[target]:
+                dist[switch] = 1
+                next_hops[switch] = (target,)
+            else:
+                dist[switch] = 2
+                next_hops[switch] = others if tiers[switch] == 'aggr' else aggr
+        routes.set_destination(target, dist, next_hops)
+    return True
+
+def ShortestPaths(routes, switches, adjs, targets = None):#CP CODE
+    #a clean Clos fabric has closed form paths, the graph search is only the fallback
+    if targets is None:
+        if ClosShortestPaths(routes, switches, adjs):
+            return True
+        routes.reset(set(adjs.keys()) | set(switches.keys()))
+        targets = routes.dpids
 
-def ShortestPaths(switches, adjs):#CP CODE
     topograph = nx.Graph()
 
     for dpid in adjs:
@@ -685,15 +2069,347 @@ def ShortestPaths(switches, adjs):#CP CODE
         for neighbor in adjs.get(dpid):
             topograph.add_edge(dpid, neighbor)
 
-    for switch in switches:
-        for target in switches:
-            try:
-                switches[switch].appendPaths(target, list(nx.all_shortest_paths(topograph,switch,target)))
-            except nx.NetworkXNoPath:
-                pass
+    for target in targets:
+        if target in topograph:
+            routes.set_destination_from_distances(target, nx.single_source_shortest_path_length(topograph, target), adjs)
+        else:
+            routes.set_destination(target, {target: 0}, {})
 
     return True
-    
+
+class IncrementalShortestPaths(object):
+    #uses the hop distances kept in the path store, so that after a batch of link changes
+    #only the destinations whose distances/shortest paths may have changed are recomputed
+    def __init__(self, routes):
+        self.routes = routes
+        self.changed_links = set()   # links added/removed since the last update
+        self.known_switches = None   # switches of the last update (a new/gone switch means a full update)
+
+    def link_changed(self, dpid1, dpid2):
+        self.changed_links.add((dpid1, dpid2))
+
+    def update(self, switches, adjs):
+        changed_links = self.changed_links
+        self.changed_links = set()
+
+        current_switches = set(adjs.keys()) | set(switches.keys())
+        if self.known_switches != current_switches:
+            self.known_switches = current_switches
+            return ShortestPaths(self.routes, switches, adjs)
+
+        #a link can only be (or have been) on a shortest path towards dst if its ends are at different distances
+        affected = []
+        for dst in self.routes.dpids:
+            for (dpid1, dpid2) in changed_links:
+                if self.routes.distance(dpid1, dst) != self.routes.distance(dpid2, dst):
+                    affected.append(dst)
+                    break
+        return ShortestPaths(self.routes, switches, adjs, affected)
+
+def in_prefix(addr, network, length):
+    return (addr >> (32 - length)) == (network >> (32 - length))
+
+def prefixes_overlap(prefix1, prefix2):
+    return in_prefix(prefix1[0], prefix2[0], min(prefix1[1], prefix2[1]))
+
+def parse_prefix(text):
+    #'*', 'a.b.c.d' or 'a.b.c.d/len' -> (network as unsigned int, prefix length)
+    text = text.strip()
+    if text == '*':
+        return (0, 0)
+    if '/' in text:
+        (ip, length) = text.split('/')
+        length = int(length)
+    else:
+        (ip, length) = (text, 32)
+    if length < 0 or length > 32:
+        raise ValueError("invalid prefix length: %s" % (text))
+    network = IPAddr(ip).toUnsigned()
+    if length < 32:
+        network = (network >> (32 - length)) << (32 - length)
+    return (network, length)
+
+def parse_protocol(text):
+    text = text.strip().lower()
+    if text in ['', '*']:
+        return None
+    if text in IP_PROTOCOLS:
+        return IP_PROTOCOLS[text]
+    return int(text)
+
+def parse_ports(text):
+    #'*', 'port' or 'first-last' -> (first, last)
+    text = text.strip()
+    if text in ['', '*']:
+        return (0, 0xFFFF)
+    if '-' in text:
+        (first, last) = text.split('-')
+        return (int(first), int(last))
+    return (int(text), int(text))
+
+#binary radix trie over IPv4 prefixes, a lookup returns the values of every prefix covering an address
+#(from the shortest to the longest prefix)
+class PrefixTrie(object):
+    def __init__(self):
+        self.root = [None, None, []] # [child for bit 0, child for bit 1, values of the prefix ending here]
+
+    def insert(self, network, length, value):
+        node = self.root
+        for i in range(length):
+            bit = (network >> (31 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, []]
+            node = node[bit]
+        node[2].append(value)
+
+    def covering(self, addr):
+        node = self.root
+        values = list(node[2])
+        for i in range(32):
+            node = node[(addr >> (31 - i)) & 1]
+            if node is None:
+                break
+            values.extend(node[2])
+        return values
+
+#the firewall policy: tenants made of IPs/prefixes (the traffic within a tenant is allowed, across tenants denied)
+#plus allow/deny rules on source/destination prefixes, protocol and destination ports, with precedence
+#deny rule > allow rule > tenants. The csv file holds one entry per row:
+#   <tenant id>,<ip or prefix>,<ip or prefix>,...
+#   allow|deny,<src ip/prefix or *>,<dst ip/prefix or *>[,<tcp|udp|icmp|protocol number|*>[,<port|first-last|*>]]
+class FirewallPolicy(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.mtime = None
+        self.load()
+
+    def changed(self):
+        try:
+            return os.stat(self.filename).st_mtime != self.mtime
+        except OSError:
+            return False
+
+    def load(self):
+        self.mtime = os.stat(self.filename).st_mtime
+        tenants = [] # list of (network, length, tenant id)
+        rules = []   # list of (action, src prefix, dst prefix, protocol, (first port, last port))
+        with open(self.filename, 'r') as csvfile:
+            for row in csv.reader(csvfile):
+                row = [field.strip() for field in row]
+                if len(row) == 0 or row[0] == '' or row[0].startswith('#'):
+                    continue
+                (kind, parsed) = parse_policy_row(row)
+                if kind == 'rule':
+                    rules.append(parsed)
+                else:
+                    tenants += parsed
+
+        tenant_trie = PrefixTrie()
+        for (network, length, tenant_id) in tenants:
+            tenant_trie.insert(network, length, tenant_id)
+        src_trie = PrefixTrie()
+        dst_trie = PrefixTrie()
+        for (i, rule) in enumerate(rules):
+            src_trie.insert(rule[1][0], rule[1][1], i)
+            dst_trie.insert(rule[2][0], rule[2][1], i)
+
+        #swap everything at once, the decisions of the previous policy are forgotten
+        (self.tenants, self.rules) = (tenants, rules)
+        (self.tenant_trie, self.src_trie, self.dst_trie) = (tenant_trie, src_trie, dst_trie)
+        self.cache = {}
+
+    def tenant_of(self, ip):
+        tenant_ids = self.tenant_trie.covering(ip.toUnsigned())
+        if len(tenant_ids) == 0:
+            return None
+        return tenant_ids[-1] #the longest prefix wins
+
+    #decide on a packet (protocol None for ARP), returns (allowed, port_specific): allowed is True/False or None for
+    #IPs not covered by the policy, port_specific tells whether rules with a protocol/ports were involved
+    def decide(self, srcip, dstip, protocol=None, dstport=None, srcport=None):
+        key = (srcip, dstip, protocol, dstport, srcport)
+        decision = self.cache.get(key)
+        if decision is not None:
+            return decision
+
+        src_rules = set(self.src_trie.covering(srcip.toUnsigned()))
+        candidates = [self.rules[i] for i in self.dst_trie.covering(dstip.toUnsigned()) if i in src_rules]
+        #the rules of the opposite direction, an allow rule also allows the replies (source port = the allowed port)
+        reply_src_rules = set(self.src_trie.covering(dstip.toUnsigned()))
+        replies = [self.rules[i] for i in self.dst_trie.covering(srcip.toUnsigned()) if i in reply_src_rules]
+        port_specific = any(rule[3] is not None or rule[4] != (0, 0xFFFF) for rule in candidates + replies)
+        if protocol is None:
+            #ARP is symmetric: any allow rule between the hosts (in either direction) lets them resolve each other,
+            #otherwise a deny rule covering every protocol (in either direction) keeps them apart
+            actions = set(rule[0] for rule in candidates + replies if rule[0] == 'allow' or (rule[3] is None and rule[4] == (0, 0xFFFF)))
+            if 'allow' in actions:
+                actions = set(['allow'])
+        else:
+            actions = set(rule[0] for rule in candidates
+                          if (rule[3] is None or rule[3] == protocol) and
+                             (rule[4] == (0, 0xFFFF) or (dstport is not None and rule[4][0] <= dstport <= rule[4][1])))
+            actions |= set(rule[0] for rule in replies
+                           if rule[0] == 'allow' and (rule[3] is None or rule[3] == protocol) and
+                              (rule[4] == (0, 0xFFFF) or (srcport is not None and rule[4][0] <= srcport <= rule[4][1])))
+        if 'deny' in actions:
+            allowed = False
+        elif 'allow' in actions:
+            allowed = True
+        else:
+            src_tenant = self.tenant_of(srcip)
+            dst_tenant = self.tenant_of(dstip)
+            if src_tenant is None or dst_tenant is None:
+                allowed = None
+            else:
+                allowed = (src_tenant == dst_tenant)
+
+        if len(self.cache) >= POLICY_CACHE_SIZE:
+            self.cache = {}
+        self.cache[key] = (allowed, port_specific)
+        return (allowed, port_specific)
+
+    #cover the IPs of every tenant with as few prefixes as possible: a prefix is split until the tenant entries inside
+    #it belong to a single tenant (addresses outside the policy are never forwarded, so any prefix may cover them)
+    #returns a dict (key = tenant id, value = list of (network, prefix length))
+    def tenant_prefixes(self):
+        tenant_prefixes = {}
+        def split(network, length, entries):
+            if len(entries) == 0:
+                return
+            tenant_ids = set(entry[2] for entry in entries)
+            if len(tenant_ids) == 1 or length == 32:
+                #at a single address the longest entry wins, as in tenant_of
+                tenant_id = tenant_ids.pop() if len(tenant_ids) == 1 else max(entries, key = lambda entry: entry[1])[2]
+                tenant_prefixes.setdefault(tenant_id, []).append((network, length))
+                return
+            half = network | (1 << (31 - length))
+            split(network, length + 1, [entry for entry in entries if prefixes_overlap(entry, (network, length + 1))])
+            split(half, length + 1, [entry for entry in entries if prefixes_overlap(entry, (half, length + 1))])
+        split(0, 0, self.tenants)
+        return tenant_prefixes
+
+    #the destination prefixes of the traffic from ip that neither the compiled drop rules nor the destination based rules
+    #decide right, so it keeps going through the controller: the destinations of the rules with a protocol/ports that
+    #cover ip (as source, or as destination of an allow rule, which decides the replies too) and the cross-tenant prefixes
+    #an allow rule overlaps without allowing everything from ip to them; everything for an IP outside the tenants
+    def undecided(self, ip):
+        addr = ip.toUnsigned()
+        if self.tenant_of(ip) is None:
+            return [(0, 0)]
+        prefixes = set()
+        allowed = [] #destination prefixes every packet from ip is allowed to (unless a deny rule drops it)
+        for rule in self.rules:
+            port_specific = rule[3] is not None or rule[4] != (0, 0xFFFF)
+            if in_prefix(addr, rule[1][0], rule[1][1]):
+                if port_specific:
+                    prefixes.add(rule[2])
+                elif rule[0] == 'allow':
+                    allowed.append(rule[2])
+            if rule[0] == 'allow' and in_prefix(addr, rule[2][0], rule[2][1]):
+                if port_specific:
+                    prefixes.add(rule[1])
+                else:
+                    allowed.append(rule[1])
+        allow_rules = [rule for rule in self.rules if rule[0] == 'allow']
+        tenant_prefixes = self.tenant_prefixes()
+        for (tenant_id, src_prefixes) in tenant_prefixes.items():
+            for src_prefix in src_prefixes:
+                if not in_prefix(addr, src_prefix[0], src_prefix[1]):
+                    continue
+                for (other_id, dst_prefixes) in tenant_prefixes.items():
+                    if other_id == tenant_id:
+                        continue
+                    for dst_prefix in dst_prefixes:
+                        #compile() left the pair to the controller if an allow rule overlaps it in either direction
+                        overlapped = any((prefixes_overlap(src_prefix, rule[1]) and prefixes_overlap(dst_prefix, rule[2])) or
+                                         (prefixes_overlap(src_prefix, rule[2]) and prefixes_overlap(dst_prefix, rule[1])) for rule in allow_rules)
+                        covered = any(prefix[1] <= dst_prefix[1] and in_prefix(dst_prefix[0], prefix[0], prefix[1]) for prefix in allowed)
+                        if overlapped and not covered:
+                            prefixes.add(dst_prefix)
+        return sorted(prefixes)
+
+    #compile the policy into drop rules (dl_type, src prefix, dst prefix, protocol, port): the deny rules that fit a single
+    #match and the cross-tenant prefix pairs that no allow rule overlaps (in either direction, as the replies and ARP
+    #are allowed both ways), the rest is decided at the controller
+    def compile(self):
+        compiled = []
+        allow_rules = [rule for rule in self.rules if rule[0] == 'allow']
+        def allow_overlaps(src_prefix, dst_prefix):
+            return any((prefixes_overlap(src_prefix, rule[1]) and prefixes_overlap(dst_prefix, rule[2])) or
+                       (prefixes_overlap(src_prefix, rule[2]) and prefixes_overlap(dst_prefix, rule[1])) for rule in allow_rules)
+        for rule in self.rules:
+            if rule[0] != 'deny':
+                continue
+            if rule[4] == (0, 0xFFFF):
+                compiled.append((0x0800, rule[1], rule[2], rule[3], None))
+                if rule[3] is None and not allow_overlaps(rule[1], rule[2]):
+                    compiled.append((0x0806, rule[1], rule[2], None, None))
+            elif rule[4][0] == rule[4][1] and rule[3] in [6, 17]:
+                compiled.append((0x0800, rule[1], rule[2], rule[3], rule[4][0]))
+
+        prefixes = self.tenant_prefixes()
+        for src_tenant in sorted(prefixes.keys()):
+            for dst_tenant in sorted(prefixes.keys()):
+                if src_tenant == dst_tenant:
+                    continue
+                for src_prefix in prefixes[src_tenant]:
+                    for dst_prefix in prefixes[dst_tenant]:
+                        if allow_overlaps(src_prefix, dst_prefix):
+                            continue
+                        compiled.append((0x0806, src_prefix, dst_prefix, None, None))
+                        compiled.append((0x0800, src_prefix, dst_prefix, None, None))
+        return compiled
+
+#an ARP request for dst_ip sent by (src_mac, src_ip)
+def arp_request(src_mac, src_ip, dst_ip):
+    r = arp()
+    r.opcode   = arp.REQUEST
+    r.hwsrc    = src_mac
+    r.hwdst    = EthAddr("00:00:00:00:00:00")
+    r.protosrc = src_ip
+    r.protodst = dst_ip
+    e = ethernet(type=ethernet.ARP_TYPE, src=src_mac, dst=EthAddr("ff:ff:ff:ff:ff:ff"))
+    e.set_payload(r)
+    return e
+
+#a row of the policy file -> ('rule', (action, src prefix, dst prefix, protocol, ports)) or ('tenant', list of (network, length, tenant id))
+def parse_policy_row(row):
+    if row[0] in ['allow', 'deny']:
+        if len(row) < 3:
+            raise ValueError("incomplete rule: %s" % (",".join(row)))
+        protocol = parse_protocol(row[3]) if len(row) > 3 else None
+        ports = parse_ports(row[4]) if len(row) > 4 else (0, 0xFFFF)
+        return ('rule', (row[0], parse_prefix(row[1]), parse_prefix(row[2]), protocol, ports))
+    tenant_id = int(row[0])
+    return ('tenant', [parse_prefix(ip) + (tenant_id,) for ip in row[1:len(row)]])
+
+#a row given as a csv line or a list of fields -> list of stripped fields
+def policy_row(row):
+    if not isinstance(row, list):
+        row = next(csv.reader([row.strip()]), [])
+    return [str(field).strip() for field in row]
+
+def firewall_match(rule):
+    (dl_type, src_prefix, dst_prefix, protocol, port) = rule
+    match = of.ofp_match()
+    match.dl_type = dl_type
+    if src_prefix[1] > 0:
+        match.nw_src = (IPAddr(src_prefix[0]), src_prefix[1])
+    if dst_prefix[1] > 0:
+        match.nw_dst = (IPAddr(dst_prefix[0]), dst_prefix[1])
+    if protocol is not None:
+        match.nw_proto = protocol
+    if port is not None:
+        match.tp_dst = port
+    return match
+
+#a compiled drop rule narrowed to the traffic a host sends into its edge switch
+def host_firewall_match(rule, ip, port):
+    match = firewall_match(rule)
+    match.nw_src = ip
+    match.in_port = port
+    return match
+
 def str_to_bool(str):
     assert(str in ['True', 'False'])
     if str=='True':
@@ -703,13 +2419,23 @@ def str_to_bool(str):
 
         
 def launch(firewall_capability='True', migration_capability='True',
-           firewall_policy_file='./ext/firewall_policies.csv', migration_events_file='./ext/migration_events.csv'):
+           firewall_policy_file='./ext/firewall_policies.csv', migration_events_file='./ext/migration_events.csv',
+           proactive_forwarding='True', load_share_report_interval='0', port_stats_interval='2', flow_stats_interval='5',
+           in_place_migration='True', control_socket='', host_timeout='0'):
     """
     Args:
         firewall_capability  : boolean, True/False
         migration_capability : boolean, True/False
         firewall_policy_file : string, filename of the csv file with firewall policies
         migration_info_file  : string, filename of the csv file with migration information
+        proactive_forwarding : boolean, True/False (destination based rules towards the learned hosts)
+        load_share_report_interval : seconds between the prints of the per link load share, 0 disables them
+        port_stats_interval  : seconds between the port statistics polls, 0 disables the congestion aware path selection
+        flow_stats_interval  : seconds between the flow statistics polls of the edge switches, 0 disables the elephant rerouting
+                               (and the host_timeout then only counts the packets that reach the controller)
+        in_place_migration   : boolean, True/False (rewrite the running flows make before break instead of flushing them)
+        control_socket       : string, path of the unix socket of the control API, empty disables it
+        host_timeout         : seconds a host is remembered without being seen again, 0 remembers it until its switch/port fails
     """
     print("\033[03mLoading Cloud Network Controller\033[00m")
     firewall_capability = str_to_bool(firewall_capability)
@@ -723,6 +2449,14 @@ def launch(firewall_capability='True', migration_capability='True',
         print("\033[03m\033[92mMigration Capability \033[04mENABLED\033[00m")
     else:
         print("\033[03m\033[31mMigration Capability \033[04mDISABLED\033[00m")
-        
-    core.registerNew(CloudNetController, firewall_capability, migration_capability, firewall_policy_file, migration_events_file)
+
+    proactive_forwarding = str_to_bool(proactive_forwarding)
+    if proactive_forwarding:
+        print("\033[03m\033[92mProactive Forwarding \033[04mENABLED\033[00m")
+    else:
+        print("\033[03m\033[31mProactive Forwarding \033[04mDISABLED\033[00m")
+
+    core.registerNew(CloudNetController, firewall_capability, migration_capability, firewall_policy_file, migration_events_file, proactive_forwarding,
+                     float(load_share_report_interval), float(port_stats_interval), float(flow_stats_interval), str_to_bool(in_place_migration),
+                     control_socket, float(host_timeout))
     print("\033[03mNetwork Controller loaded\033[00m")
@@ -0,0 +1,303 @@
+#!/usr/bin/python3
+
+# Unit tests of the CloudNetController (equal cost paths, flow setup, firewall policy, flow database, migrations,
+# control API, host locations), run without Mininet: POX is stubbed when it is not on the path, e.g.
+#   python3 -m pytest test_CloudNetController.py
+
+import os
+import sys
+import tempfile
+import types
+import unittest
+
+# POX is stubbed by the pox_stub module at the root of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from pox_stub import stub_pox, Connection
+stub_pox()
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pox.openflow.libopenflow_01 as of
+from pox.lib.addresses import IPAddr
+import CloudNetController as cnc
+
+# the clos_topo.py fabric: every aggregation switch is linked to every core and edge switch
+def clos_adjs(cores, fanout):
+    core_dpids = list(range(1, cores + 1))
+    aggr_dpids = list(range(cores + 1, cores + cores * fanout + 1))
+    edge_dpids = list(range(aggr_dpids[-1] + 1, aggr_dpids[-1] + cores * fanout * fanout + 1))
+    adjs = {}
+    for aggr in aggr_dpids:
+        for dpid in core_dpids + edge_dpids:
+            adjs.setdefault(aggr, set()).add(dpid)
+            adjs.setdefault(dpid, set()).add(aggr)
+    return (adjs, core_dpids, aggr_dpids, edge_dpids)
+
+class EqualCostPathsTest(unittest.TestCase):
+    def test_clos(self):
+        (adjs, cores, aggrs, edges) = clos_adjs(2, 2)
+        routes = cnc.NextHopPaths()
+        self.assertTrue(cnc.ClosShortestPaths(routes, dict((dpid, None) for dpid in adjs), adjs))
+        self.assertEqual(routes.count_paths(edges[0], edges[-1]), len(aggrs))
+        self.assertEqual(routes.count_paths(cores[0], cores[1]), len(aggrs))
+        self.assertEqual(routes.count_paths(aggrs[0], aggrs[1]), len(cores) + len(edges))
+        self.assertEqual(routes.count_paths(edges[0], aggrs[0]), 1)
+        paths = set(tuple(routes.get_path(edges[0], edges[-1], k)) for k in range(len(aggrs)))
+        self.assertEqual(paths, set((edges[0], aggr, edges[-1]) for aggr in aggrs))
+    def test_link_removal(self):
+        #a ring of four switches, with two equal cost paths between the opposite ones until a link fails
+        adjs = {1: set([2, 4]), 2: set([1, 3]), 3: set([2, 4]), 4: set([3, 1])}
+        routes = cnc.NextHopPaths()
+        routing = cnc.IncrementalShortestPaths(routes)
+        routing.update({}, adjs)
+        self.assertEqual(routes.count_paths(1, 3), 2)
+        adjs[1].discard(2)
+        adjs[2].discard(1)
+        routing.link_changed(1, 2)
+        routing.link_changed(2, 1)
+        routing.update({}, adjs)
+        self.assertEqual(routes.count_paths(1, 3), 1)
+        self.assertEqual(routes.get_path(1, 3, 0), [1, 4, 3])
+        self.assertEqual(routes.count_paths(1, 2), 1)
+    def test_graph_search_matches_clos(self):
+        (adjs, cores, aggrs, edges) = clos_adjs(2, 2)
+        clos = cnc.NextHopPaths()
+        cnc.ClosShortestPaths(clos, dict((dpid, None) for dpid in adjs), adjs)
+        searched = cnc.NextHopPaths()
+        searched.reset(adjs.keys())
+        cnc.ShortestPaths(searched, {}, adjs, targets = list(adjs.keys()))
+        for src in adjs:
+            for dst in adjs:
+                self.assertEqual(searched.count_paths(src, dst), clos.count_paths(src, dst))
+    def test_select_path_is_deterministic(self):
+        (adjs, cores, aggrs, edges) = clos_adjs(2, 2)
+        routes = cnc.NextHopPaths()
+        cnc.ClosShortestPaths(routes, dict((dpid, None) for dpid in adjs), adjs)
+        hash_value = cnc.flow_hash(IPAddr("10.0.0.1"), IPAddr("10.0.0.2"), 6, 40000, 80)
+        self.assertEqual(hash_value, cnc.flow_hash(IPAddr("10.0.0.1"), IPAddr("10.0.0.2"), 6, 40000, 80))
+        self.assertEqual(routes.select_path(edges[0], edges[-1], hash_value), routes.select_path(edges[0], edges[-1], hash_value))
+
+# a controller on a fabric of two switches (switch 1 port 2 is linked to switch 2 port 1), the migration events and
+# the firewall policy are read from the given rows
+def two_switch_controller(test, firewall_rows = None, migration_rows = None, **options):
+    files = []
+    for rows in [firewall_rows, migration_rows]:
+        if rows is None:
+            files.append(None)
+            continue
+        rows_file = tempfile.NamedTemporaryFile('w', suffix = '.csv', delete = False)
+        rows_file.write("".join(row + "\n" for row in rows))
+        rows_file.close()
+        test.addCleanup(os.remove, rows_file.name)
+        files.append(rows_file.name)
+    ctl = cnc.CloudNetController(firewall_rows is not None, migration_rows is not None, files[0], files[1],
+                                 port_stats_interval = 0, flow_stats_interval = 0, **options)
+    for dpid in [1, 2]:
+        sw = cnc.SwitchWithPaths(ctl.routes, ctl.flow_db)
+        sw.dpid = dpid
+        sw.connection = Connection(dpid)
+        ctl.switches[dpid] = sw
+    ctl.sw_sw_ports = {(1, 2): 2, (2, 1): 1}
+    ctl.adjs = {1: set([2]), 2: set([1])}
+    cnc.ShortestPaths(ctl.routes, ctl.switches, ctl.adjs)
+    ctl._paths_computed = True
+    return ctl
+
+# the packet-in of an ICMP packet at a switch
+def ip_packet_in(dpid, srcip, dstip):
+    packet = types.SimpleNamespace(src = "00:00:00:00:00:01", next = types.SimpleNamespace(protocol = 1, srcip = IPAddr(srcip), dstip = IPAddr(dstip)))
+    return (types.SimpleNamespace(dpid = dpid, parsed = packet), packet)
+
+# answer the barrier requests in the order they were sent, check(xid) runs before each reply
+def answer_barriers(ctl, check = None):
+    while len(ctl.flow_programmer.pending) > 0:
+        xid = min(ctl.flow_programmer.pending)
+        if check is not None:
+            check(xid)
+        ctl._handle_BarrierIn(types.SimpleNamespace(xid = xid))
+
+def packet_outs(sw):
+    return [msg for msg in sw.connection.sent if isinstance(msg, of.ofp_packet_out)]
+
+class FlowSetupTest(unittest.TestCase):
+    def test_packet_released_after_the_barrier_replies(self):
+        ctl = two_switch_controller(self, proactive_forwarding = False)
+        (event, packet) = ip_packet_in(1, "10.0.0.1", "10.0.0.2")
+        ctl.install_end_to_end_IP_path(event, 2, 3, packet)
+        self.assertEqual(len(ctl.flow_programmer.pending), 2) #one barrier per switch of the path
+        answer_barriers(ctl, lambda xid: self.assertEqual(packet_outs(ctl.switches[2]), []))
+        self.assertEqual([(msg.data, msg.actions[0].port) for msg in packet_outs(ctl.switches[2])], [(packet, 3)])
+
+    def test_packet_ins_of_a_pending_flow_are_queued(self):
+        ctl = two_switch_controller(self, proactive_forwarding = False)
+        packets = []
+        for dpid in [1, 1, 2]: #a second packet of the source, then the first packet at the downstream switch
+            (event, packet) = ip_packet_in(dpid, "10.0.0.1", "10.0.0.2")
+            ctl.install_end_to_end_IP_path(event, 2, 3, packet)
+            packets.append(packet)
+        self.assertEqual([len(sw.connection.sent) for sw in ctl.switches.values()], [1, 1]) #the rules were sent once
+        answer_barriers(ctl)
+        self.assertEqual([msg.data for msg in packet_outs(ctl.switches[2])], packets)
+        self.assertEqual(ctl.pending_flows, {})
+
+class FirewallPolicyTest(unittest.TestCase):
+    def policy(self, rows):
+        policy_file = tempfile.NamedTemporaryFile('w', suffix = '.csv', delete = False)
+        policy_file.write("\n".join(rows) + "\n")
+        policy_file.close()
+        self.addCleanup(os.remove, policy_file.name)
+        return cnc.FirewallPolicy(policy_file.name)
+    def test_compile_tenants(self):
+        policy = self.policy(["1,10.0.1.1", "2,10.0.2.1"])
+        tenant1 = cnc.parse_prefix("10.0.0.0/23")
+        tenant2 = cnc.parse_prefix("10.0.2.0/23")
+        self.assertEqual(sorted(policy.compile()), sorted([(0x0800, tenant1, tenant2, None, None), (0x0806, tenant1, tenant2, None, None),
+                                                           (0x0800, tenant2, tenant1, None, None), (0x0806, tenant2, tenant1, None, None)]))
+    def test_tenants(self):
+        policy = self.policy(["1,10.0.1.1,10.0.1.2", "2,10.0.2.1"])
+        self.assertEqual(policy.decide(IPAddr("10.0.1.1"), IPAddr("10.0.1.2"), 6, 80), (True, False))
+        self.assertEqual(policy.decide(IPAddr("10.0.1.1"), IPAddr("10.0.2.1"), 6, 80), (False, False))
+        self.assertEqual(policy.decide(IPAddr("10.0.1.1"), IPAddr("10.0.3.1")), (None, False))
+    def test_allow_rule_allows_the_replies(self):
+        policy = self.policy(["1,10.0.1.1", "2,10.0.2.5", "allow,10.0.1.0/24,10.0.2.5,tcp,80"])
+        client = IPAddr("10.0.1.1")
+        server = IPAddr("10.0.2.5")
+        self.assertEqual(policy.decide(client, server, 6, 80, 40000), (True, True))
+        self.assertEqual(policy.decide(client, server, 6, 81, 40000)[0], False)
+        self.assertEqual(policy.decide(server, client, 6, 40000, 80), (True, True))
+        self.assertEqual(policy.decide(server, client, 6, 40000, 81)[0], False)
+        self.assertEqual(policy.decide(server, client, 17, 40000, 80)[0], False)
+    def test_arp_is_symmetric(self):
+        policy = self.policy(["1,10.0.1.1", "2,10.0.2.5", "allow,10.0.1.0/24,10.0.2.5,tcp,80"])
+        self.assertEqual(policy.decide(IPAddr("10.0.1.1"), IPAddr("10.0.2.5"))[0], True)
+        self.assertEqual(policy.decide(IPAddr("10.0.2.5"), IPAddr("10.0.1.1"))[0], True)
+    def test_deny_wins(self):
+        policy = self.policy(["1,10.0.1.1,10.0.1.2", "deny,10.0.1.1,10.0.1.2", "allow,10.0.1.1,10.0.1.2,tcp,22"])
+        self.assertEqual(policy.decide(IPAddr("10.0.1.1"), IPAddr("10.0.1.2"), 6, 22)[0], False)
+        self.assertEqual(policy.decide(IPAddr("10.0.1.2"), IPAddr("10.0.1.1"), 6, 22)[0], True)
+    def test_compile_skips_both_directions_of_an_allow_rule(self):
+        policy = self.policy(["1,10.0.1.1", "2,10.0.2.1", "3,10.0.3.1", "allow,10.0.1.1,10.0.2.1,tcp,80"])
+        compiled = policy.compile()
+        prefixes = policy.tenant_prefixes()
+        pairs = set((rule[1], rule[2]) for rule in compiled)
+        for src_prefix in prefixes[1]:
+            for dst_prefix in prefixes[2]:
+                self.assertNotIn((src_prefix, dst_prefix), pairs)
+                self.assertNotIn((dst_prefix, src_prefix), pairs)
+        for src_prefix in prefixes[1]:
+            for dst_prefix in prefixes[3]:
+                self.assertIn((src_prefix, dst_prefix), pairs)
+                self.assertIn((dst_prefix, src_prefix), pairs)
+    def test_compile_deny_rules(self):
+        policy = self.policy(["deny,10.0.1.0/24,10.0.2.1", "deny,10.0.1.0/24,10.0.2.2,udp,53", "deny,10.0.1.0/24,10.0.2.3,tcp,1-1024"])
+        src = cnc.parse_prefix("10.0.1.0/24")
+        self.assertEqual(sorted(policy.compile()), sorted([(0x0800, src, cnc.parse_prefix("10.0.2.1"), None, None),
+                                                           (0x0806, src, cnc.parse_prefix("10.0.2.1"), None, None),
+                                                           (0x0800, src, cnc.parse_prefix("10.0.2.2"), 17, 53)]))
+
+class FlowDatabaseTest(unittest.TestCase):
+    def flow_mod(self, dst, port, command = of.OFPFC_MODIFY_STRICT):
+        msg = of.ofp_flow_mod(command = command, match = of.ofp_match(dl_type = 0x0800, nw_dst = IPAddr(dst)))
+        msg.actions.append(of.ofp_action_output(port))
+        return msg
+
+    def test_track(self):
+        flow_db = cnc.FlowDatabase()
+        src = IPAddr("10.0.0.1")
+        dst = IPAddr("10.0.0.2")
+        msg = self.flow_mod("10.0.0.2", 1)
+        flow_db.track(7, msg, (src, dst), [7, 3, 8])
+        flow_db.track(8, self.flow_mod("10.0.0.2", 2), (src, dst), [7, 3, 8])
+        self.assertTrue(msg.flags & of.OFPFF_SEND_FLOW_REM)
+        self.assertEqual(len(flow_db.of_ip(src)), 2)
+        self.assertEqual(sorted(entry.dpid for entry in flow_db.on_link(7, 3)), [7, 8])
+        self.assertEqual(flow_db.get(7, msg.match, msg.priority).actions[0].port, 1)
+
+        #a rule is replaced in place, and removed by a strict delete or its FlowRemoved
+        flow_db.track(7, self.flow_mod("10.0.0.2", 4), (src, dst))
+        self.assertEqual(flow_db.get(7, msg.match, msg.priority).actions[0].port, 4)
+        self.assertEqual([entry.dpid for entry in flow_db.on_link(7, 3)], [8])
+        flow_db.track(7, self.flow_mod("10.0.0.2", 4, of.OFPFC_DELETE_STRICT))
+        flow_db.remove(8, msg.match, msg.priority)
+        self.assertEqual(flow_db.entries, {})
+        self.assertEqual((flow_db.by_dpid, flow_db.by_ip, flow_db.by_link), ({}, {}, {}))
+
+    def test_stale_flow_removed(self):
+        flow_db = cnc.FlowDatabase()
+        (first, second) = (self.flow_mod("10.0.0.2", 1), self.flow_mod("10.0.0.2", 2))
+        flow_db.track(7, first)
+        flow_db.track(7, second)
+        #the removal of the rule that was replaced arrives late
+        flow_db.removed(7, first.match, first.priority, first.cookie)
+        self.assertEqual(flow_db.get(7, second.match, second.priority).actions[0].port, 2)
+        flow_db.removed(7, second.match, second.priority, second.cookie)
+        self.assertEqual(flow_db.entries, {})
+
+class MigrationTest(unittest.TestCase):
+    def test_old_rules_removed_after_the_new_ones_are_confirmed(self):
+        ctl = two_switch_controller(self, migration_rows = [], proactive_forwarding = False)
+        (peer, old_IP, new_IP) = (IPAddr("10.0.0.1"), IPAddr("10.0.0.2"), IPAddr("10.0.0.5"))
+        ctl.arpmap[peer] = ("00:00:00:00:00:01", 1, 3)
+        ctl.arpmap[old_IP] = ("00:00:00:00:00:02", 2, 3)
+        ctl.arpmap[new_IP] = ("00:00:00:00:00:05", 2, 4)
+        (event, packet) = ip_packet_in(1, str(peer), str(old_IP))
+        ctl.install_end_to_end_IP_path(event, 2, 3, packet)
+        answer_barriers(ctl)
+        (ingress_rule, ) = [entry for entry in ctl.flow_db.of_ip(old_IP) if entry.dpid == 1]
+        (old_rule, ) = [entry for entry in ctl.flow_db.of_ip(old_IP) if entry.dpid == 2]
+
+        ctl.handle_migration(old_IP, new_IP)
+        self.assertIn(new_IP, ctl.new_migrated_IPs)
+        answer_barriers(ctl, lambda xid: self.assertIsNotNone(ctl.flow_db.get(2, old_rule.match, old_rule.priority)))
+        self.assertIsNone(ctl.flow_db.get(2, old_rule.match, old_rule.priority))
+        #the running flow's rule at its ingress switch rewrites the headers in place
+        actions = ctl.flow_db.get(1, ingress_rule.match, ingress_rule.priority).actions
+        self.assertEqual([(action.kind, getattr(action, 'nw_addr', None)) for action in actions[:1]], [('set_nw_dst', new_IP)])
+
+class ControlApiTest(unittest.TestCase):
+    def test_malformed_migrate_is_rejected(self):
+        ctl = two_switch_controller(self, migration_rows = [])
+        ctl.arpmap[IPAddr("10.0.0.2")] = ("00:00:00:00:00:02", 2, 3)
+        ctl.arpmap[IPAddr("10.0.0.5")] = ("00:00:00:00:00:05", 2, 4)
+        for request in [{"op": "migrate"},
+                        {"op": "migrate", "old": "10.0.0.2"},
+                        {"op": "migrate", "old": "10.0.0.2", "new": "not an ip"},
+                        {"op": "migrate", "migrations": "10.0.0.2"},
+                        {"op": "migrate", "old": "10.0.0.2", "new": "10.0.0.9"}, #unknown location
+                        {"op": "migrate", "migrations": [["10.0.0.2", "10.0.0.5"], ["10.0.0.3", "10.0.0.5"]]}]:
+            response = ctl.handle_control_request(request)
+            self.assertFalse(response['ok'], request)
+            self.assertIn('error', response)
+        #nothing of a rejected request is applied
+        self.assertEqual((ctl.old_migrated_IPs, ctl.scheduled_migrations), ({}, {}))
+        self.assertTrue(ctl.handle_control_request({"op": "migrate", "old": "10.0.0.2", "new": "10.0.0.5"})['ok'])
+        self.assertEqual(ctl.old_migrated_IPs, {IPAddr("10.0.0.2"): IPAddr("10.0.0.5")})
+
+class HostLocationsTest(unittest.TestCase):
+    def test_move_and_expire(self):
+        hosts = cnc.HostLocations()
+        events = []
+        hosts.addListenerByName("HostMoved", events.append)
+        hosts.addListenerByName("HostExpired", events.append)
+        host = IPAddr("10.0.0.1")
+        self.assertTrue(hosts.learn(host, ("00:00:00:00:00:01", 7, 1)))
+        self.assertFalse(hosts.learn(host, ("00:00:00:00:00:01", 7, 1)))
+        self.assertTrue(hosts.learn(host, ("00:00:00:00:00:01", 8, 2)))
+        self.assertEqual((events[0].ip, events[0].old_location[1], events[0].new_location[1]), (host, 7, 8))
+        self.assertEqual((hosts.at_dpid(7), hosts.at_port(8, 2)), ([], [host]))
+        hosts.expire_port(8, 2, "port down")
+        self.assertEqual((events[1].ip, events[1].reason), (host, "port down"))
+        self.assertEqual((dict(hosts), hosts.by_dpid, hosts.by_port), ({}, {}, {}))
+
+    def test_idle_timeout(self):
+        hosts = cnc.HostLocations(timeout = 60)
+        (idle, busy) = (IPAddr("10.0.0.1"), IPAddr("10.0.0.2"))
+        hosts.learn(idle, ("00:00:00:00:00:01", 7, 1))
+        hosts.learn(busy, ("00:00:00:00:00:02", 7, 2))
+        for ip in [idle, busy]:
+            hosts.last_seen[ip] -= 120
+        hosts.seen(busy) #e.g. its rules count traffic
+        hosts.expire_idle()
+        self.assertEqual(list(hosts.keys()), [busy])
+
+if __name__ == '__main__':
+    unittest.main()
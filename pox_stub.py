@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+
+# The POX modules the controllers import, stubbed with only what their unit tests use, so the tests run without
+# POX and Mininet. With the real POX on the path nothing is stubbed. The tests call stub_pox() before importing a
+# controller, e.g.
+#   sys.path.insert(0, <the repository root>)
+#   from pox_stub import stub_pox
+#   stub_pox()
+
+import itertools
+import logging
+import socket
+import struct
+import sys
+import types
+
+def provide(name, **attributes):
+    module = sys.modules.setdefault(name, types.ModuleType(name))
+    if '.' in name:
+        (parent, child) = name.rsplit('.', 1)
+        setattr(provide(parent), child, module)
+    for (key, value) in attributes.items():
+        if not hasattr(module, key):
+            setattr(module, key, value)
+    return module
+
+class IPAddr(object):
+    def __init__(self, addr):
+        if isinstance(addr, IPAddr):
+            addr = addr.toUnsigned()
+        elif not isinstance(addr, int):
+            addr = struct.unpack("!I", socket.inet_aton(addr))[0]
+        self.addr = addr
+    def toUnsigned(self):
+        return self.addr
+    def __str__(self):
+        return socket.inet_ntoa(struct.pack("!I", self.addr))
+    __repr__ = __str__
+    def __hash__(self):
+        return hash(self.addr)
+    def __eq__(self, other):
+        return isinstance(other, IPAddr) and self.addr == other.addr
+    def __ne__(self, other):
+        return not self == other
+    def __lt__(self, other):
+        return self.addr < other.addr
+
+class EthAddr(str):
+    pass
+
+ETHER_BROADCAST = EthAddr("ff:ff:ff:ff:ff:ff")
+
+class arp(object):
+    (REQUEST, REPLY) = (1, 2)
+    HW_TYPE_ETHERNET = 1
+    PROTO_TYPE_IP = 0x0800
+    protolen = 4
+
+class ethernet(object):
+    (IP_TYPE, ARP_TYPE, LLDP_TYPE) = (0x0800, 0x0806, 0x88cc)
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+    def set_payload(self, payload):
+        self.next = self.payload = payload
+    def pack(self):
+        return b"ethernet"
+
+class ofp_match(object):
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+    def pack(self):
+        return repr(sorted((key, str(value)) for (key, value) in self.__dict__.items())).encode()
+
+class ofp_flow_mod(object):
+    def __init__(self, **fields):
+        (self.command, self.priority, self.flags, self.cookie) = (OFPFC_ADD, OFP_DEFAULT_PRIORITY, 0, 0)
+        (self.idle_timeout, self.hard_timeout, self.buffer_id) = (0, 0, NO_BUFFER)
+        (self.match, self.actions) = (ofp_match(), [])
+        self.__dict__.update(fields)
+    def pack(self):
+        return b"flow_mod"
+
+class ofp_packet_out(object):
+    def __init__(self, **fields):
+        (self.data, self.in_port, self.actions) = (None, OFPP_NONE, [])
+        self.__dict__.update(fields)
+    def pack(self):
+        return b"packet_out"
+
+xids = itertools.count(1)
+
+class ofp_barrier_request(object):
+    def __init__(self):
+        self.xid = next(xids)
+    def pack(self):
+        return b"barrier_request"
+
+class ofp_action(object):
+    def __init__(self, kind, **fields):
+        self.kind = kind
+        self.__dict__.update(fields)
+
+def ofp_action_output(port):
+    return ofp_action('output', port = port)
+
+class ofp_action_nw_addr(object):
+    set_src = staticmethod(lambda nw_addr: ofp_action('set_nw_src', nw_addr = nw_addr))
+    set_dst = staticmethod(lambda nw_addr: ofp_action('set_nw_dst', nw_addr = nw_addr))
+
+class ofp_action_dl_addr(object):
+    set_src = staticmethod(lambda dl_addr: ofp_action('set_dl_src', dl_addr = dl_addr))
+    set_dst = staticmethod(lambda dl_addr: ofp_action('set_dl_dst', dl_addr = dl_addr))
+
+(OFPFC_ADD, OFPFC_MODIFY, OFPFC_MODIFY_STRICT, OFPFC_DELETE, OFPFC_DELETE_STRICT) = range(5)
+OFP_DEFAULT_PRIORITY = 0x8000
+OFPFF_SEND_FLOW_REM = 1
+(OFPP_FLOOD, OFPP_CONTROLLER, OFPP_NONE) = (0xfffb, 0xfffd, 0xffff)
+NO_BUFFER = -1
+
+class Event(object):
+    pass
+
+class EventMixin(object):
+    def addListenerByName(self, name, handler):
+        self.__dict__.setdefault('_listeners', {}).setdefault(name, []).append(handler)
+    def raiseEvent(self, event_type, *args):
+        event = event_type(*args)
+        for handler in self.__dict__.get('_listeners', {}).get(event_type.__name__, []):
+            handler(event)
+        return event
+    def listenTo(self, source):
+        return None
+
+# the timers never fire, the tests call the periodic methods themselves
+class Timer(object):
+    def __init__(self, *args, **kw):
+        pass
+    def cancel(self):
+        pass
+
+class Core(object):
+    def __init__(self):
+        self.openflow = types.SimpleNamespace(addListeners = lambda *args, **kw: None)
+    def getLogger(self, *args):
+        return logging.getLogger("pox")
+    def listen_to_dependencies(self, *args, **kw):
+        return True
+    def callLater(self, function, *args):
+        function(*args)
+
+# a switch connection, recording what the controller sends to it
+class Connection(object):
+    def __init__(self, dpid):
+        self.dpid = dpid
+        self.sent = []
+    def send(self, data):
+        self.sent.append(data)
+    def removeListeners(self, listeners):
+        pass
+
+def stub_pox():
+    try:
+        import pox.core
+        if hasattr(pox.core, 'POXCore'):
+            return #the real POX
+    except ImportError:
+        pass
+
+    openflow = dict((name, value) for (name, value) in globals().items() if name.startswith(('ofp_', 'OFP', 'NO_BUFFER')))
+    provide('pox')
+    provide('pox.core', core = Core())
+    provide('pox.openflow', ethernet = ethernet)
+    provide('pox.openflow.libopenflow_01', **openflow)
+    provide('pox.lib')
+    provide('pox.lib.packet', arp = arp, ethernet = ethernet)
+    provide('pox.lib.packet.arp', arp = arp)
+    provide('pox.lib.packet.ipv4', ipv4 = object)
+    provide('pox.lib.packet.ethernet', ethernet = ethernet, ETHER_BROADCAST = ETHER_BROADCAST)
+    provide('pox.lib.addresses', IPAddr = IPAddr, EthAddr = EthAddr)
+    provide('pox.lib.revent', Event = Event, EventMixin = EventMixin, __all__ = ['Event', 'EventMixin'])
+    provide('pox.lib.recoco', Timer = Timer)